@@ -0,0 +1,96 @@
+#! /usr/bin/env python3
+
+"""
+Micro-benchmark comparing the per-message cost of evaluating an output map.
+
+Run from the repository root: python -m benchmarks.output_map
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from telegram2elastic import DottedPathDict, OutputMap, OutputWriter
+
+
+class FakeChat:
+    title = "Benchmark Chat"
+
+
+class FakeMessage:
+    def __init__(self, message_id: int):
+        self.id = message_id
+        self.date = datetime.now()
+        self.text = f"Message number {message_id}"
+
+
+def get_display_name(entity):
+    return entity.title
+
+
+async def legacy_async_exec(code, variables):
+    # Implementation used before output maps were compiled once per writer
+    task = [None]
+
+    exec_variables = {
+        "asyncio": asyncio,
+        "task": task
+    }
+
+    exec_variables.update(variables)
+    exec("async def _async_exec():\n return {}\ntask[0] = asyncio.ensure_future(_async_exec())".format(code), exec_variables)
+    return await task[0]
+
+
+async def legacy_eval_map(input_map: dict, variables: dict):
+    output = DottedPathDict()
+
+    for key, expression in input_map.items():
+        output.set(key, await legacy_async_exec(expression, variables))
+
+    return output
+
+
+async def measure(evaluate, count: int):
+    start_time = time.perf_counter()
+
+    for message_id in range(count):
+        await evaluate({
+            "message": FakeMessage(message_id),
+            "chat": FakeChat(),
+            "chat_name": FakeChat.title,
+            "chat_type": "group",
+            "sender": {"username": "bench", "firstName": "Bench", "lastName": "Mark"},
+            "get_display_name": get_display_name,
+            "translated_text": None,
+            "media": None
+        })
+
+    return (time.perf_counter() - start_time) / count
+
+
+async def run(count: int):
+    input_map = OutputWriter.default_output_map
+    output_map = OutputMap(input_map)
+
+    legacy_seconds = await measure(lambda variables: legacy_eval_map(input_map, variables), count)
+    compiled_seconds = await measure(output_map.evaluate, count)
+
+    print(f"Messages: {count}")
+    print(f"Legacy (exec per field): {legacy_seconds * 1e6:8.2f} µs/message")
+    print(f"Compiled output map:     {compiled_seconds * 1e6:8.2f} µs/message")
+    print(f"Speedup:                 {legacy_seconds / compiled_seconds:8.1f}x")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmark output map evaluation")
+    argument_parser.add_argument("--count", type=int, default=20000, help="number of messages to evaluate")
+
+    arguments = argument_parser.parse_args()
+
+    asyncio.run(run(arguments.count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Local stand-ins for the services written to by the outputs, used by the benchmarks.
+
+Each stand-in accepts everything it receives and answers just enough for the corresponding output to continue.
+"""
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class TcpSink:
+    # Reads and discards everything sent by the TCP output
+    def __init__(self):
+        self.server = None
+        self.received_bytes = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, "127.0.0.1", 0)
+
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while data := await reader.read(1024 * 1024):
+            self.received_bytes += len(data)
+
+        writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class RedisStandIn:
+    # Speaks the Redis protocol for the commands used by the Redis output without storing anything
+    def __init__(self):
+        self.server = None
+        self.received_commands = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, "127.0.0.1", 0)
+
+        return self.server.sockets[0].getsockname()[1]
+
+    async def read_command(self, reader: asyncio.StreamReader):
+        header = await reader.readline()
+        if not header:
+            return None
+
+        arguments = []
+
+        for _ in range(int(header[1:])):
+            length = int((await reader.readline())[1:])
+            arguments.append((await reader.readexactly(length + 2))[:-2])
+
+        return arguments
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while (arguments := await self.read_command(reader)) is not None:
+            command = arguments[0].decode().upper()
+            self.received_commands += 1
+
+            if command == "RPUSH":
+                writer.write(f":{len(arguments) - 2}\r\n".encode())
+            elif command == "XADD":
+                entry_id = f"{self.received_commands}-0"
+                writer.write(f"${len(entry_id)}\r\n{entry_id}\r\n".encode())
+            else:
+                writer.write(b"+OK\r\n")
+
+            await writer.drain()
+
+        writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class ElasticsearchHandler(BaseHTTPRequestHandler):
+    # Keep connections open and send each response using a single write to not measure delayed ACKs
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def do_HEAD(self):
+        self.send_json({})
+
+    def do_GET(self):
+        self.send_json({})
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if self.path.startswith("/_bulk"):
+            items = []
+
+            for line in body.splitlines()[0::2]:
+                operation, metadata = next(iter(json.loads(line).items()))
+                items.append({operation: {"_index": metadata.get("_index"), "_id": str(metadata.get("_id")), "status": 201, "result": "created"}})
+
+            self.send_json({"took": 1, "errors": False, "items": items})
+        else:
+            self.send_json({"result": "created"})
+
+    def send_json(self, data: dict):
+        body = json.dumps(data).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ElasticsearchStandIn:
+    # HTTP endpoint answering index and bulk requests like Elasticsearch, running in a separate thread
+    def __init__(self):
+        self.server = None
+        self.thread = None
+
+    async def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ElasticsearchHandler)
+        self.server.daemon_threads = True
+
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self.server.server_address[1]
+
+    async def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
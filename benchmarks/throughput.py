@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+
+"""
+Throughput benchmark running synthetic messages through the OutputHandler into each output type.
+
+The messages (text, media, edits, varied chats and senders) are created offline and belong to a stub Telegram
+client, the outputs write to local stand-ins (a temporary file, a TCP listener, an HTTP bulk endpoint and an
+in-process Redis server). Peak memory is measured using tracemalloc which also slows down the processing a bit,
+so compare results of the same benchmark only.
+
+Run from the repository root: python -m benchmarks.throughput [--outputs file redis] [--save results.json] [--compare results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+
+from telethon.tl.patched import Message
+from telethon.tl.types import Channel, ChatPhotoEmpty, Document, DocumentAttributeFilename, MessageMediaDocument, PeerChannel, PeerUser, User
+from telethon.utils import get_peer_id
+
+from benchmarks.stand_ins import ElasticsearchStandIn, RedisStandIn, TcpSink
+from telegram2elastic import OutputHandler
+
+
+class FakeTelegramClient:
+    # Attributes used by Telethon's Message objects
+    _self_id = 0
+    _mb_entity_cache = {}
+    parse_mode = None
+
+    async def download_media(self, message, file=None, progress_callback=None):
+        with open(file, "wb") as media_file:
+            media_file.write(os.urandom(message.file.size))
+
+        if progress_callback is not None:
+            await progress_callback(message.file.size, message.file.size)
+
+        return file
+
+
+class MessageGenerator:
+    mime_types = [("application/pdf", "pdf"), ("video/mp4", "mp4"), ("image/jpeg", "jpg"), ("audio/ogg", "ogg")]
+
+    def __init__(self, seed: int, chat_count: int = 20, sender_count: int = 200, media_ratio: float = 0.1, edit_ratio: float = 0.05):
+        self.randomizer = random.Random(seed)
+        self.client = FakeTelegramClient()
+
+        self.media_ratio = media_ratio
+        self.edit_ratio = edit_ratio
+
+        now = datetime.now(timezone.utc)
+
+        # Broadcast channels and groups (megagroups) with an access hash, just like received from Telegram
+        self.chats = [Channel(id=1000 + index, title=f"Chat {index}", photo=ChatPhotoEmpty(), date=now, access_hash=index, megagroup=bool(index % 2), broadcast=not index % 2) for index in range(chat_count)]
+        self.senders = [User(id=100000 + index, first_name=f"First{index}", last_name=f"Last{index}", username=f"user{index}", access_hash=index) for index in range(sender_count)]
+
+        self.entities = {get_peer_id(entity): entity for entity in self.chats + self.senders}
+
+    def create_text(self):
+        words = ["telegram", "elastic", "message", "benchmark", "hello", "world", "pipeline", "output", "media", "chat"]
+
+        return " ".join(self.randomizer.choice(words) for _ in range(self.randomizer.randint(3, 60)))
+
+    def create_media(self, media_id: int):
+        mime_type, extension = self.randomizer.choice(self.mime_types)
+        size = self.randomizer.randint(1024, 64 * 1024)
+
+        document = Document(id=media_id, access_hash=0, file_reference=b"", date=datetime.now(timezone.utc), mime_type=mime_type, size=size, dc_id=1, attributes=[DocumentAttributeFilename(f"file{media_id}.{extension}")])
+
+        return MessageMediaDocument(document=document)
+
+    def create_message(self, message_id: int, chat: Channel, date: datetime, media=None, edit_date: datetime = None):
+        sender = self.randomizer.choice(self.senders)
+
+        message = Message(id=message_id, peer_id=PeerChannel(chat.id), from_id=PeerUser(sender.id), date=date, message=self.create_text(), media=media, edit_date=edit_date)
+        message._finish_init(self.client, self.entities, None)
+
+        return message
+
+    def generate(self, count: int):
+        messages = []
+        last_message_ids = {}
+        date = datetime.now(timezone.utc) - timedelta(seconds=count)
+
+        for index in range(count):
+            chat = self.randomizer.choice(self.chats)
+            date += timedelta(seconds=1)
+
+            if last_message_ids.get(chat.id) and self.randomizer.random() < self.edit_ratio:
+                # Edit of an earlier message of the same chat (same ID, different text)
+                message_id = self.randomizer.randint(1, last_message_ids[chat.id])
+                messages.append(self.create_message(message_id, chat, date - timedelta(minutes=5), edit_date=date))
+                continue
+
+            message_id = last_message_ids[chat.id] = last_message_ids.get(chat.id, 0) + 1
+            media = self.create_media(index) if self.randomizer.random() < self.media_ratio else None
+
+            messages.append(self.create_message(message_id, chat, date, media))
+
+        return messages
+
+
+class OutputBenchmark(ABC):
+    def __init__(self, stand_in_class=None):
+        self.stand_in = stand_in_class() if stand_in_class is not None else None
+
+    async def start(self, temp_dir: str) -> dict:
+        port = await self.stand_in.start() if self.stand_in is not None else None
+
+        return self.get_output_config(temp_dir, port)
+
+    @abstractmethod
+    def get_output_config(self, temp_dir: str, port: int) -> dict:
+        pass
+
+    async def stop(self):
+        if self.stand_in is not None:
+            await self.stand_in.stop()
+
+
+class FileBenchmark(OutputBenchmark):
+    def get_output_config(self, temp_dir: str, port: int):
+        return {"type": "file", "path": os.path.join(temp_dir, "messages.json")}
+
+
+class TcpBenchmark(OutputBenchmark):
+    def __init__(self):
+        super().__init__(TcpSink)
+
+    def get_output_config(self, temp_dir: str, port: int):
+        return {"type": "tcp", "host": "127.0.0.1", "port": port}
+
+
+class ElasticsearchBenchmark(OutputBenchmark):
+    def __init__(self, options: dict):
+        super().__init__(ElasticsearchStandIn)
+
+        self.options = options
+
+    def get_output_config(self, temp_dir: str, port: int):
+        return {"type": "elasticsearch", "host": f"http://127.0.0.1:{port}", **self.options}
+
+
+class RedisBenchmark(OutputBenchmark):
+    def __init__(self):
+        super().__init__(RedisStandIn)
+
+    def get_output_config(self, temp_dir: str, port: int):
+        return {"type": "redis", "host": "127.0.0.1", "port": port, "key": "telegram"}
+
+
+BENCHMARKS = {
+    "file": FileBenchmark,
+    "tcp": TcpBenchmark,
+    "elasticsearch": lambda: ElasticsearchBenchmark({}),
+    "elasticsearch-bulk": lambda: ElasticsearchBenchmark({"bulk": True}),
+    "elasticsearch-async": lambda: ElasticsearchBenchmark({"async": True}),
+    "redis": RedisBenchmark
+}
+
+
+def get_percentile(values: list, percentile: float):
+    return sorted(values)[min(len(values) - 1, int(len(values) * percentile))]
+
+
+async def run_benchmark(name: str, messages: list, media_dir: str):
+    benchmark = BENCHMARKS[name]()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        output_config = await benchmark.start(temp_dir)
+
+        tracemalloc.start()
+
+        output_handler = OutputHandler(media_config={"download_path": os.path.join(media_dir, name)})
+        output_handler.add(output_config)
+
+        # Latency from submitting the message until the output has written it
+        submit_times = {}
+        latencies = []
+
+        writer = output_handler.outputs[0]
+        write_message = writer.write_message
+
+        async def measure_write_message(context):
+            await write_message(context)
+            latencies.append(time.perf_counter() - submit_times[id(context.message)])
+
+        writer.write_message = measure_write_message
+
+        start_time = time.perf_counter()
+
+        for message in messages:
+            submit_times[id(message)] = time.perf_counter()
+            # Edits are submitted like the MessageEdited handler does
+            await output_handler.submit(message, lambda chat: True, is_edit=message.edit_date is not None)
+
+        await output_handler.close()
+
+        seconds = time.perf_counter() - start_time
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        await benchmark.stop()
+
+    return {
+        "messages": len(latencies),
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(len(latencies) / seconds, 1),
+        "latency_p50_ms": round(get_percentile(latencies, 0.5) * 1000, 3),
+        "latency_p99_ms": round(get_percentile(latencies, 0.99) * 1000, 3),
+        "peak_memory_bytes": peak_memory
+    }
+
+
+def print_comparison(results: dict, previous_results: dict):
+    print()
+    print(f"Compared to {previous_results['timestamp']}:")
+
+    for name, result in results.items():
+        previous_result = previous_results["results"].get(name)
+        if previous_result is None:
+            continue
+
+        changes = []
+
+        for key in ["messages_per_second", "latency_p50_ms", "latency_p99_ms", "peak_memory_bytes"]:
+            if previous_result[key]:
+                changes.append(f"{key} {(result[key] / previous_result[key] - 1) * 100:+.1f}%")
+
+        print(f"{name:20} {', '.join(changes)}")
+
+
+async def run(arguments):
+    messages = MessageGenerator(arguments.seed, media_ratio=arguments.media_ratio, edit_ratio=arguments.edit_ratio).generate(arguments.count)
+    results = {}
+
+    print(f"Messages: {len(messages)} ({sum(1 for message in messages if message.media)} with media, {sum(1 for message in messages if message.edit_date)} edits)")
+    print(f"{'Output':20} {'msgs/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'peak MB':>10}")
+
+    with tempfile.TemporaryDirectory() as media_dir:
+        for name in arguments.outputs:
+            result = results[name] = await run_benchmark(name, messages, media_dir)
+
+            print(f"{name:20} {result['messages_per_second']:10.1f} {result['latency_p50_ms']:10.3f} {result['latency_p99_ms']:10.3f} {result['peak_memory_bytes'] / 1024 / 1024:10.1f}")
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "count": arguments.count,
+        "seed": arguments.seed,
+        "media_ratio": arguments.media_ratio,
+        "edit_ratio": arguments.edit_ratio,
+        "results": results
+    }
+
+    if arguments.compare:
+        with open(arguments.compare, "r") as compare_file:
+            print_comparison(results, json.load(compare_file))
+
+    if arguments.save:
+        with open(arguments.save, "w") as save_file:
+            json.dump(report, save_file, indent=2)
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmark writing messages to the outputs using local stand-ins")
+    argument_parser.add_argument("--count", type=int, default=5000, help="number of messages to write")
+    argument_parser.add_argument("--outputs", nargs="*", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="outputs to benchmark (default: all)")
+    argument_parser.add_argument("--seed", type=int, default=42, help="seed for generating the messages")
+    argument_parser.add_argument("--media-ratio", type=float, default=0.1, help="share of messages with media")
+    argument_parser.add_argument("--edit-ratio", type=float, default=0.05, help="share of messages which are edits of earlier messages")
+    argument_parser.add_argument("--save", help="write the results as JSON to the given file")
+    argument_parser.add_argument("--compare", help="compare the results with those of a previous run (JSON file written using --save)")
+
+    arguments = argument_parser.parse_args()
+
+    asyncio.run(run(arguments))
+
+
+if __name__ == "__main__":
+    main()
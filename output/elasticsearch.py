@@ -1,21 +1,151 @@
-from telegram2elastic import OutputWriter
+import asyncio
+import json
+import logging
+import re
+from datetime import datetime
+
+from telegram2elastic import FileSize, OutputBatcher, OutputWriter, METRICS, RejectedMessageError, json_default
+
+
+class BulkIndexer:
+    # Item status codes which are worth retrying (the rest is rejected permanently, e.g. mapping errors)
+    retry_status_codes = {429, 502, 503, 504}
+
+    def __init__(self, send_bulk: callable, config: dict, name: str = "output", document_failed: callable = None, operation: str = "index"):
+        self.send_bulk = send_bulk
+        self.operation = operation
+        self.document_failed = document_failed
+        self.metric_labels = (("output", name),)
+
+        self.max_documents = int(config.get("max_documents", 500))
+        self.max_bytes = FileSize.human_readable_to_bytes(str(config.get("max_size", "5M")))
+        self.max_linger = float(config.get("max_linger", 1))
+        self.max_retries = int(config.get("max_retries", 3))
+        self.retry_delay = float(config.get("retry_delay", 1))
+
+        self.logger = logging.getLogger("elasticsearch_bulk")
+
+        self.batcher = OutputBatcher(self.send, self.max_documents, self.max_linger, self.max_bytes)
+
+    async def add(self, index: str, doc_id, document: dict, operation: str = None, key=None):
+        # The key is passed to document_failed() (e.g. to identify the message across chats), the document ID by default
+        operation = operation or self.operation
+        action = {operation: {"_index": index, "_id": doc_id}}
+
+        # Partial updates (e.g. edited messages) create the document if it does not exist yet
+        if operation == "update":
+            document = {"doc": document, "doc_as_upsert": True}
+
+        await self.batcher.add((action, document, doc_id if key is None else key), len(json.dumps(document, default=json_default)) + 1)
+
+    async def flush(self):
+        await self.batcher.flush()
+
+    async def send(self, actions: list):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * pow(2, attempt - 1))
+
+            operations = []
+            for action, document, _ in actions:
+                operations.append(action)
+                operations.append(document)
+
+            try:
+                response = await self.send_bulk(operations)
+            except Exception as exception:
+                self.logger.error(f"Bulk request with {len(actions)} documents failed (attempt {attempt + 1}): {exception}")
+                continue
+
+            if not response.get("errors"):
+                self.logger.debug(f"Indexed {len(actions)} documents")
+                return
+
+            actions = self.get_retryable_actions(actions, response.get("items", []))
+            if not actions:
+                return
+
+            self.logger.warning(f"Retrying {len(actions)} documents of bulk request (attempt {attempt + 1})")
+            METRICS.count("output_retries_total", self.metric_labels)
+
+        self.logger.error(f"Giving up on {len(actions)} documents after {self.max_retries} retries")
+        METRICS.count("output_errors_total", self.metric_labels, len(actions))
+
+        if self.document_failed is not None:
+            for _, _, key in actions:
+                self.document_failed(key, False)
+
+    def get_retryable_actions(self, actions: list, items: list):
+        retry_actions = []
+
+        for (action, document, key), item in zip(actions, items):
+            result = next(iter(item.values()))
+
+            error = result.get("error")
+            if error is None:
+                continue
+
+            if result.get("status") in self.retry_status_codes:
+                retry_actions.append((action, document, key))
+            else:
+                self.logger.error(f"Unable to index document {result.get('_id')} into {result.get('_index')}: {error}")
+                METRICS.count("output_errors_total", self.metric_labels)
+
+                if self.document_failed is not None:
+                    self.document_failed(key, True)
+
+        return retry_actions
+
+    async def close(self):
+        await self.flush()
 
 
 class Writer(OutputWriter):
+    # strftime directives resulting in more than one index per day
+    sub_day_directives = re.compile(r"%[HIMSfpXcrRTsZz]")
+
     def __init__(self, config: dict):
         super().__init__(config)
 
         elasticsearch_version = config.get("version", 8)
+        self.is_async = bool(config.get("async", False))
 
         match elasticsearch_version:
             case 8:
-                from elasticsearch8 import Elasticsearch
+                from elasticsearch8 import Elasticsearch, AsyncElasticsearch
             case 9:
-                from elasticsearch9 import Elasticsearch
+                from elasticsearch9 import Elasticsearch, AsyncElasticsearch
             case _:
                 raise RuntimeError(f"Invalid Elasticsearch version: {elasticsearch_version}")
 
         self.index_format = config.get("index_format", "telegram-%Y.%m.%d")
+        self.index_cache = {}
+        self.daily_index = self.sub_day_directives.search(self.index_format) is None
+
+        # Data streams only accept new documents (op_type "create") with an "@timestamp" field and require an index template
+        self.data_stream = bool(config.get("data_stream", False))
+        self.operation = "create" if self.data_stream else "index"
+        self.index_options = {"op_type": "create"} if self.data_stream else {}
+        self.timestamp_field = "@timestamp" if self.data_stream else "timestamp"
+
+        import_config = config.get("import")
+
+        if import_config is True:
+            import_config = {}
+
+        self.import_config = import_config if isinstance(import_config, dict) else None
+
+        # Indices being imported to need a template to get the import settings once they are created
+        template_config = config.get("index_template")
+
+        if template_config is True or (template_config is None and (self.data_stream or self.import_config is not None)):
+            template_config = {}
+
+        self.template_config = template_config if isinstance(template_config, dict) else None
+        self.template_created = False
+
+        # Settings of the indices before starting the import, restored once the import is done
+        self.original_settings = None
 
         username = config.get("username")
         password = config.get("password")
@@ -25,12 +155,174 @@ class Writer(OutputWriter):
         else:
             http_auth = None
 
-        self.client = Elasticsearch(hosts=config.get("host", "localhost"), basic_auth=http_auth)
+        client_options = {}
+
+        if config.get("connections_per_node") is not None:
+            client_options["connections_per_node"] = int(config.get("connections_per_node"))
+
+        if config.get("request_timeout") is not None:
+            client_options["request_timeout"] = float(config.get("request_timeout"))
+
+        if self.is_async:
+            self.client = AsyncElasticsearch(hosts=config.get("host", "localhost"), basic_auth=http_auth, **client_options)
+        else:
+            self.client = Elasticsearch(hosts=config.get("host", "localhost"), basic_auth=http_auth, **client_options)
+
+        # Limits the number of concurrent index requests in async mode, further messages wait for a free slot (backpressure)
+        self.in_flight = asyncio.Semaphore(int(config.get("max_in_flight", 8)))
+        self.pending_requests = {}
+
+        # Documents which could not be indexed, only tracked if errors have to be reported (see flush_pending())
+        self.failed_documents = 0
+        self.rejected_keys = []
+
+        bulk_config = config.get("bulk")
+
+        if bulk_config is True:
+            bulk_config = {}
+
+        if isinstance(bulk_config, dict):
+            self.bulk_indexer = BulkIndexer(self.send_bulk, bulk_config, self.name, self.document_failed, self.operation)
+        else:
+            self.bulk_indexer = None
+
+    async def send_bulk(self, operations: list):
+        if self.is_async:
+            response = await self.client.bulk(operations=operations)
+        else:
+            # Run the synchronous client in a thread to not block the event loop while waiting for the bulk response
+            response = await asyncio.to_thread(self.client.bulk, operations=operations)
+
+        return response.body
+
+    async def call_client(self, function: callable, **kwargs):
+        if self.is_async:
+            response = await function(**kwargs)
+        else:
+            response = await asyncio.to_thread(function, **kwargs)
+
+        return response.body
+
+    def get_index(self, date: datetime) -> str:
+        # Formatting the index name is only required once per day (unless the format contains placeholders like the hour)
+        if not self.daily_index:
+            return date.strftime(self.index_format)
+
+        key = (date.year, date.month, date.day, date.utcoffset())
+
+        index = self.index_cache.get(key)
+        if index is None:
+            if len(self.index_cache) >= 1000:
+                self.index_cache.clear()
+
+            index = self.index_cache[key] = date.strftime(self.index_format)
+
+        return index
+
+    def get_index_patterns(self) -> list:
+        index_patterns = self.template_config.get("index_patterns")
+        if index_patterns:
+            return [index_patterns] if isinstance(index_patterns, str) else list(index_patterns)
+
+        # Everything starting with the fixed part of the index format
+        if "%" in self.index_format:
+            return [self.index_format.split("%")[0] + "*"]
+
+        return [self.index_format]
 
-    async def write_message(self, message, translated_text, downloaded_media):
-        doc_data = await self.get_message_dict(message, translated_text, downloaded_media)
+    def get_template_settings(self) -> dict:
+        settings = self.template_config.get("settings") or {}
 
-        doc_data["timestamp"] = message.date
+        return {key if key.startswith("index.") else f"index.{key}": value for key, value in settings.items()}
+
+    def get_template_mappings(self) -> dict:
+        properties = {self.timestamp_field: {"type": "date"}}
+
+        # Dotted names (e.g. "sender.id") map fields of objects
+        for field, mapping in (self.template_config.get("mappings") or {}).items():
+            *parents, name = field.split(".")
+            field_properties = properties
+
+            for parent in parents:
+                field_properties = field_properties.setdefault(parent, {}).setdefault("properties", {})
+
+            field_properties[name] = {"type": mapping} if isinstance(mapping, str) else mapping
+
+        return {"properties": properties}
+
+    async def put_index_template(self, import_settings: dict = None):
+        template = {"settings": {**self.get_template_settings(), **(import_settings or {})}, "mappings": self.get_template_mappings()}
+
+        options = {"data_stream": {}} if self.data_stream else {}
+
+        await self.call_client(self.client.indices.put_index_template, name=self.template_config.get("name", "telegram2elastic"), index_patterns=self.get_index_patterns(), priority=int(self.template_config.get("priority", 100)), template=template, **options)
+
+        self.template_created = True
+
+    async def get_index_settings(self) -> dict:
+        response = await self.call_client(self.client.indices.get_settings, index=",".join(self.get_index_patterns()), name="index.refresh_interval,index.number_of_replicas", flat_settings=True, allow_no_indices=True)
+
+        # Settings which are not set explicitly are missing and reset to their default using None
+        return {index: {key: data.get("settings", {}).get(key) for key in ["index.refresh_interval", "index.number_of_replicas"]} for index, data in response.items()}
+
+    async def put_index_settings(self, indices: list, settings: dict):
+        # Limit the number of indices per request to not exceed the maximum URL length
+        for start in range(0, len(indices), 100):
+            await self.call_client(self.client.indices.put_settings, index=",".join(indices[start:start + 100]), settings=settings, allow_no_indices=True)
+
+    async def start_import(self):
+        if self.import_config is None or self.original_settings is not None:
+            return
+
+        import_settings = {"index.refresh_interval": "-1", "index.number_of_replicas": int(self.import_config.get("number_of_replicas", 0))}
+
+        try:
+            self.original_settings = await self.get_index_settings()
+
+            # New indices are created using the import settings, existing ones are updated
+            await self.put_index_template(import_settings)
+
+            if self.original_settings:
+                await self.put_index_settings(list(self.original_settings), import_settings)
+        except Exception as exception:
+            logging.error(f"Unable to prepare Elasticsearch indices for importing: {exception}")
+
+    async def finish_import(self):
+        original_settings, self.original_settings = self.original_settings, None
+
+        template_settings = self.get_template_settings()
+        default_settings = {key: template_settings.get(key) for key in ["index.refresh_interval", "index.number_of_replicas"]}
+
+        try:
+            await self.put_index_template()
+
+            # Restore the previous settings of existing indices, indices created while importing get the settings of the template
+            indices_by_settings = {}
+
+            for index in await self.get_index_settings():
+                settings = original_settings.get(index, default_settings)
+                indices_by_settings.setdefault(tuple(settings.items()), []).append(index)
+
+            for settings, indices in indices_by_settings.items():
+                await self.put_index_settings(indices, dict(settings))
+        except Exception as exception:
+            logging.error(f"Unable to restore settings of Elasticsearch indices after importing: {exception}")
+
+    async def write_message(self, context):
+        message = context.message
+
+        if self.template_config is not None and not self.template_created:
+            self.template_created = True
+
+            try:
+                await self.put_index_template()
+            except Exception as exception:
+                logging.error(f"Unable to create index template: {exception}")
+
+        # Copy the dict as it is shared with other outputs using the same output map
+        doc_data = dict(await self.get_message_dict(context))
+
+        doc_data[self.timestamp_field] = message.date
 
         # get_message_dict() by default adds "id" and "date" which should not be in the body
         if "id" in doc_data:
@@ -38,4 +330,116 @@ class Writer(OutputWriter):
         if "date" in doc_data:
             del doc_data["date"]
 
-        self.client.index(index=message.date.strftime(self.index_format), body=doc_data, id=message.id)
+        index = self.get_index(message.date)
+
+        # Identifies the message for the dead letter file of the spool (message IDs are only unique within a chat)
+        message_key = (message.chat_id, message.id)
+
+        # Edit records only contain the changed fields and are applied as partial update of the existing document
+        is_edit = context.is_edit
+        if is_edit:
+            if self.data_stream:
+                raise RejectedMessageError(f"Edit of document {message.id} can't be written to data stream {index}", [message_key])
+
+            doc_data.pop("edit", None)
+
+            # Edit records always contain the chat, documents are already identified by their ID though
+            if "chat_id" not in self.output_map.keys:
+                doc_data.pop("chat_id", None)
+
+        if self.bulk_indexer is not None:
+            await self.bulk_indexer.add(index, message.id, doc_data, "update" if is_edit else None, message_key)
+        elif self.is_async:
+            await self.in_flight.acquire()
+
+            document_key = (index, message.id)
+            previous_request = self.pending_requests.get(document_key)
+
+            request = asyncio.ensure_future(self.index_document(index, message.id, doc_data, previous_request, is_edit, message_key))
+            request.add_done_callback(lambda _: self.request_done(document_key, request))
+
+            self.pending_requests[document_key] = request
+        else:
+            try:
+                if is_edit:
+                    self.client.update(index=index, id=message.id, doc=doc_data, doc_as_upsert=True)
+                else:
+                    self.client.index(index=index, body=doc_data, id=message.id, **self.index_options)
+            except Exception as exception:
+                if self.is_rejected(exception):
+                    raise RejectedMessageError(f"Document {message.id} rejected by {index}: {exception}", [message_key]) from exception
+
+                raise
+
+    @staticmethod
+    def is_rejected(exception: Exception):
+        # Client errors (except too many requests) will not succeed on retry
+        status_code = getattr(exception, "status_code", None)
+
+        return isinstance(status_code, int) and 400 <= status_code < 500 and status_code != 429
+
+    def request_done(self, document_key: tuple, request: asyncio.Future):
+        self.in_flight.release()
+
+        if self.pending_requests.get(document_key) is request:
+            del self.pending_requests[document_key]
+
+    async def index_document(self, index: str, doc_id, doc_data: dict, previous_request: asyncio.Future | None, is_edit: bool = False, message_key: tuple = None):
+        # Another version of the same document (e.g. the original message before an edit) must be indexed first
+        if previous_request is not None:
+            await asyncio.wait([previous_request])
+
+        try:
+            if is_edit:
+                await self.client.update(index=index, id=doc_id, doc=doc_data, doc_as_upsert=True)
+            else:
+                await self.client.index(index=index, body=doc_data, id=doc_id, **self.index_options)
+        except Exception as exception:
+            logging.error(f"Unable to index document {doc_id} into {index}: {exception}")
+            METRICS.count("output_errors_total", (("output", self.name),))
+
+            self.document_failed(message_key, self.is_rejected(exception))
+
+    def document_failed(self, message_key: tuple, rejected: bool):
+        if not self.report_errors:
+            return
+
+        if rejected:
+            self.rejected_keys.append(message_key)
+        else:
+            self.failed_documents += 1
+
+    def reset_errors(self):
+        self.failed_documents = 0
+        self.rejected_keys = []
+
+    async def flush_pending(self):
+        if self.bulk_indexer is not None:
+            await self.bulk_indexer.flush()
+
+        if self.pending_requests:
+            await asyncio.wait(list(self.pending_requests.values()))
+
+        failed_documents, rejected_keys = self.failed_documents, self.rejected_keys
+        self.reset_errors()
+
+        if failed_documents:
+            raise RuntimeError(f"Unable to index {failed_documents} documents")
+
+        if rejected_keys:
+            raise RejectedMessageError(f"{len(rejected_keys)} documents rejected", rejected_keys)
+
+    async def close(self):
+        if self.bulk_indexer is not None:
+            await self.bulk_indexer.close()
+
+        if self.pending_requests:
+            await asyncio.wait(list(self.pending_requests.values()))
+
+        if self.original_settings is not None:
+            await self.finish_import()
+
+        if self.is_async:
+            await self.client.close()
+        else:
+            self.client.close()
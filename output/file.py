@@ -1,18 +1,174 @@
-import json
+import asyncio
+import gzip
+import logging
+import lzma
 import os
+import shutil
+import time
+from datetime import datetime
 
-from telegram2elastic import json_default, OutputWriter
+from telegram2elastic import FileSize, OutputWriter
+
+COMPRESSION_OPENERS = {
+    "gzip": (gzip.open, ".gz"),
+    "lzma": (lzma.open, ".xz")
+}
+
+
+def compress_file(path: str, compression: str):
+    opener, extension = COMPRESSION_OPENERS[compression]
+
+    with open(path, "rb") as input_file, opener(f"{path}{extension}.tmp", "wb") as output_file:
+        shutil.copyfileobj(input_file, output_file, 1024 * 1024)
+
+    # Keep the modification time of the segment so that the files keep their order (e.g. for replaying them)
+    shutil.copystat(path, f"{path}{extension}.tmp")
+    os.replace(f"{path}{extension}.tmp", f"{path}{extension}")
+    os.remove(path)
 
 
 class Writer(OutputWriter):
+    fsync_policies = ["never", "flush", "rotate"]
+
     def __init__(self, config: dict):
         super().__init__(config)
 
-        self.path = os.path.expanduser(config.get("path"))
+        # The path might contain strftime placeholders to rotate the file based on the current time
+        self.path_pattern = os.path.expanduser(config.get("path"))
+
+        max_size = config.get("max_size")
+        self.max_size = FileSize.human_readable_to_bytes(str(max_size)) if max_size else None
+
+        self.flush_interval = float(config.get("flush_interval", 1))
+        self.buffer_size = FileSize.human_readable_to_bytes(str(config.get("buffer_size", "64K")))
+
+        self.fsync = config.get("fsync", "never")
+        if self.fsync not in self.fsync_policies:
+            raise RuntimeError(f"Invalid fsync policy for file output: {self.fsync} (expected one of {', '.join(self.fsync_policies)})")
+
+        self.compression = config.get("compression")
+        self.compress_rotated = config.get("compress_rotated")
+
+        for compression in [self.compression, self.compress_rotated]:
+            if compression is not None and compression not in COMPRESSION_OPENERS:
+                raise RuntimeError(f"Invalid compression for file output: {compression} (expected one of {', '.join(COMPRESSION_OPENERS)})")
+
+        self.file = None
+        self.path = None
+        self.written_bytes = 0
+
+        self.current_path = None
+        self.path_second = None
+        self.flush_task = None
+        self.compress_tasks = set()
+
+    def get_current_path(self):
+        # Formatting the path is only required once per second
+        now = int(time.time())
+
+        if now != self.path_second:
+            self.path_second = now
+            self.current_path = datetime.fromtimestamp(now).strftime(self.path_pattern)
+
+        return self.current_path
+
+    def open(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        if self.compression is not None:
+            opener, _ = COMPRESSION_OPENERS[self.compression]
+            self.file = opener(path, "ab")
+        else:
+            self.file = open(path, "ab", buffering=self.buffer_size)
+
+        self.path = path
+        self.written_bytes = os.path.getsize(path) if self.compression is None else 0
+
+    def close_file(self):
+        if self.file is None:
+            return
+
+        self.file.flush()
+
+        if self.fsync != "never":
+            os.fsync(self.file.fileno())
+
+        self.file.close()
+        self.file = None
+
+    def rotate(self):
+        rotated_path = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+
+        self.close_file()
+        os.replace(self.path, rotated_path)
+
+        self.compress_segment(rotated_path)
+
+    def compress_segment(self, path: str):
+        if self.compress_rotated is None:
+            return
+
+        task = asyncio.ensure_future(asyncio.to_thread(compress_file, path, self.compress_rotated))
+        task.add_done_callback(self.compress_done)
+
+        self.compress_tasks.add(task)
+
+    def compress_done(self, task: asyncio.Future):
+        self.compress_tasks.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Unable to compress rotated file: {task.exception()}")
+
+    async def write_message(self, context):
+        line = await self.get_message_json(context) + b"\n"
+
+        path = self.get_current_path()
+
+        if path != self.path:
+            # Time based rotation: the formatted path changed
+            previous_path = self.path
+
+            self.close_file()
+            self.open(path)
+
+            if previous_path is not None:
+                self.compress_segment(previous_path)
+        elif self.max_size is not None and self.written_bytes + len(line) > self.max_size and self.written_bytes:
+            self.rotate()
+            self.open(path)
+
+        self.file.write(line)
+        self.written_bytes += len(line)
+
+        if self.flush_interval <= 0:
+            self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+
+        self.flush_task = None
+        self.flush()
+
+    def flush(self):
+        if self.file is None:
+            return
+
+        self.file.flush()
+
+        if self.fsync == "flush":
+            os.fsync(self.file.fileno())
+
+    async def flush_pending(self):
+        self.flush()
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
 
-    async def write_message(self, message, translated_text, downloaded_media):
-        message_dict = await self.get_message_dict(message, translated_text, downloaded_media)
+        self.close_file()
 
-        with open(self.path, "a") as output_file:
-            json.dump(message_dict, output_file, default=json_default)
-            output_file.write("\n")
+        if self.compress_tasks:
+            await asyncio.wait(list(self.compress_tasks))
@@ -1,8 +1,9 @@
-import json
+import asyncio
+import logging
 
-from redis import Redis
+from redis.asyncio import Redis
 
-from telegram2elastic import json_default, OutputWriter
+from telegram2elastic import OutputBatcher, OutputWriter, METRICS
 
 
 class Writer(OutputWriter):
@@ -11,9 +12,77 @@ class Writer(OutputWriter):
 
         self.key = config.get("key")
 
+        # Append to a Redis Stream (XADD) instead of a list (RPUSH)
+        self.use_stream = bool(config.get("stream", False))
+
+        # Maximum number of entries kept in the list (LTRIM) or stream (MAXLEN), 0 to keep everything
+        self.max_length = int(config.get("max_length", 0))
+
+        batch_config = config.get("batch") or {}
+
+        self.max_messages = int(batch_config.get("max_messages", 100))
+        self.max_linger = float(batch_config.get("max_linger", 0.5))
+
+        # Batches which could not be written are retried with exponentially increasing delays
+        self.max_retries = int(batch_config.get("max_retries", 3))
+        self.retry_delay = float(batch_config.get("retry_delay", 1))
+
         self.client = Redis(host=config.get("host", "localhost"), port=config.get("port", 6379), db=config.get("db", 0), username=config.get("username"), password=config.get("password"))
 
-    async def write_message(self, message, translated_text, downloaded_media):
-        message_dict = await self.get_message_dict(message, translated_text, downloaded_media)
+        self.batcher = OutputBatcher(self.send_batch, self.max_messages, self.max_linger)
+
+        # Number of messages which could not be written, only tracked if errors have to be reported (see flush_pending())
+        self.failed_messages = 0
+
+    async def write_message(self, context):
+        await self.batcher.add(await self.get_message_json(context))
+
+    async def flush(self):
+        await self.batcher.flush()
+
+    async def send_batch(self, messages: list):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay * pow(2, attempt - 1))
+                METRICS.count("output_retries_total", (("output", self.name),))
+
+            try:
+                await self.send(messages)
+                return
+            except Exception as exception:
+                logging.error(f"Unable to write {len(messages)} messages to Redis key '{self.key}' (attempt {attempt + 1}): {exception}")
+
+        logging.error(f"Giving up on {len(messages)} messages for Redis key '{self.key}' after {self.max_retries} retries")
+        METRICS.count("output_errors_total", (("output", self.name),), len(messages))
+
+        if self.report_errors:
+            self.failed_messages += len(messages)
+
+    def reset_errors(self):
+        self.failed_messages = 0
+
+    async def flush_pending(self):
+        await self.flush()
+
+        failed_messages = self.failed_messages
+        self.reset_errors()
+
+        if failed_messages:
+            raise RuntimeError(f"Unable to write {failed_messages} messages to Redis key '{self.key}'")
+
+    async def send(self, messages: list):
+        async with self.client.pipeline(transaction=False) as pipeline:
+            if self.use_stream:
+                for message in messages:
+                    pipeline.xadd(self.key, {"message": message}, maxlen=self.max_length or None, approximate=True)
+            else:
+                pipeline.rpush(self.key, *messages)
+
+                if self.max_length:
+                    pipeline.ltrim(self.key, -self.max_length, -1)
+
+            await pipeline.execute()
 
-        self.client.rpush(self.key, json.dumps(message_dict, default=json_default))
+    async def close(self):
+        await self.flush()
+        await self.client.close()
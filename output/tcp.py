@@ -1,39 +1,242 @@
-import json
+import asyncio
 import logging
-import socket
-import time
+import os
+from collections import deque
 
-from telegram2elastic import json_default, OutputWriter
+from telegram2elastic import FileSize, OutputWriter, METRICS
+
+
+class SpillFile:
+    # Append-only file holding lines which did not fit into the in-memory buffer, read back in the same order
+    def __init__(self, path: str):
+        self.path = path
+        self.read_offset = 0
+
+        # Track the size in memory to not stat the file for every message
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def has_data(self):
+        return self.size > self.read_offset
+
+    def append(self, lines: list):
+        with open(self.path, "ab") as spill_file:
+            spill_file.writelines(lines)
+
+        self.size += sum(len(line) for line in lines)
+
+    def read(self, max_lines: int):
+        lines = []
+
+        with open(self.path, "rb") as spill_file:
+            spill_file.seek(self.read_offset)
+
+            while len(lines) < max_lines:
+                line = spill_file.readline()
+                if not line.endswith(b"\n"):
+                    break
+
+                lines.append(line)
+
+        self.read_offset += sum(len(line) for line in lines)
+
+        # Start over with an empty file once everything has been read
+        if not self.has_data():
+            os.truncate(self.path, 0)
+            self.read_offset = 0
+            self.size = 0
+
+        return lines
+
+    def prepend(self, lines: list):
+        # Rewrite the file with the given lines in front of the unread ones (e.g. unsent lines on shutdown)
+        remaining_data = b""
+
+        if self.has_data():
+            with open(self.path, "rb") as spill_file:
+                spill_file.seek(self.read_offset)
+                remaining_data = spill_file.read()
+
+        with open(f"{self.path}.tmp", "wb") as spill_file:
+            spill_file.writelines(lines)
+            spill_file.write(remaining_data)
+
+        os.replace(f"{self.path}.tmp", self.path)
+        self.read_offset = 0
+        self.size = os.path.getsize(self.path)
 
 
 class Writer(OutputWriter):
+    overflow_policies = ["block", "drop_oldest", "spill"]
+
     def __init__(self, config: dict):
         super().__init__(config)
 
         self.host = config.get("host")
         self.port = config.get("port")
 
-        self.socket = None
+        # Maximum number of lines kept in memory while the connection is slow or down
+        self.buffer_size = int(config.get("buffer_size", 10000))
 
-    def ensure_connected(self):
-        if self.socket:
-            return
+        # Maximum number of bytes sent using a single write
+        self.max_write_size = FileSize.human_readable_to_bytes(str(config.get("max_write_size", "64K")))
+
+        self.reconnect_delay = float(config.get("reconnect_delay", 1))
+        self.max_reconnect_delay = float(config.get("max_reconnect_delay", 60))
+        self.close_timeout = float(config.get("close_timeout", 10))
+
+        self.overflow = config.get("overflow", "block")
+        if self.overflow not in self.overflow_policies:
+            raise RuntimeError(f"Invalid overflow policy for TCP output: {self.overflow} (expected one of {', '.join(self.overflow_policies)})")
+
+        if self.overflow == "spill":
+            spill_path = config.get("spill_path")
+            if spill_path is None:
+                raise RuntimeError("The TCP output requires 'spill_path' if overflow policy 'spill' is used")
+
+            self.spill_file = SpillFile(os.path.expanduser(spill_path))
+        else:
+            self.spill_file = None
+
+        self.buffer = deque()
+        self.sending_lines = []
+        self.buffer_changed = asyncio.Condition()
+        self.dropped_lines = 0
+
+        # Number of dropped lines not reported by flush_pending() yet, only tracked if errors have to be reported
+        self.unreported_dropped_lines = 0
+
+        self.stream_writer = None
+        self.sender_task = None
+
+    async def write_message(self, context):
+        line = await self.get_message_json(context) + b"\n"
+
+        if self.sender_task is None:
+            self.start_sender()
+
+        async with self.buffer_changed:
+            # Keep the order of lines: as long as lines are spilled, new lines have to be appended to the spill file as well
+            if self.spill_file is not None and (len(self.buffer) >= self.buffer_size or self.spill_file.has_data()):
+                self.spill_file.append([line])
+                self.buffer_changed.notify_all()
+                return
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+            if len(self.buffer) >= self.buffer_size:
+                if self.overflow == "drop_oldest":
+                    self.buffer.popleft()
+                    self.dropped_lines += 1
 
-    async def write_message(self, message, translated_text, downloaded_media):
-        message_dict = await self.get_message_dict(message, translated_text, downloaded_media)
+                    if self.report_errors:
+                        self.unreported_dropped_lines += 1
+                    METRICS.count("output_errors_total", (("output", self.name),))
 
-        data = json.dumps(message_dict, default=json_default) + "\n"
+                    if self.dropped_lines == 1 or self.dropped_lines % 1000 == 0:
+                        logging.warning(f"TCP output buffer for {self.host}:{self.port} is full, dropped {self.dropped_lines} messages so far")
+                else:
+                    await self.buffer_changed.wait_for(lambda: len(self.buffer) < self.buffer_size)
+
+            self.buffer.append(line)
+            self.buffer_changed.notify_all()
+
+    def start(self):
+        # Send lines spilled by a previous run without waiting for the next message
+        if self.spill_file is not None and self.spill_file.has_data():
+            self.start_sender()
+
+    def start_sender(self):
+        self.sender_task = asyncio.ensure_future(self.send_loop())
+
+    async def send_loop(self):
+        reconnect_delay = self.reconnect_delay
 
         while True:
-            try:
-                self.ensure_connected()
-                self.socket.sendall(bytes(data, encoding="utf-8"))
-                break
-            except Exception as exception:
-                logging.error(exception)
-                self.socket.close()
-                self.socket = None
-                time.sleep(1)
+            self.sending_lines = await self.take_lines()
+
+            while True:
+                try:
+                    await self.send(self.sending_lines)
+                    reconnect_delay = self.reconnect_delay
+                    break
+                except (OSError, ConnectionError) as exception:
+                    logging.error(f"Unable to send {len(self.sending_lines)} messages to {self.host}:{self.port}, retrying in {reconnect_delay:.1f}s: {exception}")
+
+                    METRICS.count("output_retries_total", (("output", self.name),))
+
+                    self.disconnect()
+                    await asyncio.sleep(reconnect_delay)
+
+                    reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay)
+
+            async with self.buffer_changed:
+                self.sending_lines = []
+                self.buffer_changed.notify_all()
+
+    async def take_lines(self):
+        async with self.buffer_changed:
+            await self.buffer_changed.wait_for(lambda: self.buffer or (self.spill_file is not None and self.spill_file.has_data()))
+
+            if not self.buffer:
+                self.buffer.extend(self.spill_file.read(self.buffer_size))
+
+            # Coalesce as many lines as fit into a single write
+            lines = [self.buffer.popleft()]
+            size = len(lines[0])
+
+            while self.buffer and size + len(self.buffer[0]) <= self.max_write_size:
+                size += len(self.buffer[0])
+                lines.append(self.buffer.popleft())
+
+            self.buffer_changed.notify_all()
+
+            return lines
+
+    async def send(self, lines: list):
+        if self.stream_writer is None:
+            _, self.stream_writer = await asyncio.open_connection(self.host, self.port)
+
+        self.stream_writer.write(b"".join(lines))
+        await self.stream_writer.drain()
+
+    def disconnect(self):
+        if self.stream_writer is not None:
+            self.stream_writer.close()
+            self.stream_writer = None
+
+    def is_drained(self):
+        return not self.buffer and not self.sending_lines and (self.spill_file is None or not self.spill_file.has_data())
+
+    def reset_errors(self):
+        self.unreported_dropped_lines = 0
+
+    async def flush_pending(self):
+        # Lines are retried until they have been sent, so only dropped lines are failures
+        if self.sender_task is not None:
+            await self.wait_drained()
+
+        dropped_lines = self.unreported_dropped_lines
+        self.reset_errors()
+
+        if dropped_lines:
+            raise RuntimeError(f"Dropped {dropped_lines} messages for {self.host}:{self.port} as the buffer was full")
+
+    async def close(self):
+        if self.sender_task is None:
+            return
+
+        try:
+            await asyncio.wait_for(self.wait_drained(), self.close_timeout)
+        except asyncio.TimeoutError:
+            unsent_lines = self.sending_lines + list(self.buffer)
+
+            if self.spill_file is not None:
+                # Keep unsent lines for the next start
+                self.spill_file.prepend(unsent_lines)
+            else:
+                logging.error(f"Unable to send {len(unsent_lines)} remaining messages to {self.host}:{self.port} before shutdown")
+
+        self.sender_task.cancel()
+        self.disconnect()
+
+    async def wait_drained(self):
+        async with self.buffer_changed:
+            await self.buffer_changed.wait_for(self.is_drained)
@@ -1,27 +1,42 @@
 #! /usr/bin/env python3
 
 import argparse
+import ast
 import asyncio
 import base64
+import bisect
+import contextlib
+import contextvars
+import gzip
+import hashlib
+import heapq
 import importlib
+import inspect
+import json
 import logging
+import lzma
 import os
 import re
+import shutil
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 
 import yaml
 
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
 from telethon.tl import types
 from telethon.tl.functions.messages import TranslateTextRequest
 from telethon.tl.patched import Message
 from telethon.tl.types import User, Chat, Channel
 from telethon.tl.types.messages import TranslateResult
-from telethon.utils import get_display_name
+from telethon.utils import get_display_name, get_peer_id
 
 LOG_LEVEL_INFO = 35
 
@@ -153,370 +168,3009 @@ def json_default(value):
         return repr(value)
 
 
-async def async_exec(code, variables):
-    task = [None]
+class OutputMap:
+    # Attributes of a message which might change by editing it and attributes identifying a message
+    edited_attributes = {"text", "message", "raw_text", "entities", "edit_date"}
+    identifying_attributes = {"id", "chat_id", "date"}
 
-    exec_variables = {
-        "asyncio": asyncio,
-        "task": task
+    def __init__(self, input_map: dict):
+        self.expressions = []
+        self.identity = tuple((key, str(expression)) for key, expression in input_map.items())
+        self.keys = set(input_map)
+
+        # Names of the variables used by the expressions (e.g. to only request the chat entity if it is used)
+        self.variables = set()
+
+        for key, expression in input_map.items():
+            code = OutputMap.compile_expression(key, expression)
+
+            # Expressions without "await" are evaluated synchronously, only the others produce a coroutine
+            self.expressions.append((key, code, bool(code.co_flags & inspect.CO_COROUTINE)))
+            self.variables.update(OutputMap.get_names(ast.parse(str(expression), mode="eval")))
+
+        # Output maps for edit records by the parts of the message they contain
+        self.edit_maps = {}
+
+    @classmethod
+    def get_edit_kind(cls, expression: str) -> str | None:
+        # Tells which part of an edited message the expression depends on ("media", "text" or "identity" for fields identifying the message)
+        tree = ast.parse(expression, mode="eval")
+
+        names = cls.get_names(tree)
+        message_attributes = {node.attr for node in ast.walk(tree) if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "message"}
+
+        if "media" in names:
+            return "media"
+
+        if "translated_text" in names or message_attributes & cls.edited_attributes:
+            return "text"
+
+        if names == {"message"} and message_attributes and message_attributes <= cls.identifying_attributes:
+            return "identity"
+
+        return None
+
+    @staticmethod
+    def get_names(tree: ast.AST) -> set:
+        return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+    def get_edit_map(self, kinds: tuple):
+        edit_map = self.edit_maps.get(kinds)
+
+        if edit_map is None:
+            input_map = {key: expression for key, expression in self.identity if OutputMap.get_edit_kind(expression) in kinds}
+
+            # Message IDs are only unique within a chat, consumers need the chat to match the edit with the message
+            if "message.chat_id" not in input_map.values():
+                input_map.setdefault("chat_id", "message.chat_id")
+
+            if "text" in kinds:
+                input_map.setdefault("edit_date", "message.edit_date")
+
+            input_map.setdefault("edit", "True")
+
+            edit_map = self.edit_maps[kinds] = OutputMap(input_map)
+
+        return edit_map
+
+    @staticmethod
+    def compile_expression(key: str, expression):
+        try:
+            return compile(str(expression), f"<output_map:{key}>", "eval", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+        except SyntaxError as exception:
+            raise RuntimeError(f"Invalid output map expression for '{key}': {expression} ({exception.msg})") from exception
+
+    async def evaluate(self, variables: dict):
+        start_time = time.perf_counter()
+        output = DottedPathDict()
+
+        exec_variables = {
+            "asyncio": asyncio
+        }
+
+        exec_variables.update(variables)
+
+        for key, code, is_async in self.expressions:
+            value = eval(code, exec_variables)
+
+            if is_async:
+                value = await value
+
+            output.set(key, value)
+
+        METRICS.observe("eval_map_seconds", time.perf_counter() - start_time)
+
+        return output
+
+
+def read_json_file(path: str, default=None):
+    try:
+        with open(path, "r") as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return default
+    except ValueError as exception:
+        logging.error(f"Unable to parse JSON file '{path}', ignoring its content: {exception}")
+        return default
+
+
+def write_json_file(path: str, data):
+    # Write to a temporary file first to not leave a truncated file behind if the process is interrupted
+    with open(f"{path}.tmp", "w") as json_file:
+        json.dump(data, json_file, default=json_default)
+
+    os.replace(f"{path}.tmp", path)
+
+
+class Histogram:
+    # Upper bounds of the buckets in seconds
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets: tuple = None):
+        self.buckets = buckets or self.default_buckets
+
+        # The last count is for values larger than the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # Collected in memory using plain dicts to keep the overhead low, formatted only when requested
+    prefix = "telegram2elastic"
+
+    lag_buckets = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400, 604800)
+
+    descriptions = {
+        "messages_total": "Messages processed per chat type",
+        "output_messages_total": "Messages written per output",
+        "output_errors_total": "Errors while writing messages per output",
+        "output_retries_total": "Retried requests per output",
+        "output_write_seconds": "Time spent writing a message per output",
+        "entity_lookup_seconds": "Time spent looking up chats and senders",
+        "media_download_seconds": "Time spent downloading media",
+        "media_download_errors_total": "Failed media downloads",
+        "media_downloaded_bytes_total": "Bytes of downloaded media",
+        "translation_seconds": "Time spent translating a batch of messages",
+        "translation_errors_total": "Failed translation requests",
+        "eval_map_seconds": "Time spent evaluating an output map",
+        "lag_seconds": "Time between the message date and writing the message per output",
+        "queue_depth": "Items waiting in a queue",
+        "pipeline_errors_total": "Messages which could not be processed per pipeline stage",
+        "output_skipped_total": "Messages not written as the circuit breaker of the output is open",
+        "circuit_breaker_open": "Whether the circuit breaker of the output is open",
+        "spool_size_bytes": "Size of spooled messages which have not been written yet per output",
+        "spool_acknowledged_total": "Spooled messages written per output",
+        "spool_dead_letter_total": "Spooled messages rejected by the output and written to the dead letter file",
+        "spool_dropped_total": "Messages dropped as the spool of the output is full",
+        "telegram_api_wait_seconds": "Time Telegram API requests waited for the rate limiter per priority",
+        "telegram_flood_waits_total": "FloodWait errors received from Telegram",
+        "telegram_api_rate": "Current rate of the Telegram API rate limiter in requests per second"
+    }
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+        # Values which are already tracked somewhere else (e.g. queue sizes) are collected using callbacks when formatting
+        self.callbacks = {}
+
+    def count(self, name: str, labels: tuple = (), amount: int = 1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, labels: tuple = (), buckets: tuple = None):
+        histogram = self.histograms.get((name, labels))
+
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(buckets)
+
+        histogram.observe(value)
+
+    def register(self, name: str, metric_type: str, callback: callable):
+        # The callback returns a dict of labels (tuple of name/value pairs) to the current value
+        self.callbacks[name] = (metric_type, callback)
+
+    @staticmethod
+    def format_labels(labels: tuple, extra_labels: tuple = ()):
+        labels = labels + extra_labels
+        if not labels:
+            return ""
+
+        return "{" + ",".join(f'{name}="{str(value)}"' for name, value in labels) + "}"
+
+    def format(self):
+        metrics = {}
+
+        for (name, labels), value in self.counters.items():
+            metrics.setdefault((name, "counter"), []).append(f"{self.prefix}_{name}{self.format_labels(labels)} {value}")
+
+        for name, (metric_type, callback) in self.callbacks.items():
+            for labels, value in callback().items():
+                metrics.setdefault((name, metric_type), []).append(f"{self.prefix}_{name}{self.format_labels(labels)} {value}")
+
+        for (name, labels), histogram in self.histograms.items():
+            lines = metrics.setdefault((name, "histogram"), [])
+            cumulative_count = 0
+
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative_count += count
+                lines.append(f"{self.prefix}_{name}_bucket{self.format_labels(labels, (('le', bucket),))} {cumulative_count}")
+
+            lines.append(f"{self.prefix}_{name}_bucket{self.format_labels(labels, (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{self.prefix}_{name}_sum{self.format_labels(labels)} {histogram.sum}")
+            lines.append(f"{self.prefix}_{name}_count{self.format_labels(labels)} {histogram.count}")
+
+        output = []
+
+        for (name, metric_type), lines in sorted(metrics.items()):
+            if name in self.descriptions:
+                output.append(f"# HELP {self.prefix}_{name} {self.descriptions[name]}")
+
+            output.append(f"# TYPE {self.prefix}_{name} {metric_type}")
+            output.extend(lines)
+
+        return "\n".join(output) + "\n"
+
+
+METRICS = Metrics()
+
+
+class MetricsServer:
+    def __init__(self, config: dict):
+        self.host = config.get("host", "127.0.0.1")
+        self.port = int(config.get("port", 9090))
+
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_request, self.host, self.port)
+
+        logging.log(LOG_LEVEL_INFO, f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+
+            # Skip the request headers
+            while (await reader.readline()).strip():
+                pass
+
+            request_parts = request_line.decode("latin-1").split()
+
+            if len(request_parts) >= 2 and request_parts[0] == "GET" and request_parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = METRICS.format().encode("utf-8")
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (OSError, ConnectionError) as exception:
+            logging.debug(f"Unable to answer metrics request: {exception}")
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+@dataclass
+class DownloadedMedia:
+    filepath: Path
+    filename: str
+
+    # "pending" while downloading in the background, "downloaded" or "failed" afterwards
+    status: str = "downloaded"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def consume(self, amount: float):
+        self.refill()
+
+        # Going into debt allows amounts larger than the capacity, concurrent consumers queue up behind each other
+        self.tokens -= amount
+
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class MediaConfigurationRule:
+    # Media types a message might have (see get_media_type())
+    media_types = ["photo", "file"]
+
+    def __init__(self, global_config: dict, config_data: dict, rule_index: int):
+        self.global_config = global_config
+        self.config_data = config_data
+        self.index = rule_index
+
+        self.logger = logging.getLogger(f"media_download_config_rule[#{rule_index}]")
+
+        # Everything is resolved once here as the rules are checked for each message containing media
+        self.media_type_matcher = self.compile_matcher("media_type")
+        self.mime_type_matcher = self.compile_matcher("mime_type")
+        self.chat_type_matcher = self.compile_matcher("chat_type")
+
+        # The media types are known in advance, so the rule can be indexed by the ones it matches
+        self.matching_media_types = [media_type for media_type in self.media_types if self.matches_media_type(media_type)]
+
+        chat_ids = self.config_data.get("chats")
+        self.chat_ids = set(chat_ids) if chat_ids else None
+
+        max_size = self.get_max_size()
+        self.max_size_bytes = FileSize.human_readable_to_bytes(str(max_size)) if max_size != "" else None
+
+        self.download_path = self.get_with_fallback("download_path")
+        self.filepattern = self.get_with_fallback("file_pattern", "{date[year]}-{date[month]}-{date[day]}_{date[hour]}-{date[minute]}-{date[second]}_{message[id]}_{file[name]}.{file[ext]}")
+
+    @staticmethod
+    def get_media_type(message):
+        if isinstance(message.media, types.MessageMediaPhoto):
+            return "photo"
+        else:
+            return "file"
+
+    def matches_indexed_message(self, message, chat_type: str | None):
+        # Checks everything except the media type and the chat ID which are already covered by the index of MediaConfiguration
+        if not self.matches_mime_type(message.file.mime_type):
+            return False
+
+        if chat_type is None or not self.matches_chat_type(chat_type):
+            return False
+
+        message_chat_id = message.chat_id
+        if message_chat_id is None or not self.matches_chat_id(message_chat_id):
+            return False
+
+        if not self.check_size_limit(message.file.size):
+            return False
+
+        return True
+
+    def matches_media_type(self, media_type: str):
+        return self.matches_config_value(self.media_type_matcher, media_type)
+
+    def matches_mime_type(self, mime_type: str):
+        return self.matches_config_value(self.mime_type_matcher, mime_type)
+
+    def matches_chat_type(self, chat_type: str):
+        return self.matches_config_value(self.chat_type_matcher, chat_type)
+
+    def matches_chat_id(self, chat_id: int):
+        return self.chat_ids is None or chat_id in self.chat_ids
+
+    def check_size_limit(self, file_size_bytes: int):
+        return self.max_size_bytes is None or file_size_bytes <= self.max_size_bytes
+
+    def get_download_path(self) -> str | None:
+        return self.download_path
+
+    def get_filepattern(self) -> str:
+        return self.filepattern
+
+    def get_max_size(self) -> str:
+        return self.get_with_fallback("max_size", "")
+
+    def compile_matcher(self, config_name: str):
+        match_exact_value = self.config_data.get(config_name)
+        match_regex_value = self.config_data.get(f"{config_name}_re")
+
+        if match_exact_value is None and match_regex_value is None:
+            return None
+
+        return match_exact_value, re.compile(match_regex_value) if match_regex_value is not None else None
+
+    @staticmethod
+    def matches_config_value(matcher: tuple | None, value):
+        if matcher is None:
+            return True
+
+        match_exact_value, match_regex = matcher
+
+        if match_exact_value is not None and match_exact_value == value:
+            return True
+
+        if match_regex is not None and match_regex.match(value):
+            return True
+
+        return False
+
+    def get_with_fallback(self, option_name: str, default_value=None):
+        value = self.config_data.get(option_name)
+        if value is not None:
+            self.logger.debug(f"Config for '{option_name}' resolved: {value}")
+            return value
+
+        # Fallback to global config
+        value = self.global_config.get(option_name)
+        if value is not None:
+            self.logger.debug(f"Config for '{option_name}' resolved to global config: {value}")
+            return value
+
+        self.logger.debug(f"Config for '{option_name}' resolved to default: {default_value}")
+
+        return default_value
+
+
+class MediaConfiguration:
+    def __init__(self, config: dict):
+        self.config = config
+
+        self.rules = []
+
+        for index, rule in enumerate(config.get("rules", [])):
+            self.rules.append(MediaConfigurationRule(self.config, rule, index))
+
+        # Add default match-all rule if there are no rules configured
+        if not self.rules:
+            self.rules.append(MediaConfigurationRule(self.config, {}, 0))
+
+        # Rules by media type and chat ID (None for rules not restricted to specific chats), each list is ordered by the rule index
+        self.rule_index = {}
+
+        for rule in self.rules:
+            for media_type in rule.matching_media_types:
+                for chat_id in rule.chat_ids or [None]:
+                    self.rule_index.setdefault((media_type, chat_id), []).append(rule)
+
+    def get_candidate_rules(self, media_type: str, chat_id: int):
+        chat_rules = self.rule_index.get((media_type, chat_id))
+        other_rules = self.rule_index.get((media_type, None))
+
+        if chat_rules is None:
+            return other_rules or []
+
+        if other_rules is None:
+            return chat_rules
+
+        # Keep the configured order of rules so that the first matching rule wins
+        return heapq.merge(chat_rules, other_rules, key=lambda rule: rule.index)
+
+    def get_rule(self, message, chat_type: str | None):
+        # No rule matches messages without chat type or chat ID
+        if chat_type is None or message.chat_id is None:
+            return None
+
+        for rule in self.get_candidate_rules(MediaConfigurationRule.get_media_type(message), message.chat_id):
+            if rule.matches_indexed_message(message, chat_type):
+                rule.logger.debug("Rule matches")
+                return rule
+
+        return None
+
+
+class MessageContext:
+    def __init__(self, message, chat, sender: dict, translated_text: str | None = None, downloaded_media: DownloadedMedia | None = None, chat_name: str = None, chat_type: str = None, is_edit: bool = False):
+        self.message = message
+        self.chat = chat
+        self.chat_name = chat_name if chat_name is not None else (get_display_name(chat) if chat is not None else "")
+        self.chat_type = chat_type
+        self.sender = sender
+        self.translated_text = translated_text
+        self.downloaded_media = downloaded_media
+
+        # Translations are requested in batches, the result is awaited before evaluating the output map
+        self.translation: asyncio.Future | None = None
+
+        # Edits are written as edit records only containing the fields which might have changed
+        self.is_edit = is_edit
+        self.media_changed = True
+
+        # Set for the record written after a background download, it only updates the media fields of the message
+        self.media_only = False
+
+        # Priority of Telegram API requests made for this message (e.g. while translating it), see ApiRateLimiter
+        self.priority = API_PRIORITY.get()
+
+        # Resolved with whether all outputs handled the message, only set for messages submitted using Pipeline.submit()
+        self.written: asyncio.Future | None = None
+        self.delivered = True
+        self.pending_outputs = 0
+
+        # Results are cached per output map so outputs sharing the same map evaluate and serialize it only once
+        self.message_dicts = {}
+        self.serialized_messages = {}
+
+    @staticmethod
+    def get_sender_dict(sender_user):
+        if sender_user is None:
+            return {
+                "username": "",
+                "firstName": "Deleted User",
+                "lastName": ""
+            }
+        elif isinstance(sender_user, Channel):
+            return {
+                "username": getattr(sender_user, "username", ""),
+                "firstName": getattr(sender_user, "title", ""),
+                "lastName": None
+            }
+        else:
+            return {
+                "username": getattr(sender_user, "username", ""),
+                "firstName": getattr(sender_user, "first_name", ""),
+                "lastName": getattr(sender_user, "last_name", "")
+            }
+
+    def with_media(self, downloaded_media: DownloadedMedia):
+        # Writing the whole message again would revert edits written in the meantime, so only the media fields are updated
+        context = MessageContext(message=self.message, chat=self.chat, sender=self.sender, downloaded_media=downloaded_media, chat_name=self.chat_name, chat_type=self.chat_type, is_edit=True)
+        context.media_only = True
+
+        return context
+
+    def output_done(self, delivered: bool):
+        self.delivered = self.delivered and delivered
+        self.pending_outputs -= 1
+
+        if self.pending_outputs <= 0:
+            self.set_written(self.delivered)
+
+    def set_written(self, delivered: bool):
+        if self.written is not None and not self.written.done():
+            self.written.set_result(delivered)
+
+    def get_edit_kinds(self) -> tuple:
+        if self.media_only:
+            return "identity", "media"
+
+        return ("identity", "text", "media") if self.media_changed else ("identity", "text")
+
+    def get_variables(self):
+        return {
+            "message": self.message,
+            "chat": self.chat,
+            "chat_name": self.chat_name,
+            "chat_type": self.chat_type,
+            "sender": self.sender,
+            "get_display_name": get_display_name,
+            "translated_text": self.translated_text,
+            "media": self.downloaded_media
+        }
+
+    async def get_message_dict(self, output_map: OutputMap) -> DottedPathDict:
+        if self.is_edit:
+            output_map = output_map.get_edit_map(self.get_edit_kinds())
+
+        if self.translation is not None:
+            self.translated_text = await self.translation
+
+        if output_map not in self.message_dicts:
+            # Store the task instead of the result so that outputs evaluating concurrently still share a single evaluation
+            self.message_dicts[output_map] = asyncio.ensure_future(output_map.evaluate(self.get_variables()))
+
+        return await self.message_dicts[output_map]
+
+    async def get_message_json(self, output_map: OutputMap) -> bytes:
+        message_dict = await self.get_message_dict(output_map)
+
+        if self.is_edit:
+            output_map = output_map.get_edit_map(self.get_edit_kinds())
+
+        if output_map not in self.serialized_messages:
+            self.serialized_messages[output_map] = json.dumps(message_dict, default=json_default).encode("utf-8")
+
+        return self.serialized_messages[output_map]
+
+
+class RejectedMessageError(Exception):
+    # Raised by outputs for messages which are rejected permanently (e.g. mapping errors), retrying them is pointless
+    def __init__(self, message: str, message_keys: list = None):
+        super().__init__(message)
+
+        # (chat_id, id) of the rejected messages as message IDs are only unique within a chat
+        self.message_keys = message_keys or []
+
+
+class OutputWriter(ABC):
+    default_output_map = {
+        "id": "message.id",
+        "date": "message.date",
+        "sender": "sender",
+        "chat": "chat_name",
+        "message": "message.text",
+        "media": "media.filename if media else None"
+    }
+
+    def __init__(self, config: dict):
+        self.config: dict = config
+
+        # Set by the OutputHandler based on the position of the output in the config, used for logs and metrics
+        self.name = config.get("name", "output")
+
+        # Set by the OutputHandler if the output is spooled or while importing, failures of buffered messages then have to be reported by flush_pending()
+        self.spool = None
+        self.report_errors = False
+
+        # Set by the OutputHandler, writes messages using timeouts, retries and a circuit breaker
+        self.delivery = None
+
+        output_map_config = self.config.get("output_map")
+
+        if output_map_config is None:
+            output_map_config = self.default_output_map
+
+        self.output_map = OutputMap(output_map_config)
+
+    @abstractmethod
+    async def write_message(self, context: MessageContext):
+        pass
+
+    def start(self):
+        # Called once the event loop is running (e.g. to resume sending messages kept by a previous run)
+        pass
+
+    async def flush_pending(self):
+        # Called by the spool after writing a batch of messages, returns once all of them have been written or raises
+        pass
+
+    async def start_import(self):
+        # Called before importing lots of messages (e.g. import-history), the import is done once close() is called
+        pass
+
+    def reset_errors(self):
+        # Called once failures have to be reported, forgets failures not reported by flush_pending() so far
+        pass
+
+    async def close(self):
+        # Called on shutdown to flush anything the output still buffers
+        pass
+
+    async def get_message_dict(self, context: MessageContext) -> DottedPathDict:
+        # The returned dict is shared with other outputs using the same output map and must not be modified
+        return await context.get_message_dict(self.output_map)
+
+    async def get_message_json(self, context: MessageContext) -> bytes:
+        return await context.get_message_json(self.output_map)
+
+
+class OutputBatcher:
+    # Collects items of an output and sends them using send(items) once a limit is reached or no further items arrived for max_linger seconds
+    def __init__(self, send: callable, max_items: int, max_linger: float, max_size: int = None):
+        self.send = send
+        self.max_items = max_items
+        self.max_linger = max_linger
+        self.max_size = max_size
+
+        self.items = []
+        self.size = 0
+        self.linger_task = None
+
+        # Batches are sent one after another to keep the order of items (e.g. a message and its edits)
+        self.send_lock = asyncio.Lock()
+        self.send_tasks = set()
+
+    async def add(self, item, size: int = 0):
+        self.items.append(item)
+        self.size += size
+
+        if len(self.items) >= self.max_items or (self.max_size is not None and self.size >= self.max_size):
+            await self.flush()
+        elif self.linger_task is None:
+            self.linger_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.max_linger)
+
+        self.linger_task = None
+        await self.flush()
+
+    async def flush(self):
+        if self.linger_task is not None:
+            self.linger_task.cancel()
+            self.linger_task = None
+
+        if self.items:
+            items = self.items
+            self.items = []
+            self.size = 0
+
+            # The batch has already been taken from the buffer, cancelling the caller (e.g. due to the timeout of the delivery) must not cancel sending it
+            send_task = asyncio.ensure_future(self.send_locked(items))
+            send_task.add_done_callback(self.send_tasks.discard)
+            self.send_tasks.add(send_task)
+
+        # Also waits for batches of previously cancelled calls
+        if self.send_tasks:
+            await asyncio.shield(asyncio.gather(*self.send_tasks))
+
+    async def send_locked(self, items: list):
+        async with self.send_lock:
+            await self.send(items)
+
+
+@dataclass
+class StoredMessage:
+    id: int
+    chat_id: int
+    date: datetime
+
+
+class StoredContext(MessageContext):
+    # Context of a message read back from a spool or a replayed file, the message dict has already been evaluated when writing it
+    def __init__(self, record: dict):
+        message = StoredMessage(id=record["id"], chat_id=record["chat_id"], date=datetime.fromisoformat(record["date"]))
+
+        super().__init__(message=message, chat=None, sender={})
+
+        self.message_dict = DottedPathDict(record["data"])
+        self.is_edit = bool(self.message_dict.get("edit"))
+
+    async def get_message_dict(self, output_map: OutputMap) -> DottedPathDict:
+        return self.message_dict
+
+    async def get_message_json(self, output_map: OutputMap) -> bytes:
+        return json.dumps(self.message_dict, default=json_default).encode("utf-8")
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self):
+        # Once the reset timeout passed, messages are tried again (half-open) and a single failure opens the circuit again
+        return not self.is_open()
+
+    def record_success(self):
+        was_open = self.opened_at is not None
+
+        self.failures = 0
+        self.opened_at = None
+
+        return was_open
+
+    def record_failure(self):
+        # Returns whether the circuit has been opened by this failure
+        self.failures += 1
+
+        if self.failure_threshold and (self.failures >= self.failure_threshold or self.opened_at is not None):
+            self.opened_at = time.monotonic()
+            return True
+
+        return False
+
+
+class OutputDelivery:
+    # Writes messages to a single output with a timeout, retries and a circuit breaker so that a failing output does not affect the others
+    def __init__(self, output, name: str, config: dict):
+        self.output = output
+        self.name = name
+        self.labels = (("output", name),)
+
+        self.timeout = float(config.get("timeout", 60)) or None
+        self.max_retries = int(config.get("max_retries", 3))
+        self.retry_delay = float(config.get("retry_delay", 1))
+        self.max_retry_delay = float(config.get("max_retry_delay", 30))
+
+        self.circuit_breaker = CircuitBreaker(int(config.get("failure_threshold", 5)), float(config.get("reset_timeout", 30)))
+        self.skipped_messages = 0
+
+        self.logger = logging.getLogger("output_delivery")
+
+    def log_outcome(self, level: int, outcome: str, context, attempt: int = None, duration: float = None, error: Exception = None):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        message = getattr(context, "message", None)
+
+        fields = {
+            "output": self.name,
+            "outcome": outcome,
+            "message_id": getattr(message, "id", None),
+            "chat_id": getattr(message, "chat_id", None),
+            "attempt": attempt,
+            "duration": round(duration, 4) if duration is not None else None,
+            "error": repr(str(error)) if error is not None else None
+        }
+
+        fields = {key: value for key, value in fields.items() if value is not None}
+
+        # Logged as key=value pairs and passed as extra fields for log handlers processing the records
+        self.logger.log(level, " ".join(f"{key}={value}" for key, value in fields.items()), extra={"delivery": fields})
+
+    async def write(self, context) -> bool:
+        # Returns whether the message has been handled by the output (rejected messages count as handled as retrying them is pointless)
+        if not self.circuit_breaker.allow():
+            self.skipped_messages += 1
+            METRICS.count("output_skipped_total", self.labels)
+            self.log_outcome(logging.DEBUG, "skipped", context)
+            return False
+
+        for attempt in range(1, self.max_retries + 2):
+            if attempt > 1:
+                await asyncio.sleep(min(self.retry_delay * pow(2, attempt - 2), self.max_retry_delay))
+
+            start_time = time.perf_counter()
+
+            try:
+                await asyncio.wait_for(self.output.write_message(context), self.timeout)
+            except RejectedMessageError as exception:
+                # Retrying does not help, and the output itself is working fine
+                METRICS.count("output_errors_total", self.labels)
+                self.log_outcome(logging.ERROR, "rejected", context, attempt, time.perf_counter() - start_time, exception)
+                return True
+            except Exception as exception:
+                outcome = "timeout" if isinstance(exception, asyncio.TimeoutError) else "error"
+
+                METRICS.count("output_errors_total", self.labels)
+                self.log_outcome(logging.WARNING, outcome, context, attempt, time.perf_counter() - start_time, exception)
+
+                if self.circuit_breaker.record_failure():
+                    logging.error(f"Circuit breaker for {self.name} opened after {self.circuit_breaker.failures} failures, skipping messages for {self.circuit_breaker.reset_timeout:.0f}s")
+                    break
+
+                if attempt <= self.max_retries:
+                    METRICS.count("output_retries_total", self.labels)
+
+                continue
+
+            duration = time.perf_counter() - start_time
+
+            if self.circuit_breaker.record_success():
+                logging.log(LOG_LEVEL_INFO, f"Circuit breaker for {self.name} closed, skipped {self.skipped_messages} messages while it was open")
+                self.skipped_messages = 0
+
+            METRICS.observe("output_write_seconds", duration, self.labels)
+            METRICS.count("output_messages_total", self.labels)
+
+            if isinstance(context, MessageContext):
+                METRICS.observe("lag_seconds", time.time() - context.message.date.timestamp(), self.labels, Metrics.lag_buckets)
+
+            self.log_outcome(logging.DEBUG, "written", context, attempt, duration)
+            return True
+
+        self.log_outcome(logging.ERROR, "failed", context, attempt)
+
+        return False
+
+
+class OutputSpool:
+    # Append-only segment files holding the messages of an output until they have been written (acknowledged)
+    def __init__(self, output: OutputWriter, config: dict):
+        self.output = output
+        self.output.report_errors = True
+        self.labels = (("output", output.name),)
+
+        if config.get("path") is None:
+            raise RuntimeError(f"The spool of {output.name} requires 'path'")
+
+        self.path = Path(os.path.expanduser(config.get("path")))
+        self.segment_size = FileSize.human_readable_to_bytes(str(config.get("segment_size", "16M")))
+        self.max_size = FileSize.human_readable_to_bytes(str(config.get("max_size", "1G")))
+        self.batch_size = int(config.get("batch_size", 100))
+        self.retry_delay = float(config.get("retry_delay", 1))
+        self.max_retry_delay = float(config.get("max_retry_delay", 60))
+        self.close_timeout = float(config.get("close_timeout", 10))
+
+        dead_letter_file = config.get("dead_letter_file")
+        self.dead_letter_file = Path(os.path.expanduser(dead_letter_file)) if dead_letter_file else self.path.joinpath("dead-letter.jsonl")
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # Position of the first record which has not been acknowledged yet
+        self.ack_file = self.path.joinpath("ack.json")
+        ack = read_json_file(str(self.ack_file), {"segment": 0, "offset": 0})
+        self.ack_segment = ack["segment"]
+        self.ack_offset = ack["offset"]
+
+        self.segments = []
+
+        for segment_path in sorted(self.path.glob("*.spool")):
+            if int(segment_path.stem) < self.ack_segment:
+                segment_path.unlink()
+            else:
+                self.segments.append(int(segment_path.stem))
+
+        # Size of all records which have not been acknowledged yet
+        self.size = sum(self.get_segment_path(segment).stat().st_size for segment in self.segments) - (self.ack_offset if self.ack_segment in self.segments else 0)
+
+        # Always start a new segment to not append to a segment which might end with a partially written record
+        self.write_segment = (self.segments[-1] + 1) if self.segments else self.ack_segment
+        self.write_file = None
+        self.write_size = 0
+
+        self.data_available = asyncio.Event()
+        self.drain_task = None
+        self.dropped_records = 0
+
+    def get_segment_path(self, segment: int) -> Path:
+        return self.path.joinpath(f"{segment:012d}.spool")
+
+    def start(self):
+        if self.drain_task is None:
+            if self.size:
+                logging.log(LOG_LEVEL_INFO, f"Replaying {FileSize.bytes_to_human_readable(self.size)} of spooled messages for {self.output.name}")
+                self.data_available.set()
+
+            self.drain_task = asyncio.ensure_future(self.drain())
+
+    async def append(self, context: MessageContext) -> bool:
+        # Returns whether the message has been spooled, it is then written to the output eventually
+        record = {
+            "id": context.message.id,
+            "chat_id": context.message.chat_id,
+            "date": context.message.date.isoformat(),
+            "data": await self.output.get_message_dict(context)
+        }
+
+        line = json.dumps(record, default=json_default).encode("utf-8") + b"\n"
+
+        if self.size + len(line) > self.max_size:
+            self.dropped_records += 1
+            METRICS.count("spool_dropped_total", self.labels)
+
+            if self.dropped_records == 1 or self.dropped_records % 1000 == 0:
+                logging.error(f"Spool of {self.output.name} is full, dropped {self.dropped_records} messages so far")
+
+            return False
+
+        if self.write_file is None or self.write_size + len(line) > self.segment_size and self.write_size:
+            self.open_segment()
+
+        # Unbuffered to write each record using a single system call which makes it visible for reading immediately
+        self.write_file.write(line)
+        self.write_size += len(line)
+        self.size += len(line)
+
+        self.data_available.set()
+        self.start()
+
+        return True
+
+    def open_segment(self):
+        if self.write_file is not None:
+            self.write_file.close()
+            self.write_segment += 1
+
+        self.write_file = open(self.get_segment_path(self.write_segment), "ab", buffering=0)
+        self.write_size = 0
+
+        self.segments.append(self.write_segment)
+
+    def read_records(self):
+        records = []
+
+        segment = self.ack_segment
+        offset = self.ack_offset
+
+        for segment in [segment for segment in self.segments if segment >= self.ack_segment]:
+            if segment != self.ack_segment:
+                offset = 0
+
+            with open(self.get_segment_path(segment), "rb") as segment_file:
+                segment_file.seek(offset)
+
+                while len(records) < self.batch_size:
+                    line = segment_file.readline()
+
+                    # Partially written record of a previous run (or the end of the segment)
+                    if not line.endswith(b"\n"):
+                        break
+
+                    offset += len(line)
+                    records.append((json.loads(line), segment, offset, len(line)))
+
+            if len(records) >= self.batch_size or segment == self.write_segment:
+                break
+
+        return records
+
+    async def drain(self):
+        retry_delay = self.retry_delay
+
+        while True:
+            records = self.read_records()
+
+            if not records:
+                self.data_available.clear()
+                self.skip_to_write_segment()
+
+                await self.data_available.wait()
+                continue
+
+            try:
+                await self.write_records([record for record, *_ in records])
+                retry_delay = self.retry_delay
+            except Exception as exception:
+                logging.error(f"Unable to write {len(records)} spooled messages to {self.output.name}, retrying in {retry_delay:.1f}s: {exception}")
+                METRICS.count("output_retries_total", self.labels)
+
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, self.max_retry_delay)
+                continue
+
+            _, segment, offset, _ = records[-1]
+
+            self.acknowledge(segment, offset)
+            self.size -= sum(size for *_, size in records)
+
+            METRICS.count("spool_acknowledged_total", self.labels, len(records))
+
+    async def write_records(self, records: list):
+        for record in records:
+            try:
+                await self.output.write_message(StoredContext(record))
+            except RejectedMessageError as exception:
+                self.dead_letter([record], exception)
+
+        try:
+            await self.output.flush_pending()
+        except RejectedMessageError as exception:
+            rejected_keys = set(exception.message_keys)
+            self.dead_letter([record for record in records if (record["chat_id"], record["id"]) in rejected_keys], exception)
+
+    def dead_letter(self, records: list, exception: Exception):
+        logging.error(f"{self.output.name} rejected {len(records)} messages, writing them to {self.dead_letter_file}: {exception}")
+        METRICS.count("spool_dead_letter_total", self.labels, len(records))
+
+        with open(self.dead_letter_file, "a") as dead_letter_file:
+            for record in records:
+                dead_letter_file.write(json.dumps({"output": self.output.name, "error": str(exception), "record": record}, default=json_default) + "\n")
+
+    def acknowledge(self, segment: int, offset: int):
+        self.ack_segment = segment
+        self.ack_offset = offset
+
+        # Segments before the acknowledged one are not required anymore
+        while self.segments and self.segments[0] < segment:
+            self.get_segment_path(self.segments.pop(0)).unlink(missing_ok=True)
+
+        write_json_file(str(self.ack_file), {"segment": self.ack_segment, "offset": self.ack_offset})
+
+    def skip_to_write_segment(self):
+        # Everything has been read, older segments (e.g. ending with a partially written record) can be removed
+        if self.ack_segment != self.write_segment:
+            self.acknowledge(self.write_segment, 0)
+            self.size = self.write_size
+
+    def is_drained(self):
+        return self.size == 0
+
+    async def close(self):
+        if self.drain_task is not None:
+            try:
+                await asyncio.wait_for(self.wait_drained(), self.close_timeout)
+            except asyncio.TimeoutError:
+                logging.log(LOG_LEVEL_INFO, f"Keeping {FileSize.bytes_to_human_readable(self.size)} of spooled messages for {self.output.name} until the next start")
+
+            self.drain_task.cancel()
+
+        if self.write_file is not None:
+            self.write_file.close()
+            self.write_file = None
+
+    async def wait_drained(self):
+        while not self.is_drained():
+            await asyncio.sleep(0.1)
+
+
+class ChatType(Enum):
+    GROUP = "group"
+    CHANNEL = "channel"
+    BOT = "bot"
+    CONTACT = "contact"
+    USER = "user"
+
+    @classmethod
+    def get_from_chat(cls, chat):
+        if isinstance(chat, Chat):
+            if chat.deactivated:
+                return None
+            else:
+                return cls.GROUP
+
+        if isinstance(chat, Channel):
+            if chat.megagroup:
+                return cls.GROUP
+            else:
+                return cls.CHANNEL
+
+        if isinstance(chat, User):
+            if chat.bot:
+                return cls.BOT
+
+            if chat.contact:
+                return cls.CONTACT
+            else:
+                return cls.USER
+
+        return None
+
+
+@dataclass
+class EntityInfo:
+    # Derived data of a chat or sender entity which is all that is needed for each message
+    id: int
+    display_name: str
+    chat_type: ChatType | None
+    sender: dict
+    fetched_at: float
+
+    @classmethod
+    def from_entity(cls, entity):
+        return cls(id=getattr(entity, "id", None), display_name=get_display_name(entity) if entity is not None else "", chat_type=ChatType.get_from_chat(entity), sender=MessageContext.get_sender_dict(entity), fetched_at=time.time())
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "display_name": self.display_name,
+            "chat_type": self.chat_type.value if self.chat_type else None,
+            "sender": self.sender,
+            "fetched_at": self.fetched_at
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(id=data["id"], display_name=data["display_name"], chat_type=ChatType(data["chat_type"]) if data["chat_type"] else None, sender=data["sender"], fetched_at=data["fetched_at"])
+
+
+class EntityCache:
+    def __init__(self, config: dict):
+        ttl = TimeInterval.parse(str(config.get("ttl", "1d")))
+        self.ttl = ttl.seconds if ttl else 0
+
+        self.cache_file = os.path.expanduser(config.get("file")) if config.get("file") else None
+        self.unsaved_entries = 0
+
+        # Entities by their peer ID (e.g. message.chat_id or message.sender_id), the least recently used ones are removed first
+        self.size = int(config.get("size", 10000))
+        self.entities = OrderedDict()
+
+        # Chat entities (only kept in memory) for output maps using the chat variable
+        self.chat_entities = OrderedDict()
+
+        if self.cache_file:
+            for peer_id, data in read_json_file(self.cache_file, {}).items():
+                self.entities[int(peer_id)] = EntityInfo.from_dict(data)
+
+            self.limit_size(self.entities)
+
+    def limit_size(self, entities: OrderedDict):
+        while len(entities) > self.size:
+            entities.popitem(last=False)
+
+    def get_fresh(self, peer_id: int) -> EntityInfo | None:
+        entity_info = self.entities.get(peer_id)
+
+        if entity_info is None or (self.ttl and time.time() - entity_info.fetched_at > self.ttl):
+            return None
+
+        self.entities.move_to_end(peer_id)
+
+        return entity_info
+
+    def add(self, entity, peer_id: int = None) -> EntityInfo:
+        if peer_id is None:
+            peer_id = get_peer_id(entity)
+
+        entity_info = EntityInfo.from_entity(entity)
+        self.entities[peer_id] = entity_info
+        self.entities.move_to_end(peer_id)
+        self.limit_size(self.entities)
+
+        self.unsaved_entries += 1
+        if self.unsaved_entries >= 100:
+            self.save()
+
+        return entity_info
+
+    def add_chat_entity(self, peer_id: int, entity):
+        self.chat_entities[peer_id] = entity
+        self.chat_entities.move_to_end(peer_id)
+        self.limit_size(self.chat_entities)
+
+    async def get_chat(self, message) -> EntityInfo:
+        entity_info = self.get_fresh(message.chat_id)
+
+        if entity_info is None:
+            chat = await message.get_chat()
+
+            self.add_chat_entity(message.chat_id, chat)
+            entity_info = self.add(chat, message.chat_id)
+
+        return entity_info
+
+    async def get_chat_entity(self, message):
+        # message.chat is only available if Telethon already knows the entity, get_chat() requests it otherwise
+        chat = message.chat or self.chat_entities.get(message.chat_id)
+
+        if chat is None:
+            chat = await message.get_chat()
+
+            self.add_chat_entity(message.chat_id, chat)
+            self.add(chat, message.chat_id)
+
+        return chat
+
+    async def get_sender(self, message) -> EntityInfo:
+        if message.sender_id is None:
+            return EntityInfo.from_entity(None)
+
+        entity_info = self.get_fresh(message.sender_id)
+
+        if entity_info is None:
+            entity_info = self.add(await message.get_sender(), message.sender_id)
+
+        return entity_info
+
+    def save(self):
+        if self.cache_file is not None and self.unsaved_entries:
+            write_json_file(self.cache_file, {peer_id: entity_info.to_dict() for peer_id, entity_info in self.entities.items()})
+
+        self.unsaved_entries = 0
+
+
+class ExecutorLane:
+    def __init__(self):
+        # Pending items per key and the keys having pending items in the order they are processed (round-robin)
+        self.items = {}
+        self.keys = deque()
+        self.has_items = asyncio.Event()
+
+    def add(self, key, item):
+        items = self.items.get(key)
+
+        if items is None:
+            self.items[key] = deque([item])
+            self.keys.append(key)
+        else:
+            items.append(item)
+
+        self.has_items.set()
+
+    def take(self):
+        key = self.keys.popleft()
+        items = self.items[key]
+        item = items.popleft()
+
+        # Other keys of the lane are processed first, so a key having many items does not delay the others
+        if items:
+            self.keys.append(key)
+        else:
+            del self.items[key]
+
+        if not self.keys:
+            self.has_items.clear()
+
+        return item
+
+
+class KeyedExecutor:
+    # Processes items in parallel lanes, items of the same key are processed by the same lane one after another in the order they were added
+    def __init__(self, process: callable, lanes: int, queue_size: int, key: callable):
+        self.process = process
+        self.key = key
+        self.lanes = [ExecutorLane() for _ in range(max(1, lanes))]
+        self.queue_size = queue_size
+
+        # Items waiting in any lane and items added but not processed yet
+        self.size = 0
+        self.unfinished = 0
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+        # Callers of put() waiting for free space
+        self.putters = deque()
+
+    def qsize(self):
+        return self.size
+
+    def get_lane(self, key) -> ExecutorLane:
+        return self.lanes[hash(key) % len(self.lanes)]
+
+    async def put(self, item):
+        # Waits while the queue is full which slows down the caller (backpressure)
+        while self.size >= self.queue_size:
+            putter = asyncio.get_running_loop().create_future()
+            self.putters.append(putter)
+
+            try:
+                await putter
+            except asyncio.CancelledError:
+                if putter in self.putters:
+                    self.putters.remove(putter)
+                elif self.size < self.queue_size:
+                    # The free space has been handed to this caller, pass it on
+                    self.wake_putter()
+
+                raise
+
+        key = self.key(item)
+        self.get_lane(key).add(key, item)
+
+        self.size += 1
+        self.unfinished += 1
+        self.finished.clear()
+
+    def wake_putter(self):
+        while self.putters:
+            putter = self.putters.popleft()
+
+            if not putter.done():
+                putter.set_result(None)
+                break
+
+    async def run_lane(self, lane: ExecutorLane):
+        while True:
+            await lane.has_items.wait()
+
+            item = lane.take()
+
+            self.size -= 1
+            self.wake_putter()
+
+            try:
+                await self.process_item(item)
+            finally:
+                self.unfinished -= 1
+
+                if not self.unfinished:
+                    self.finished.set()
+
+    async def process_item(self, item):
+        await self.process(item)
+
+    async def join(self):
+        await self.finished.wait()
+
+
+class PipelineStage(KeyedExecutor):
+    # Each worker processes its own lane, so messages of the same chat keep their order (e.g. an edit is written after the original message)
+    def __init__(self, name: str, process: callable, config: dict, key: callable = None):
+        super().__init__(process, int(config.get("workers", 1)), int(config.get("queue_size", 100)), key or (lambda item: None))
+
+        self.name = name
+        self.workers = len(self.lanes)
+
+        self.max_queue_depth = 0
+        self.busy_workers = 0
+        self.processed = 0
+        self.errors = 0
+
+    async def put(self, item):
+        await super().put(item)
+
+        self.max_queue_depth = max(self.max_queue_depth, self.size)
+
+    async def process_item(self, item):
+        self.busy_workers += 1
+
+        try:
+            await self.process(item)
+            self.processed += 1
+        except Exception as exception:
+            self.errors += 1
+            logging.error(f"Pipeline stage '{self.name}' failed to process message: {exception}")
+        finally:
+            self.busy_workers -= 1
+
+    def get_stats(self):
+        return {
+            "queue_depth": self.size,
+            "max_queue_depth": self.max_queue_depth,
+            "busy_workers": self.busy_workers,
+            "workers": self.workers,
+            "processed": self.processed,
+            "errors": self.errors
+        }
+
+
+class Pipeline:
+    def __init__(self, output_handler, config: dict):
+        self.output_handler = output_handler
+        self.stats_interval = TimeInterval.parse(str(config.get("stats_interval", "1m")))
+
+        # Messages are partitioned by chat in all stages
+        self.ingest_stage = PipelineStage("ingest", self.ingest, config.get("ingest", {}), lambda item: getattr(item[0], "chat_id", None))
+        self.enrich_stage = PipelineStage("enrich", self.enrich, config.get("enrich", {}), self.get_chat_id)
+
+        self.output_stages = []
+        for index, output in enumerate(output_handler.outputs):
+            spool = getattr(output, "spool", None)
+
+            # Spooled outputs are written in the background by the spool
+            if spool is not None:
+                process = spool.append
+            else:
+                process = (getattr(output, "delivery", None) or OutputDelivery(output, f"output[#{index}]", {})).write
+
+            self.output_stages.append(PipelineStage(f"output[#{index}]", Pipeline.track_delivery(process), config.get("output", {}), self.get_chat_id))
+
+        self.tasks = []
+
+        METRICS.register("queue_depth", "gauge", self.get_queue_depths)
+        METRICS.register("pipeline_errors_total", "counter", lambda: {(("stage", stage.name),): stage.errors for stage in self.stages})
+
+    @property
+    def stages(self):
+        return [self.ingest_stage, self.enrich_stage] + self.output_stages
+
+    @staticmethod
+    def get_chat_id(context: MessageContext):
+        return getattr(context.message, "chat_id", None)
+
+    @staticmethod
+    def track_delivery(process: callable):
+        async def write_output(context: MessageContext):
+            delivered = False
+
+            try:
+                delivered = await process(context)
+            finally:
+                context.output_done(bool(delivered))
+
+        return write_output
+
+    def start(self):
+        for stage in self.stages:
+            for lane in stage.lanes:
+                self.tasks.append(asyncio.ensure_future(stage.run_lane(lane)))
+
+        if self.stats_interval is not None and self.stats_interval.seconds:
+            self.tasks.append(asyncio.ensure_future(self.log_stats()))
+
+    async def submit(self, message, is_chat_enabled: callable, is_edit: bool = False) -> asyncio.Future:
+        # Returns a future resolved with whether all outputs handled the message (messages of disabled chats count as handled)
+        if not self.tasks:
+            self.start()
+
+        written = asyncio.get_running_loop().create_future()
+
+        # The pipeline tasks process messages of all callers, so the priority of the caller is passed along with the message
+        await self.ingest_stage.put((message, is_chat_enabled, is_edit, API_PRIORITY.get(), written))
+
+        return written
+
+    async def submit_context(self, context: MessageContext):
+        # Messages which do not have to be resolved using Telegram (e.g. from exports) skip the ingest stage
+        if not self.tasks:
+            self.start()
+
+        await self.enrich_stage.put(context)
+
+    async def ingest(self, item):
+        message, is_chat_enabled, is_edit, priority, written = item
+
+        try:
+            with ApiRateLimiter.priority(priority):
+                context = await self.output_handler.create_context(message, is_chat_enabled, is_edit)
+        except Exception:
+            written.set_result(False)
+            raise
+
+        if context is None:
+            written.set_result(True)
+            return
+
+        context.written = written
+        await self.enrich_stage.put(context)
+
+    async def enrich(self, context):
+        try:
+            with ApiRateLimiter.priority(context.priority):
+                await self.output_handler.enrich_context(context)
+        except Exception:
+            context.set_written(False)
+            raise
+
+        await self.write(context)
+
+        # Media downloaded in the background is written again once the download completed
+        await self.output_handler.submit_media_download(context)
+
+    async def write(self, context):
+        context.pending_outputs = len(self.output_stages)
+
+        if not self.output_stages:
+            context.set_written(True)
+
+        for stage in self.output_stages:
+            await stage.put(context)
+
+    def get_queue_depths(self):
+        queue_depths = {(("queue", stage.name),): stage.qsize() for stage in self.stages}
+        queue_depths[(("queue", "media"),)] = self.output_handler.media_downloader.queue.qsize()
+
+        return queue_depths
+
+    def get_stats(self):
+        return {stage.name: stage.get_stats() for stage in self.stages}
+
+    def format_stats(self):
+        stats = [f"{stage.name}: {stage.qsize()}/{stage.queue_size} queued, {stage.processed} processed" for stage in self.stages]
+
+        if self.output_handler.media_downloader.background:
+            stats.append(f"media: {self.output_handler.media_downloader.format_stats()}")
+
+        return ", ".join(stats)
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval.seconds)
+
+            # Only report if messages are piling up somewhere
+            if any(stage.qsize() for stage in self.stages) or self.output_handler.media_downloader.queue.qsize():
+                logging.log(LOG_LEVEL_INFO, f"Pipeline stats: {self.format_stats()}")
+            else:
+                logging.debug(f"Pipeline stats: {self.format_stats()}")
+
+    async def join(self):
+        # Wait for each stage to process everything queued so far
+        if self.tasks:
+            for stage in self.stages:
+                await stage.join()
+
+    async def close(self):
+        await self.join()
+
+        for task in self.tasks:
+            task.cancel()
+
+        self.tasks = []
+
+
+class MediaStore:
+    link_modes = ["hardlink", "symlink", "reference"]
+
+    def __init__(self, config: dict):
+        # Append-only index file (one JSON object per line) mapping Telegram media IDs and content hashes to stored files
+        self.index_file = os.path.expanduser(config.get("index_file"))
+
+        self.link_mode = config.get("link", "hardlink")
+        if self.link_mode not in self.link_modes:
+            raise RuntimeError(f"Invalid media link mode: {self.link_mode} (expected one of {', '.join(self.link_modes)})")
+
+        self.use_hash = bool(config.get("hash", False))
+
+        self.paths_by_key = {}
+        self.paths_by_hash = {}
+
+        # Downloads currently in progress by media key to not fetch the same media twice at the same time
+        self.pending_downloads = {}
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, "r") as index_file:
+                for line in index_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Might be a partially written last line
+                        continue
+
+                    self.paths_by_key[entry["key"]] = entry["path"]
+
+                    if entry.get("hash"):
+                        self.paths_by_hash[entry["hash"]] = entry["path"]
+        except FileNotFoundError:
+            pass
+
+    def add(self, key: str, path: Path, content_hash: str | None):
+        self.paths_by_key[key] = str(path)
+
+        if content_hash is not None:
+            self.paths_by_hash.setdefault(content_hash, str(path))
+
+        Path(self.index_file).parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.index_file, "a") as index_file:
+            index_file.write(json.dumps({"key": key, "path": str(path), "hash": content_hash}) + "\n")
+
+    @staticmethod
+    def get_media_key(message) -> str | None:
+        if message.photo is not None:
+            return f"photo:{message.photo.id}"
+
+        if message.document is not None:
+            return f"document:{message.document.id}"
+
+        return None
+
+    def lookup(self, key: str) -> Path | None:
+        path = self.paths_by_key.get(key)
+
+        # The file might have been deleted since it was added to the index
+        if path is None or not os.path.exists(path):
+            return None
+
+        return Path(path)
+
+    def link(self, existing_path: Path, filepath: Path) -> Path:
+        if existing_path == filepath or self.link_mode == "reference":
+            return existing_path
+
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        if filepath.exists() or filepath.is_symlink():
+            filepath.unlink()
+
+        if self.link_mode == "hardlink":
+            try:
+                os.link(existing_path, filepath)
+            except OSError:
+                # Hardlinks are not possible across file systems
+                shutil.copyfile(existing_path, filepath)
+        else:
+            os.symlink(existing_path.absolute(), filepath)
+
+        return filepath
+
+    @staticmethod
+    def hash_file(path: Path):
+        file_hash = hashlib.sha256()
+
+        with open(path, "rb") as hash_file:
+            while chunk := hash_file.read(1024 * 1024):
+                file_hash.update(chunk)
+
+        return file_hash.hexdigest()
+
+    async def store(self, key: str, filepath: Path) -> Path:
+        # Called after the media has been downloaded to filepath, might replace it by a link to identical content
+        content_hash = None
+
+        if self.use_hash:
+            content_hash = await asyncio.to_thread(self.hash_file, filepath)
+
+            existing_path = self.paths_by_hash.get(content_hash)
+
+            if existing_path is not None and os.path.exists(existing_path) and Path(existing_path) != filepath:
+                if self.link_mode == "reference":
+                    filepath.unlink()
+
+                filepath = self.link(Path(existing_path), filepath)
+
+        self.add(key, filepath, content_hash)
+
+        return filepath
+
+
+class MediaDownloader:
+    def __init__(self, config: dict):
+        # Download media in the given number of background workers instead of before writing the message (0 to disable)
+        self.workers = int(config.get("workers", 0))
+        self.queue = asyncio.Queue(int(config.get("queue_size", 100)))
+        self.close_timeout = float(config.get("close_timeout", 60))
+
+        max_bandwidth = config.get("max_bandwidth")
+        self.bandwidth = TokenBucket(FileSize.human_readable_to_bytes(str(max_bandwidth))) if max_bandwidth else None
+
+        dedup_config = config.get("dedup")
+        self.media_store = MediaStore(dedup_config) if dedup_config else None
+
+        self.downloaded_bytes = 0
+        self.busy_workers = 0
+        self.stats_time = time.monotonic()
+        self.stats_bytes = 0
+
+        self.tasks = []
+
+    @property
+    def background(self):
+        return self.workers > 0
+
+    async def submit(self, context: MessageContext, write_context: callable):
+        if not self.tasks:
+            for _ in range(self.workers):
+                self.tasks.append(asyncio.ensure_future(self.run_worker()))
+
+        await self.queue.put((context, write_context))
+
+    async def run_worker(self):
+        while True:
+            context, write_context = await self.queue.get()
+            self.busy_workers += 1
+
+            try:
+                await write_context(context.with_media(await self.download(context.message, context.downloaded_media)))
+            except Exception as exception:
+                logging.error(f"Unable to write message {context.message.id} after downloading media: {exception}")
+            finally:
+                self.busy_workers -= 1
+                self.queue.task_done()
+
+    async def download(self, message, downloaded_media: DownloadedMedia) -> DownloadedMedia:
+        filepath = downloaded_media.filepath
+        media_key = MediaStore.get_media_key(message) if self.media_store is not None else None
+        download_future = None
+
+        try:
+            if media_key is not None:
+                # Wait for a download of the same media which is currently in progress (e.g. a forwarded message)
+                pending_download = self.media_store.pending_downloads.get(media_key)
+                if pending_download is not None:
+                    await asyncio.wait([pending_download])
+
+                existing_path = self.media_store.lookup(media_key)
+                if existing_path is not None:
+                    logging.debug(f"Media of message {message.id} already stored at {existing_path}")
+                    filepath = self.media_store.link(existing_path, filepath)
+                    return DownloadedMedia(filepath=filepath, filename=downloaded_media.filename)
+
+                download_future = asyncio.get_running_loop().create_future()
+                self.media_store.pending_downloads[media_key] = download_future
+
+            await self.download_file(message, filepath)
+
+            if media_key is not None:
+                filepath = await self.media_store.store(media_key, filepath)
+
+            status = "downloaded"
+        except Exception as exception:
+            logging.error(f"Unable to download media of message {message.id} to {filepath}: {exception}")
+            METRICS.count("media_download_errors_total")
+            status = "failed"
+        finally:
+            if download_future is not None:
+                del self.media_store.pending_downloads[media_key]
+                download_future.set_result(None)
+
+        return DownloadedMedia(filepath=filepath, filename=downloaded_media.filename, status=status)
+
+    async def download_file(self, message, filepath: Path):
+        # Skip files which have already been downloaded completely (e.g. by a previous import)
+        if filepath.exists() and filepath.stat().st_size == message.file.size:
+            logging.debug(f"Media file {filepath} of message {message.id} already exists")
+            return
+
+        file_size_string = FileSize.bytes_to_human_readable(message.file.size)
+        logging.debug(f"Downloading media file of message {message.id} to {filepath} ({file_size_string})")
+
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        start_time = time.perf_counter()
+
+        with ApiRateLimiter.priority("media"):
+            await message.download_media(file=filepath, progress_callback=self.create_progress_callback())
+        METRICS.observe("media_download_seconds", time.perf_counter() - start_time)
+
+    def create_progress_callback(self):
+        position = 0
+
+        async def progress_callback(current: int, total: int):
+            nonlocal position
+
+            chunk_size = current - position
+            position = current
+
+            self.downloaded_bytes += chunk_size
+            METRICS.count("media_downloaded_bytes_total", amount=chunk_size)
+
+            if self.bandwidth is not None:
+                await self.bandwidth.consume(chunk_size)
+
+        return progress_callback
+
+    def format_stats(self):
+        now = time.monotonic()
+        bytes_per_second = (self.downloaded_bytes - self.stats_bytes) / max(now - self.stats_time, 0.001)
+
+        self.stats_time = now
+        self.stats_bytes = self.downloaded_bytes
+
+        return f"{self.queue.qsize()}/{self.queue.maxsize} queued, {self.busy_workers} downloading, {FileSize.bytes_to_human_readable(bytes_per_second)}/s"
+
+    async def close(self):
+        if self.tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), self.close_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Cancelling {self.queue.qsize() + self.busy_workers} pending media downloads on shutdown, the messages keep media status 'pending'")
+
+        for task in self.tasks:
+            task.cancel()
+
+        self.tasks = []
+
+
+class Translator:
+    def __init__(self, to_lang: str, config: dict):
+        self.to_lang = to_lang
+
+        self.batch_size = int(config.get("batch_size", 20))
+        self.max_wait = float(config.get("max_wait", 0.2))
+
+        self.cache_size = int(config.get("cache_size", 10000))
+        self.cache_file = os.path.expanduser(config.get("cache_file")) if config.get("cache_file") else None
+        self.cache = OrderedDict(read_json_file(self.cache_file, {}) if self.cache_file else {})
+        self.unsaved_entries = 0
+
+        # Pending translations per chat: list of (message, future)
+        self.batches = {}
+        self.flush_tasks = {}
+
+    def get_cache_key(self, message):
+        text_hash = hashlib.sha1(message.text.encode("utf-8")).hexdigest()
+
+        return f"{message.chat_id}:{message.id}:{text_hash}:{self.to_lang}"
+
+    def translate(self, message) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        cache_key = self.get_cache_key(message)
+
+        if cache_key in self.cache:
+            self.cache.move_to_end(cache_key)
+            future.set_result(self.cache[cache_key])
+            return future
+
+        # Messages can only be translated in a single request if they belong to the same chat
+        batch = self.batches.setdefault(message.chat_id, [])
+        batch.append((message, future))
+
+        if len(batch) >= self.batch_size:
+            self.flush(message.chat_id)
+        elif message.chat_id not in self.flush_tasks:
+            self.flush_tasks[message.chat_id] = asyncio.get_running_loop().call_later(self.max_wait, self.flush, message.chat_id)
+
+        return future
+
+    def flush(self, chat_id: int):
+        flush_task = self.flush_tasks.pop(chat_id, None)
+        if flush_task is not None:
+            flush_task.cancel()
+
+        batch = self.batches.pop(chat_id, None)
+        if batch:
+            asyncio.ensure_future(self.send(batch))
+
+    async def send(self, batch: list):
+        messages = [message for message, _ in batch]
+        start_time = time.perf_counter()
+
+        try:
+            translate_text_result: TranslateResult = await messages[0].client(TranslateTextRequest(to_lang=self.to_lang, peer=messages[0].input_chat, id=[message.id for message in messages]))
+            translated_texts = [result.text for result in translate_text_result.result]
+        except BaseException as exception:
+            logging.error(f"Unable to translate {len(messages)} messages of chat {messages[0].chat_id} using language '{self.to_lang}': {exception}")
+            METRICS.count("translation_errors_total")
+            translated_texts = [None] * len(messages)
+
+        METRICS.observe("translation_seconds", time.perf_counter() - start_time)
+
+        for (message, future), translated_text in zip(batch, translated_texts):
+            if translated_text is not None:
+                self.add_to_cache(self.get_cache_key(message), translated_text)
+
+            if not future.done():
+                future.set_result(translated_text)
+
+    def add_to_cache(self, cache_key: str, translated_text: str):
+        self.cache[cache_key] = translated_text
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        self.unsaved_entries += 1
+        if self.unsaved_entries >= 100:
+            self.save()
+
+    def save(self):
+        if self.cache_file is not None and self.unsaved_entries:
+            write_json_file(self.cache_file, self.cache)
+
+        self.unsaved_entries = 0
+
+    async def close(self):
+        for chat_id in list(self.batches):
+            self.flush(chat_id)
+
+        self.save()
+
+
+class OutputHandler:
+    def __init__(self, media_config: dict, translate_to_lang: str = None, pipeline_config: dict = None, translation_config: dict = None, entity_cache_config: dict = None):
+        self.outputs = []
+        self.entity_cache = EntityCache(entity_cache_config or {})
+        self.imports = {}
+        self.output_maps = {}
+        self.media_config = MediaConfiguration(media_config)
+        self.media_downloader = MediaDownloader(media_config)
+        self.translator = Translator(translate_to_lang, translation_config or {}) if translate_to_lang else None
+        self.pipeline_config = pipeline_config or {}
+        self.pipeline = None
+
+        # Media of recently seen messages to only handle media of edited messages if it changed
+        self.media_keys = OrderedDict()
+        self.media_keys_size = 10000
+
+        # Number of calls to flush_pending() which found messages which could not be written
+        self.failed_flushes = 0
+
+        # Whether any output map uses the chat entity which then has to be requested if Telethon does not know it
+        self.uses_chat = False
+
+        METRICS.register("spool_size_bytes", "gauge", self.get_spool_sizes)
+        METRICS.register("circuit_breaker_open", "gauge", lambda: {(("output", output.name),): int(output.delivery.circuit_breaker.is_open()) for output in self.outputs})
+
+    def add(self, config: dict):
+        output_type = config.get("type")
+        del config["type"]
+
+        if output_type not in self.imports:
+            self.imports[output_type] = importlib.import_module("output.{}".format(output_type))
+
+        config["name"] = f"output[#{len(self.outputs)}]"
+
+        writer = self.imports[output_type].Writer(config)
+        writer.delivery = OutputDelivery(writer, writer.name, config.get("delivery") or {})
+
+        spool_config = config.get("spool")
+        if spool_config:
+            writer.spool = OutputSpool(writer, spool_config)
+
+        # Outputs with an identical output map share the compiled map and therefore the evaluated message per context
+        writer.output_map = self.output_maps.setdefault(writer.output_map.identity, writer.output_map)
+        self.uses_chat = self.uses_chat or "chat" in writer.output_map.variables
+
+        self.outputs.append(writer)
+
+    async def submit(self, message, is_chat_enabled: callable, is_edit: bool = False) -> asyncio.Future:
+        # Hand the message over to the pipeline which processes it in the background
+        if self.pipeline is None:
+            self.pipeline = Pipeline(self, self.pipeline_config)
+
+        return await self.pipeline.submit(message, is_chat_enabled, is_edit)
+
+    async def submit_context(self, context: MessageContext):
+        if self.pipeline is None:
+            self.pipeline = Pipeline(self, self.pipeline_config)
+
+        await self.pipeline.submit_context(context)
+
+    async def write_context(self, context: MessageContext):
+        if self.pipeline is not None:
+            await self.pipeline.write(context)
+        else:
+            # Write to all outputs concurrently, each output handles its errors on its own
+            await asyncio.gather(*[output.delivery.write(context) for output in self.outputs])
+
+    async def submit_media_download(self, context: MessageContext):
+        if context.downloaded_media is not None and context.downloaded_media.status == "pending":
+            await self.media_downloader.submit(context, self.write_context)
+
+    async def create_context(self, message, is_chat_enabled: callable, is_edit: bool = False):
+        # message might not be an actual message (i.e. MessageService)
+        if not isinstance(message, Message):
+            return None
+
+        start_time = time.perf_counter()
+        chat_info = await self.entity_cache.get_chat(message)
+
+        if not is_chat_enabled(chat_info):
+            logging.debug("Skipping message {} from chat '{}' as chat type {} is not enabled".format(message.id, chat_info.display_name, chat_info.chat_type.value if chat_info.chat_type else None))
+            return None
+
+        chat_type = chat_info.chat_type.value if chat_info.chat_type else None
+
+        # The sender of an edited message does not change and is not part of edit records
+        sender = (await self.entity_cache.get_sender(message)).sender if not is_edit else {}
+
+        chat = await self.entity_cache.get_chat_entity(message) if self.uses_chat else message.chat
+
+        METRICS.observe("entity_lookup_seconds", time.perf_counter() - start_time)
+        METRICS.count("messages_total", (("chat_type", chat_type),))
+
+        return MessageContext(message=message, chat=chat, sender=sender, chat_name=chat_info.display_name, chat_type=chat_type, is_edit=is_edit)
+
+    async def enrich_context(self, context: MessageContext):
+        message = context.message
+
+        if isinstance(message, Message):
+            media_changed = self.remember_media(message)
+
+            # Media of edited messages is only downloaded again (and written) if the media itself changed
+            if context.is_edit:
+                context.media_changed = media_changed
+
+        if message.file and context.media_changed:
+            context.downloaded_media = self.get_media_download(message, context.chat_type)
+
+            if context.downloaded_media is not None:
+                if self.media_downloader.background:
+                    context.downloaded_media.status = "pending"
+                else:
+                    context.downloaded_media = await self.media_downloader.download(message, context.downloaded_media)
+
+        # Translations are requested using Telegram which is only possible for messages received from Telegram
+        if self.translator is not None and message.text and isinstance(message, Message):
+            context.translation = self.translator.translate(message)
+
+    def remember_media(self, message) -> bool:
+        # Returns whether the media of the message changed since the message has been seen (unknown messages count as changed)
+        key = (message.chat_id, message.id)
+        media_key = MediaStore.get_media_key(message)
+
+        changed = key not in self.media_keys or self.media_keys[key] != media_key
+
+        self.media_keys[key] = media_key
+        self.media_keys.move_to_end(key)
+
+        while len(self.media_keys) > self.media_keys_size:
+            self.media_keys.popitem(last=False)
+
+        return changed
+
+    async def join(self):
+        if self.pipeline is not None:
+            await self.pipeline.join()
+
+    async def flush_pending(self) -> bool:
+        # Writes messages still buffered by the outputs, returns whether all of them have been written (spooled outputs handle that on their own)
+        results = await asyncio.gather(*[output.flush_pending() for output in self.outputs if output.spool is None], return_exceptions=True)
+
+        # Rejected messages count as handled, just like for OutputDelivery
+        errors = [result for result in results if isinstance(result, Exception) and not isinstance(result, RejectedMessageError)]
+
+        for error in errors:
+            logging.error(f"Unable to write buffered messages: {error}")
+
+        if errors:
+            self.failed_flushes += 1
+
+        return not errors
+
+    def set_report_errors(self, enabled: bool):
+        # Failures of buffered messages are only collected while importing, flush_pending() reports them before import checkpoints are stored
+        for output in self.outputs:
+            if output.spool is None:
+                output.report_errors = enabled
+                output.reset_errors()
+
+    def start(self):
+        for output in self.outputs:
+            output.start()
+
+            # Replay messages spooled by a previous run
+            if output.spool is not None:
+                output.spool.start()
+
+    async def start_import(self):
+        await asyncio.gather(*[output.start_import() for output in self.outputs])
+
+    def get_spool_sizes(self):
+        return {output.spool.labels: output.spool.size for output in self.outputs if output.spool is not None}
+
+    async def close(self):
+        if self.pipeline is not None:
+            await self.pipeline.join()
+
+        if self.translator is not None:
+            await self.translator.close()
+
+        self.entity_cache.save()
+
+        # Pending downloads write their messages again, so the pipeline has to be closed afterwards
+        await self.media_downloader.close()
+
+        if self.pipeline is not None:
+            await self.pipeline.close()
+
+        for output in self.outputs:
+            if output.spool is not None:
+                await output.spool.close()
+
+            await output.close()
+
+    def get_media_download(self, message, chat_type: str | None) -> DownloadedMedia | None:
+        if message.file.name is None:
+            original_filename = f"msg{message.chat_id}-{message.id}"
+        else:
+            original_filename = Path(message.file.name).stem
+
+        full_original_filename = f"{original_filename}{message.file.ext}"
+
+        config_rule = self.media_config.get_rule(message, chat_type)
+        if config_rule is None:
+            logging.debug(f"Skipping media download for '{full_original_filename}' as no config rule matches (mime_type: {message.file.mime_type})")
+            return None
+
+        download_path = config_rule.get_download_path()
+        if download_path is None:
+            logging.debug(f"Skipping media download for '{full_original_filename}' as no download path has been configured")
+            return None
+
+        download_path = Path(download_path).expanduser()
+
+        filename_pattern_map = {
+            "date": {
+                "year": message.date.year,
+                "month": str(message.date.month).rjust(2, "0"),
+                "day": str(message.date.day).rjust(2, "0"),
+                "hour": str(message.date.hour).rjust(2, "0"),
+                "minute": str(message.date.minute).rjust(2, "0"),
+                "second": str(message.date.second).rjust(2, "0")
+            },
+            "file": {
+                "name": original_filename,
+                "ext": message.file.ext.strip(".")
+            },
+            "message": {
+                "id": message.id,
+                "chat_id": message.chat_id
+            }
+        }
+
+        filename = config_rule.get_filepattern().format_map(filename_pattern_map)
+
+        return DownloadedMedia(filepath=download_path.joinpath(filename), filename=filename)
+
+
+class JsonStreamReader:
+    # Reads a JSON document incrementally so that large documents do not have to be loaded into memory at once
+    whitespace = " \t\n\r"
+
+    def __init__(self, file, chunk_size: int = 1024 * 1024):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def read_chunk(self):
+        chunk = self.file.read(self.chunk_size)
+
+        if not chunk:
+            self.eof = True
+            return False
+
+        # Drop the part of the buffer which has already been consumed
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+        return True
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in self.whitespace:
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self.read_chunk():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, characters: str):
+        character = self.peek()
+
+        if character not in characters:
+            raise ValueError(f"Expected one of '{characters}' but got '{character}' in JSON document")
+
+        self.position += 1
+
+        return character
+
+    def read_value(self):
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+
+                # A value ending with the buffer might continue in the next chunk (e.g. a number)
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            self.read_chunk()
+
+    def iter_object(self):
+        # Yields the keys of an object, the value of each key has to be read by the caller before continuing
+        self.expect("{")
+
+        if self.peek() == "}":
+            self.position += 1
+            return
+
+        while True:
+            key = self.read_value()
+            self.expect(":")
+
+            yield key
+
+            if self.expect(",}") == "}":
+                return
+
+    def iter_array(self):
+        # Yields once for each element of an array which has to be read by the caller before continuing
+        self.expect("[")
+
+        if self.peek() == "]":
+            self.position += 1
+            return
+
+        while True:
+            yield
+
+            if self.expect(",]") == "]":
+                return
+
+
+@dataclass
+class ExportedMessage:
+    # Message of a Telegram Desktop export providing the attributes of Telethon messages commonly used in output maps
+    id: int
+    chat_id: int
+    sender_id: int | None
+    date: datetime
+    edit_date: datetime | None
+    text: str
+    reply_to_msg_id: int | None
+
+    # The message as found in the export
+    data: dict
+
+    # Media of exported messages is not downloaded from Telegram
+    file = None
+
+    @property
+    def raw_text(self):
+        return self.text
+
+
+class TelegramExport:
+    chat_types = {
+        "personal_chat": ChatType.USER,
+        "saved_messages": ChatType.USER,
+        "bot_chat": ChatType.BOT,
+        "private_group": ChatType.GROUP,
+        "private_supergroup": ChatType.GROUP,
+        "public_supergroup": ChatType.GROUP,
+        "private_channel": ChatType.CHANNEL,
+        "public_channel": ChatType.CHANNEL
+    }
+
+    def __init__(self, path: str):
+        path = Path(path).expanduser()
+
+        # Either the result.json or the directory containing it and the media folders
+        self.path = path.joinpath("result.json") if path.is_dir() else path
+        self.directory = self.path.parent
+
+    def iter_messages(self):
+        # Yields (chat, message) for all messages of a full export or a single chat export
+        with open(self.path, "r", encoding="utf-8") as export_file:
+            yield from self.read_chat(JsonStreamReader(export_file))
+
+    def read_chat(self, reader: JsonStreamReader):
+        # Chat objects contain name, type and id before the messages
+        chat = {}
+
+        for key in reader.iter_object():
+            if key == "messages":
+                for _ in reader.iter_array():
+                    yield chat, reader.read_value()
+            elif key in ["chats", "left_chats"]:
+                for list_key in reader.iter_object():
+                    if list_key == "list":
+                        for _ in reader.iter_array():
+                            yield from self.read_chat(reader)
+                    else:
+                        reader.read_value()
+            else:
+                value = reader.read_value()
+
+                if not isinstance(value, (dict, list)):
+                    chat[key] = value
+
+    @classmethod
+    def get_chat_id(cls, chat: dict):
+        chat_type = cls.chat_types.get(chat.get("type"))
+
+        if chat.get("type") == "private_group":
+            return get_peer_id(types.PeerChat(chat["id"]))
+        elif chat_type in [ChatType.GROUP, ChatType.CHANNEL]:
+            return get_peer_id(types.PeerChannel(chat["id"]))
+        else:
+            return get_peer_id(types.PeerUser(chat["id"]))
+
+    @staticmethod
+    def get_sender_id(from_id: str | None):
+        if not from_id:
+            return None
+
+        for prefix, peer_type in [("user", types.PeerUser), ("channel", types.PeerChannel), ("chat", types.PeerChat)]:
+            if from_id.startswith(prefix) and from_id[len(prefix):].isdigit():
+                return get_peer_id(peer_type(int(from_id[len(prefix):])))
+
+        return None
+
+    @staticmethod
+    def get_text(text):
+        # Formatted texts are lists of plain strings and entities like {"type": "bold", "text": "..."}
+        if isinstance(text, list):
+            return "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+
+        return text or ""
+
+    @staticmethod
+    def get_date(data: dict, key: str):
+        if data.get(f"{key}_unixtime"):
+            return datetime.fromtimestamp(int(data[f"{key}_unixtime"]), timezone.utc)
+
+        if data.get(key):
+            # Older exports only contain the local time
+            return datetime.fromisoformat(data[key]).astimezone(timezone.utc)
+
+        return None
+
+    def create_message(self, chat: dict, data: dict) -> ExportedMessage:
+        return ExportedMessage(id=data["id"], chat_id=self.get_chat_id(chat), sender_id=self.get_sender_id(data.get("from_id")), date=self.get_date(data, "date"), edit_date=self.get_date(data, "edited"), text=self.get_text(data.get("text")), reply_to_msg_id=data.get("reply_to_message_id"), data=data)
+
+    def get_media(self, data: dict) -> DownloadedMedia | None:
+        relative_path = data.get("photo") or data.get("file")
+        if not relative_path:
+            return None
+
+        filepath = self.directory.joinpath(relative_path)
+
+        # Media which has not been exported is mentioned using a placeholder text
+        if not filepath.is_file():
+            return None
+
+        return DownloadedMedia(filepath=filepath, filename=filepath.name)
+
+    def create_context(self, chat: dict, data: dict) -> MessageContext:
+        chat_type = self.chat_types.get(chat.get("type"))
+
+        if data.get("from") is None:
+            sender = MessageContext.get_sender_dict(None)
+        else:
+            sender = {"username": "", "firstName": data["from"], "lastName": ""}
+
+        return MessageContext(message=self.create_message(chat, data), chat=None, sender=sender, downloaded_media=self.get_media(data), chat_name=chat.get("name") or "", chat_type=chat_type.value if chat_type else None)
+
+
+class ExportImporter:
+    def __init__(self, output_handler):
+        self.output_handler = output_handler
+        self.progress_interval = 1000
+
+    async def import_export(self, path: str, chats: list = None):
+        export = TelegramExport(path)
+        chat_ids = set(TelegramReader.prepare_chats(chats)) if chats else None
+
+        logging.log(LOG_LEVEL_INFO, f"Importing messages from export {export.path}")
+
+        imported_messages = 0
+
+        for chat, data in export.iter_messages():
+            # Service messages (e.g. joined members) are skipped just like for imports from Telegram
+            if data.get("type") != "message":
+                continue
+
+            if chat_ids is not None and chat.get("id") not in chat_ids and TelegramExport.get_chat_id(chat) not in chat_ids:
+                continue
+
+            await self.output_handler.submit_context(export.create_context(chat, data))
+
+            imported_messages += 1
+
+            if imported_messages % self.progress_interval == 0:
+                logging.log(LOG_LEVEL_INFO, f"Imported {imported_messages} messages from export")
+
+        await self.output_handler.join()
+
+        logging.log(LOG_LEVEL_INFO, f"Import finished, imported {imported_messages} messages from export")
+
+
+def parse_ndjson_lines(lines: list) -> tuple:
+    # Runs in the worker processes of the Replayer, returns the parsed messages and the number of invalid lines
+    records = []
+    invalid_lines = 0
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError:
+            invalid_lines += 1
+            continue
+
+        # The id and date are required by the outputs (both are part of the default output map)
+        if not isinstance(record, dict) or record.get("id") is None or not isinstance(record.get("date"), str):
+            invalid_lines += 1
+            continue
+
+        records.append(record)
+
+    return records, invalid_lines
+
+
+class Replayer:
+    # Writes the messages of files written by the file output (one JSON object per line) to other outputs
+    magic_numbers = {
+        b"\x1f\x8b": gzip.open,
+        b"\xfd7zXZ\x00": lzma.open
     }
 
-    exec_variables.update(variables)
-    exec("async def _async_exec():\n return {}\ntask[0] = asyncio.ensure_future(_async_exec())".format(code), exec_variables)
-    return await task[0]
+    # Name of a segment rotated by the file output (optionally compressed): <name>.<%Y%m%d-%H%M%S-%f>[.gz|.xz]
+    rotated_file_pattern = re.compile(r"^(.*)\.(\d{8}-\d{6}-\d{6})(?:\.gz|\.xz)?$")
+
+    def __init__(self, outputs: list, batch_size: int = 1000, parallel: int = 4, workers: int = None):
+        self.outputs = outputs
+        self.batch_size = max(1, batch_size)
+        self.parallel = max(1, parallel)
+        self.workers = os.cpu_count() if workers is None else workers
+        self.read_buffer_size = 1024 * 1024
+        self.progress_interval = 10000
+
+        # Batches being written in the order they have been read, the position is only advanced once all previous batches have been written
+        self.writing = deque()
+        self.position = None
+
+        # Batches are split into lanes by chat, the messages of a lane are written in order (e.g. an edit after the original message)
+        self.lanes = [None] * self.parallel
+
+        # Set once messages could not be written, the replay stops and the position is not advanced any further
+        self.failed = False
+
+        self.replayed_messages = 0
+        self.invalid_lines = 0
+
+        for output in self.outputs:
+            # Let flush_pending() report messages which could not be written
+            output.report_errors = True
+            output.reset_errors()
+
+    @staticmethod
+    def get_files(paths: list) -> list:
+        files = []
+
+        for path in paths:
+            path = Path(path).expanduser()
+
+            if path.is_dir():
+                files.extend(Replayer.sort_files([file for file in path.iterdir() if file.is_file()]))
+            else:
+                files.append(path)
+
+        return files
+
+    @classmethod
+    def sort_files(cls, files: list) -> list:
+        # Segments rotated by size are ordered by the timestamp in their name followed by the file currently written to,
+        # files of different names (e.g. rotated by time using a path pattern) by the modification time of their oldest file
+        segments = {}
+
+        for file in files:
+            match = cls.rotated_file_pattern.match(file.name)
+            name, timestamp = (match.group(1), match.group(2)) if match else (file.name, None)
+
+            segments.setdefault(name, []).append((timestamp is None, timestamp or "", file))
+
+        groups = sorted(segments.values(), key=lambda group: min(file.stat().st_mtime for *_, file in group))
+
+        return [file for group in groups for *_, file in sorted(group)]
+
+    def open_file(self, path: Path):
+        # Compressed files are detected by their content as the file output does not add an extension when compressing
+        with open(path, "rb") as file:
+            header = file.read(6)
+
+        for magic_number, opener in self.magic_numbers.items():
+            if header.startswith(magic_number):
+                return opener(path, "rb")
+
+        return open(path, "rb", buffering=self.read_buffer_size)
+
+    @staticmethod
+    def parse_resume(value: str) -> tuple:
+        # Position as logged by a previous replay: PATH:OFFSET
+        path, _, offset = value.rpartition(":")
+
+        if not path or not offset.isdigit():
+            raise argparse.ArgumentTypeError(f"Invalid position '{value}' (expected PATH:OFFSET)")
+
+        return path, int(offset)
 
+    @staticmethod
+    def skip_files(files: list, resume: tuple) -> tuple:
+        # Skips the files before the file of the position, returns the remaining files and the offset of the first one
+        resume_path = Path(resume[0]).expanduser().resolve()
 
-async def eval_map(input_map: dict, variables: dict):
-    output = DottedPathDict()
+        for index, path in enumerate(files):
+            if path.resolve() == resume_path:
+                return files[index:], resume[1]
 
-    for key, expression in input_map.items():
-        output.set(key, await async_exec(expression, variables))
+        raise RuntimeError(f"Unable to resume at {resume[0]} as it is not one of the files to replay")
 
-    return output
+    def read_batches(self, files: list, offset: int = 0):
+        # Yields batches of complete lines together with the offset after the last line (in the uncompressed data)
+        for path in files:
+            with self.open_file(path) as file:
+                if offset:
+                    file.seek(offset)
 
+                position = offset
+                offset = 0
+                lines = []
 
-@dataclass
-class DownloadedMedia:
-    filepath: Path
-    filename: str
+                for line in file:
+                    # The last line might still be written by the file output
+                    if not line.endswith(b"\n"):
+                        break
 
+                    lines.append(line)
+                    position += len(line)
 
-class MediaConfigurationRule:
-    def __init__(self, global_config: dict, config_data: dict, rule_index: int):
-        self.global_config = global_config
-        self.config_data = config_data
+                    if len(lines) >= self.batch_size:
+                        yield path, lines, position
+                        lines = []
 
-        self.logger = logging.getLogger(f"media_download_config_rule[#{rule_index}]")
+                if lines:
+                    yield path, lines, position
 
-    def matches_message(self, message, chat):
-        if isinstance(message.media, types.MessageMediaPhoto):
-            message_media_type = "photo"
-        else:
-            message_media_type = "file"
+    async def replay(self, paths: list, resume: tuple = None):
+        files = self.get_files(paths)
+        if not files:
+            raise RuntimeError("No files to replay")
 
-        if not self.matches_media_type(message_media_type):
-            return False
+        offset = 0
+        if resume is not None:
+            files, offset = self.skip_files(files, resume)
 
-        if not self.matches_mime_type(message.file.mime_type):
-            return False
+        logging.log(LOG_LEVEL_INFO, f"Replaying {len(files)} files to {', '.join(output.name for output in self.outputs)}")
 
-        message_chat_type = ChatType.get_from_chat(chat)
-        if message_chat_type is None or not self.matches_chat_type(message_chat_type.value):
-            return False
+        loop = asyncio.get_running_loop()
+        executor = ProcessPoolExecutor(self.workers) if self.workers > 0 else None
+        write_slots = asyncio.Semaphore(self.parallel)
+        parsing = deque()
 
-        message_chat_id = message.chat_id
-        if message_chat_id is None or not self.matches_chat_id(message_chat_id):
-            return False
+        try:
+            for path, lines, position in self.read_batches(files, offset):
+                if executor is not None:
+                    future = loop.run_in_executor(executor, parse_ndjson_lines, lines)
+                else:
+                    future = loop.create_future()
+                    future.set_result(parse_ndjson_lines(lines))
 
-        if not self.check_size_limit(message.file.size):
-            return False
+                parsing.append((future, path, position))
 
-        return True
+                # Keep all worker processes busy without reading too far ahead of the outputs
+                if len(parsing) > max(1, self.workers):
+                    await self.write_parsed(*parsing.popleft(), write_slots)
 
-    def matches_media_type(self, media_type: str):
-        return self.matches_config_value("media_type", media_type)
+                if self.failed:
+                    break
 
-    def matches_mime_type(self, mime_type: str):
-        return self.matches_config_value("mime_type", mime_type)
+            while parsing and not self.failed:
+                await self.write_parsed(*parsing.popleft(), write_slots)
 
-    def matches_chat_type(self, chat_type: str):
-        return self.matches_config_value("chat_type", chat_type)
+            await asyncio.gather(*[task for task, _ in self.writing])
+            self.update_position()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
 
-    def matches_chat_id(self, chat_id: int):
-        chat_ids = self.config_data.get("chats")
-        if not chat_ids:
-            return True
+            if self.position is not None:
+                path, position = self.position
+                logging.log(LOG_LEVEL_INFO, f"Replayed {self.replayed_messages} messages, all messages up to offset {position} of {path} have been written (resume using --resume {path}:{position})")
 
-        self.logger.debug(f"Checking chat ID {chat_id} in {chat_ids}")
+        if self.invalid_lines:
+            logging.warning(f"Skipped {self.invalid_lines} lines which are not valid JSON objects containing 'id' and 'date'")
 
-        return chat_id in chat_ids
+        if self.failed:
+            raise RuntimeError("Replay stopped as messages could not be written, continue using --resume once the outputs are available again")
 
-    def check_size_limit(self, file_size_bytes: int):
-        max_size = self.get_max_size()
-        if max_size == "":
-            return True
+    async def write_parsed(self, future: asyncio.Future, path: Path, position: int, write_slots: asyncio.Semaphore):
+        records, invalid_lines = await future
+        self.invalid_lines += invalid_lines
 
-        max_size_bytes = FileSize.human_readable_to_bytes(max_size)
-        file_size_string = FileSize.bytes_to_human_readable(file_size_bytes)
+        contexts = []
 
-        self.logger.debug(f"Checking file size {file_size_string} <= {max_size}")
+        for record in records:
+            try:
+                contexts.append(StoredContext({"id": record["id"], "chat_id": record.get("chat_id"), "date": record["date"], "data": record}))
+            except ValueError:
+                self.invalid_lines += 1
 
-        return file_size_bytes <= max_size_bytes
+        await write_slots.acquire()
 
-    def get_download_path(self) -> str | None:
-        return self.get_with_fallback("download_path")
+        lane_contexts = {}
+        for context in contexts:
+            lane_contexts.setdefault(hash(context.message.chat_id) % self.parallel, []).append(context)
 
-    def get_filepattern(self) -> str:
-        return self.get_with_fallback("file_pattern", "{date[year]}-{date[month]}-{date[day]}_{date[hour]}-{date[minute]}-{date[second]}_{message[id]}_{file[name]}.{file[ext]}")
+        # Each lane writes its part of the batch once it has written its part of the previous batches
+        lane_tasks = []
+        for lane, contexts_of_lane in lane_contexts.items():
+            lane_task = asyncio.ensure_future(self.write_lane(self.lanes[lane], contexts_of_lane))
+            self.lanes[lane] = lane_task
+            lane_tasks.append(lane_task)
 
-    def get_max_size(self) -> str:
-        return self.get_with_fallback("max_size", "")
+        task = asyncio.ensure_future(asyncio.gather(*lane_tasks))
+        task.add_done_callback(lambda _: write_slots.release())
+        self.writing.append((task, (str(path), position)))
 
-    def matches_config_value(self, config_name: str, value):
-        match_exact_value = self.config_data.get(config_name)
-        match_regex_value = self.config_data.get(f"{config_name}_re")
+        self.update_position()
 
-        if match_exact_value is None and match_regex_value is None:
-            return True
+    def update_position(self):
+        while self.writing and self.writing[0][0].done():
+            task, position = self.writing[0]
 
-        self.logger.debug(f"Checking config '{config_name}' with value '{value}': exact = {match_exact_value}, regex = {match_regex_value}")
+            # Lanes only report success if no messages failed until they finished
+            if not all(task.result()):
+                self.failed = True
+                return
 
-        if match_exact_value is not None and match_exact_value == value:
-            return True
+            self.writing.popleft()
+            self.position = position
 
-        if match_regex_value is not None and re.match(match_regex_value, value):
-            return True
+    async def write_lane(self, previous_task: asyncio.Future | None, contexts: list) -> bool:
+        if previous_task is not None and not await previous_task:
+            return False
 
-        return False
+        if self.failed:
+            return False
 
-    def get_with_fallback(self, option_name: str, default_value=None):
-        value = self.config_data.get(option_name)
-        if value is not None:
-            self.logger.debug(f"Config for '{option_name}' resolved: {value}")
-            return value
+        results = await asyncio.gather(*[self.write_output(output, contexts) for output in self.outputs])
 
-        # Fallback to global config
-        value = self.global_config.get(option_name)
-        if value is not None:
-            self.logger.debug(f"Config for '{option_name}' resolved to global config: {value}")
-            return value
+        previous_count = self.replayed_messages
+        self.replayed_messages += len(contexts)
 
-        self.logger.debug(f"Config for '{option_name}' resolved to default: {default_value}")
+        if self.replayed_messages // self.progress_interval != previous_count // self.progress_interval:
+            logging.log(LOG_LEVEL_INFO, f"Replayed {self.replayed_messages} messages")
 
-        return default_value
+        # Failures of buffered messages are reported to whichever lane flushes the output first, so any failure fails all lanes still writing
+        if not all(results):
+            self.failed = True
 
+        return not self.failed
 
-class MediaConfiguration:
-    def __init__(self, config: dict):
-        self.config = config
+    async def write_output(self, output: OutputWriter, contexts: list) -> bool:
+        delivered = True
 
-        self.rules = []
+        for context in contexts:
+            delivered = await output.delivery.write(context) and delivered
 
-        for index, rule in enumerate(config.get("rules", [])):
-            self.rules.append(MediaConfigurationRule(self.config, rule, index))
+        try:
+            await output.flush_pending()
+        except RejectedMessageError as exception:
+            # Just like for OutputDelivery, retrying rejected messages is pointless
+            logging.error(f"{output.name} rejected replayed messages: {exception}")
+        except Exception as exception:
+            logging.error(f"Unable to replay messages to {output.name}: {exception}")
+            delivered = False
 
-        # Add default match-all rule if there are no rules configured
-        if not self.rules:
-            self.rules.append(MediaConfigurationRule(self.config, {}, 0))
+        if not delivered:
+            self.failed = True
 
-    def get_rule(self, message, chat):
-        for rule in self.rules:
-            if rule.matches_message(message, chat):
-                rule.logger.debug("Rule matches")
-                return rule
-            else:
-                rule.logger.debug("Rule does not match")
+        return delivered
 
-        return None
 
+class CheckpointStore:
+    # Keeps the ID of the last imported message for each chat
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoints = read_json_file(path, {})
+
+    def get(self, chat_id: int) -> int | None:
+        return self.checkpoints.get(str(chat_id))
+
+    def set(self, chat_id: int, message_id: int):
+        if message_id > self.checkpoints.get(str(chat_id), 0):
+            self.checkpoints[str(chat_id)] = message_id
+
+    def save(self):
+        write_json_file(self.path, self.checkpoints)
+
+
+@dataclass
+class ChatCheckpoint:
+    # State of the checkpoint of a chat while importing its history
+    chat: object
+    failed_flushes: int
+    failed: bool = False
+
+
+# Priority of Telegram API requests made by the current task (see ApiRateLimiter)
+API_PRIORITY = contextvars.ContextVar("api_priority", default="live")
+
+
+class ApiRateLimiter:
+    # Requests of a higher priority (lower index) are sent first once the rate limit is reached
+    priorities = ["live", "backfill", "media"]
 
-class OutputWriter(ABC):
     def __init__(self, config: dict):
-        self.config: dict = config
+        self.max_rate = float(config.get("rate", 20))
+        self.min_rate = min(float(config.get("min_rate", 1)), self.max_rate)
+        self.bucket = TokenBucket(self.max_rate, float(config.get("burst", self.max_rate)))
 
-    @abstractmethod
-    async def write_message(self, message, translated_text: str | None, downloaded_media: DownloadedMedia):
-        pass
+        # The rate is halved for each FloodWait error and raised by this share of the configured rate for each successful request
+        self.recovery = float(config.get("recovery", 0.01))
 
-    async def get_message_dict(self, message, translated_text: str | None, downloaded_media: DownloadedMedia):
-        sender_user = await message.get_sender()
+        # Longer FloodWait errors are passed to the caller instead of waiting
+        self.max_flood_wait = float(config.get("max_flood_wait", 3600))
 
-        if sender_user is None:
-            sender = {
-                "username": "",
-                "firstName": "Deleted User",
-                "lastName": ""
-            }
-        elif isinstance(sender_user, Channel):
-            sender = {
-                "username": getattr(sender_user, "username", ""),
-                "firstName": getattr(sender_user, "title", ""),
-                "lastName": None
-            }
-        else:
-            sender = {
-                "username": getattr(sender_user, "username", ""),
-                "firstName": getattr(sender_user, "first_name", ""),
-                "lastName": getattr(sender_user, "last_name", "")
-            }
+        # FloodWait errors only pause requests of the priority which received them (e.g. a long wait for downloads does not stop live messages)
+        self.paused_until = {priority: 0 for priority in self.priorities}
+        self.waiters = {priority: deque() for priority in self.priorities}
+        self.waiter_added = asyncio.Event()
+        self.dispatch_task = None
 
-        output_map_config = self.config.get("output_map")
+        # Number of requests and total wait time per priority
+        self.wait_stats = {priority: [0, 0.0] for priority in self.priorities}
 
-        if output_map_config is None:
-            output_map_config = {
-                "id": "message.id",
-                "date": "message.date",
-                "sender": "sender",
-                "chat": "get_display_name(await message.get_chat())",
-                "message": "message.text",
-                "media": "media.filename if media else None"
-            }
+        METRICS.register("telegram_api_rate", "gauge", lambda: {(): self.bucket.rate})
 
-        return await eval_map(output_map_config, {
-            "message": message,
-            "sender": sender,
-            "get_display_name": get_display_name,
-            "translated_text": translated_text,
-            "media": downloaded_media
-        })
+    @staticmethod
+    @contextlib.contextmanager
+    def priority(priority: str):
+        # Requests made by the current task within this block use the given priority (tasks created meanwhile inherit it)
+        token = API_PRIORITY.set(priority)
 
+        try:
+            yield
+        finally:
+            API_PRIORITY.reset(token)
 
-class ChatType(Enum):
-    GROUP = "group"
-    CHANNEL = "channel"
-    BOT = "bot"
-    CONTACT = "contact"
-    USER = "user"
+    def install(self, client: TelegramClient):
+        # All requests of Telethon (including those for downloading files) are sent using _call()
+        client._call = self.wrap(client._call)
 
-    @classmethod
-    def get_from_chat(cls, chat):
-        if isinstance(chat, Chat):
-            if chat.deactivated:
-                return None
-            else:
-                return cls.GROUP
+        # FloodWait errors are handled by the rate limiter instead of sleeping within Telethon
+        client.flood_sleep_threshold = 0
 
-        if isinstance(chat, Channel):
-            if chat.megagroup:
-                return cls.GROUP
-            else:
-                return cls.CHANNEL
+    def wrap(self, call: callable):
+        async def limited_call(*args, **kwargs):
+            priority = API_PRIORITY.get()
 
-        if isinstance(chat, User):
-            if chat.bot:
-                return cls.BOT
+            while True:
+                await self.acquire(priority)
 
-            if chat.contact:
-                return cls.CONTACT
-            else:
-                return cls.USER
+                try:
+                    result = await call(*args, **kwargs)
+                except FloodWaitError as exception:
+                    if exception.seconds > self.max_flood_wait:
+                        raise
 
-        return None
+                    self.flood_wait(exception.seconds, priority)
+                    continue
 
+                self.record_success()
 
-class OutputHandler:
-    def __init__(self, media_config: dict, translate_to_lang: str = None):
-        self.outputs = []
-        self.imports = {}
-        self.media_config = MediaConfiguration(media_config)
-        self.translate_to_lang = translate_to_lang
+                return result
 
-    def add(self, config: dict):
-        output_type = config.get("type")
-        del config["type"]
+        return limited_call
 
-        if output_type not in self.imports:
-            self.imports[output_type] = importlib.import_module("output.{}".format(output_type))
+    async def acquire(self, priority: str):
+        start_time = time.perf_counter()
 
-        self.outputs.append(self.imports[output_type].Writer(config))
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(future)
+        self.waiter_added.set()
 
-    async def write_message(self, message, is_chat_enabled: callable):
-        # message might not be an actual message (i.e. MessageService)
-        if not isinstance(message, Message):
-            return
+        if self.dispatch_task is None or self.dispatch_task.done():
+            self.dispatch_task = asyncio.ensure_future(self.dispatch())
 
-        chat = await message.get_chat()
-        chat_display_name = get_display_name(chat)
+        await future
 
-        if not is_chat_enabled(chat):
-            chat_type = ChatType.get_from_chat(chat)
+        wait_time = time.perf_counter() - start_time
 
-            logging.debug("Skipping message {} from chat '{}' as chat type {} is not enabled".format(message.id, chat_display_name, chat_type.value if chat_type else None))
-            return
+        stats = self.wait_stats[priority]
+        stats[0] += 1
+        stats[1] += wait_time
 
-        if message.file:
-            downloaded_media = await self.download_media(message)
-        else:
-            downloaded_media = None
+        METRICS.observe("telegram_api_wait_seconds", wait_time, (("priority", priority),))
 
-        if self.translate_to_lang and message.text:
-            try:
-                translate_text_result: TranslateResult = await message.client(TranslateTextRequest(to_lang=self.translate_to_lang, peer=message.input_sender, id=[message.id]))
-                translated_text = translate_text_result.result[0].text
-            except BaseException as exception:
-                logging.error(f"Unable to translate text '{message.text}' using language '{self.translate_to_lang}': {exception}")
-                translated_text = None
-        else:
-            translated_text = None
+    def get_ready_priorities(self) -> list:
+        now = time.monotonic()
 
-        for output in self.outputs:
-            await output.write_message(message=message, translated_text=translated_text, downloaded_media=downloaded_media)
+        return [priority for priority in self.priorities if self.waiters[priority] and self.paused_until[priority] <= now]
 
-    async def download_media(self, message):
-        if message.file.name is None:
-            original_filename = f"msg{message.chat_id}-{message.id}"
-        else:
-            original_filename = Path(message.file.name).stem
+    async def dispatch(self):
+        while any(self.waiters.values()):
+            if not self.get_ready_priorities():
+                # Sleep until the first pause ends, unless a request of another priority arrives in the meantime
+                pause = min(self.paused_until[priority] for priority in self.priorities if self.waiters[priority]) - time.monotonic()
 
-        full_original_filename = f"{original_filename}{message.file.ext}"
+                self.waiter_added.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.waiter_added.wait(), max(0.0, pause))
 
-        config_rule = self.media_config.get_rule(message, await message.get_chat())
-        if config_rule is None:
-            logging.debug(f"Skipping media download for '{full_original_filename}' as no config rule matches (mime_type: {message.file.mime_type})")
-            return None
+                continue
 
-        download_path = config_rule.get_download_path()
-        if download_path is None:
-            logging.debug(f"Skipping media download for '{full_original_filename}' as no download path has been configured")
-            return None
+            await self.bucket.consume(1)
 
-        download_path = Path(download_path).expanduser()
+            # The token goes to the request with the highest priority which is waiting (and not paused) at the time the token is available
+            for priority in self.get_ready_priorities():
+                future = self.grant(self.waiters[priority])
 
-        filename_pattern_map = {
-            "date": {
-                "year": message.date.year,
-                "month": str(message.date.month).rjust(2, "0"),
-                "day": str(message.date.day).rjust(2, "0"),
-                "hour": str(message.date.hour).rjust(2, "0"),
-                "minute": str(message.date.minute).rjust(2, "0"),
-                "second": str(message.date.second).rjust(2, "0")
-            },
-            "file": {
-                "name": original_filename,
-                "ext": message.file.ext.strip(".")
-            },
-            "message": {
-                "id": message.id,
-                "chat_id": message.chat_id
-            }
-        }
+                if future is not None:
+                    break
 
-        filename = config_rule.get_filepattern().format_map(filename_pattern_map)
-        filepath = download_path.joinpath(filename)
-        file_size_string = FileSize.bytes_to_human_readable(message.file.size)
+    @staticmethod
+    def grant(waiters: deque):
+        while waiters:
+            future = waiters.popleft()
 
-        logging.debug(f"Downloading media file '{full_original_filename}' to {filepath} ({file_size_string})")
-        filepath.parent.mkdir(parents=True, exist_ok=True)
-        await message.download_media(file=filepath)
+            if not future.done():
+                future.set_result(None)
+                return future
+
+        return None
+
+    def set_rate(self, rate: float):
+        # Tokens accumulated so far are based on the previous rate
+        self.bucket.refill()
+        self.bucket.rate = rate
+
+    def flood_wait(self, seconds: int, priority: str = "live"):
+        self.paused_until[priority] = max(self.paused_until[priority], time.monotonic() + seconds)
+        self.set_rate(max(self.min_rate, self.bucket.rate / 2))
+
+        METRICS.count("telegram_flood_waits_total", (("priority", priority),))
+        logging.warning(f"Telegram requested to wait {seconds} seconds (FloodWait) for {priority} requests, reduced request rate to {self.bucket.rate:.1f} requests per second")
+
+    def record_success(self):
+        if self.bucket.rate < self.max_rate:
+            self.set_rate(min(self.max_rate, self.bucket.rate + self.max_rate * self.recovery))
 
-        return DownloadedMedia(filepath=filepath, filename=filename)
+    def format_stats(self):
+        return ", ".join(f"{priority}: {count} requests waited {total:.1f}s" for priority, (count, total) in self.wait_stats.items() if count)
 
 
 class TelegramReader:
-    def __init__(self, config: dict, output_handler: OutputHandler):
-        self.client = TelegramClient(session=os.path.expanduser(config.get("session_file")), api_id=config.get("api_id"), api_hash=config.get("api_hash"))
+    def __init__(self, config: dict, output_handler: OutputHandler, client: TelegramClient = None):
+        if client is None:
+            client = TelegramClient(session=os.path.expanduser(config.get("session_file")), api_id=config.get("api_id"), api_hash=config.get("api_hash"))
+
+        self.client = client
         self.output_handler = output_handler
+
+        # Shared by all requests sent using the client (reading messages, resolving chats, translations and media downloads)
+        rate_limit_config = config.get("rate_limit")
+        self.rate_limiter = ApiRateLimiter(rate_limit_config if isinstance(rate_limit_config, dict) else {}) if rate_limit_config else None
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.install(self.client)
+
+        checkpoint_file = config.get("checkpoint_file")
+        if checkpoint_file is None and config.get("session_file") is not None:
+            checkpoint_file = f"{config.get('session_file')}.checkpoints.json"
+
+        self.checkpoints = CheckpointStore(os.path.expanduser(checkpoint_file)) if checkpoint_file else None
         self.additional_chats = config.get("additional_chats", [])
         self.chat_types = config.get("chat_types", [])
 
-    async def import_history(self, start_date: datetime = None, chats=None):
+        # Number of messages handed over to the output handler at once while importing and interval for logging the progress
+        self.page_size = 100
+        self.progress_interval = 1000
+
+    async def import_history(self, start_date: datetime = None, chats=None, parallel: int = 1, full: bool = False):
+        # All requests of the import (including those made by the pipeline for the imported messages) use the backfill priority
+        with ApiRateLimiter.priority("backfill"):
+            self.output_handler.set_report_errors(True)
+
+            try:
+                await self.import_chats(start_date, chats, parallel, full)
+            finally:
+                self.output_handler.set_report_errors(False)
+
+        logging.log(LOG_LEVEL_INFO, "Import finished")
+
+        if self.rate_limiter is not None and self.rate_limiter.format_stats():
+            logging.log(LOG_LEVEL_INFO, f"Telegram API rate limiter: {self.rate_limiter.format_stats()}")
+
+    async def import_chats(self, start_date: datetime, chats, parallel: int, full: bool):
         if chats:
             chats = await self.client.get_entity(TelegramReader.prepare_chats(chats))
         else:
             chats = await self.get_chats()
 
-        for chat in chats:
-            display_name = get_display_name(chat)
+        # Limits the number of chats imported at the same time
+        semaphore = asyncio.Semaphore(max(1, parallel))
 
-            if start_date:
-                logging.log(LOG_LEVEL_INFO, "Importing history for chat '{}' starting at {}".format(display_name, start_date.strftime("%c")))
-            else:
-                logging.log(LOG_LEVEL_INFO, "Importing full history for chat '{}'".format(display_name))
+        async def import_chat(chat):
+            async with semaphore:
+                await self.import_chat_history(chat, start_date, full)
 
-            async for message in self.client.iter_messages(chat, offset_date=start_date, reverse=True):
-                await self.output_handler.write_message(message, self.is_chat_enabled)
+        await asyncio.gather(*[import_chat(chat) for chat in chats])
 
-        logging.log(LOG_LEVEL_INFO, "Import finished")
+        await self.output_handler.join()
+
+    async def import_chat_history(self, chat, start_date: datetime = None, full: bool = False):
+        display_name = get_display_name(chat)
+
+        # Continue after the last imported message unless a full re-scan is requested
+        min_id = None if full or self.checkpoints is None else self.checkpoints.get(get_peer_id(chat))
+
+        if min_id:
+            logging.log(LOG_LEVEL_INFO, f"Importing history for chat '{display_name}' after message {min_id}")
+        elif start_date:
+            logging.log(LOG_LEVEL_INFO, "Importing history for chat '{}' starting at {}".format(display_name, start_date.strftime("%c")))
+        else:
+            logging.log(LOG_LEVEL_INFO, "Importing full history for chat '{}'".format(display_name))
+
+        # Fetch the next page of messages while the current one is still being written
+        pages = asyncio.Queue(1)
+        fetch_task = asyncio.ensure_future(self.fetch_message_pages(chat, start_date, min_id or 0, pages))
+
+        imported_messages = 0
+
+        # Futures of the messages submitted since the last checkpoint, resolved once the outputs handled them
+        written = []
+
+        # Once a message could not be written, later checkpoints would skip it, so no further checkpoint is stored for this chat
+        checkpoint = ChatCheckpoint(chat, self.output_handler.failed_flushes)
+
+        try:
+            while (page := await pages.get()) is not None:
+                if isinstance(page, Exception):
+                    raise page
+
+                for message in page:
+                    written.append(await self.output_handler.submit(message, self.is_chat_enabled))
+
+                imported_messages += len(page)
+
+                if imported_messages % self.progress_interval < len(page):
+                    logging.log(LOG_LEVEL_INFO, f"Imported {imported_messages} messages for chat '{display_name}' (up to {page[-1].date.strftime('%c')})")
+
+                    await self.save_checkpoint(checkpoint, page[-1].id, written)
+                    written = []
+
+                last_message_id = page[-1].id
+        finally:
+            fetch_task.cancel()
+
+        if imported_messages:
+            await self.save_checkpoint(checkpoint, last_message_id, written)
+
+        logging.log(LOG_LEVEL_INFO, f"Finished importing {imported_messages} messages for chat '{display_name}'")
+
+    async def save_checkpoint(self, checkpoint: ChatCheckpoint, message_id: int, written: list):
+        if self.checkpoints is None or checkpoint.failed:
+            return
+
+        # Only store the checkpoint once the outputs confirmed that all messages of the chat submitted so far have been written
+        delivered = all(await asyncio.gather(*written))
+        delivered = await self.output_handler.flush_pending() and delivered
+
+        # Buffered messages of this chat might have failed while flushing for another chat
+        if not delivered or self.output_handler.failed_flushes != checkpoint.failed_flushes:
+            logging.warning(f"Not all messages of chat '{get_display_name(checkpoint.chat)}' up to message {message_id} have been written, not storing any further checkpoint for it")
+            checkpoint.failed = True
+            return
+
+        self.checkpoints.set(get_peer_id(checkpoint.chat), message_id)
+        self.checkpoints.save()
+
+    async def fetch_message_pages(self, chat, start_date: datetime, min_id: int, pages: asyncio.Queue):
+        page = []
+
+        try:
+            async for message in self.client.iter_messages(chat, offset_date=start_date, min_id=min_id, reverse=True):
+                page.append(message)
+
+                if len(page) >= self.page_size:
+                    await pages.put(page)
+                    page = []
+        except Exception as exception:
+            # Pass the exception to the consumer
+            await pages.put(exception)
+            return
+
+        if page:
+            await pages.put(page)
+
+        await pages.put(None)
 
     async def list_chats(self, types):
         for chat in await self.get_chats(types):
@@ -528,9 +3182,12 @@ class TelegramReader:
         logging.log(LOG_LEVEL_INFO, "Listening for events")
 
         @self.client.on(events.NewMessage())
-        @self.client.on(events.MessageEdited())
         async def handler(event):
-            await self.output_handler.write_message(event.message, self.is_chat_enabled)
+            await self.output_handler.submit(event.message, self.is_chat_enabled)
+
+        @self.client.on(events.MessageEdited())
+        async def edit_handler(event):
+            await self.output_handler.submit(event.message, self.is_chat_enabled, is_edit=True)
 
         await self.client.catch_up()
 
@@ -557,7 +3214,7 @@ class TelegramReader:
             start_date = None
             if time_range:
                 start_date = datetime.now() - time_range.timedelta()
-            await self.import_history(start_date)
+            await self.import_history(start_date, parallel=int(config.get("parallel", 1)), full=bool(config.get("full_rescan", False)))
 
             logging.log(LOG_LEVEL_INFO, f"Periodic import completed, next periodic import at {datetime.now() + interval.timedelta()}")
 
@@ -570,7 +3227,8 @@ class TelegramReader:
         if chat_types is None:
             chat_types = self.chat_types
 
-        chat_type = ChatType.get_from_chat(chat)
+        # Either an entity or the cached EntityInfo of a chat
+        chat_type = chat.chat_type if isinstance(chat, EntityInfo) else ChatType.get_from_chat(chat)
         if chat_type is None:
             return False
 
@@ -580,6 +3238,9 @@ class TelegramReader:
         chats = []
 
         for dialog in await self.client.get_dialogs():
+            # The dialogs contain all chat entities, so the cache can be filled without further requests
+            self.output_handler.entity_cache.add(dialog.entity)
+
             if self.is_chat_enabled(dialog.entity, chat_types):
                 chats.append(dialog.entity)
 
@@ -616,6 +3277,20 @@ def main():
     import_history_command = sub_command_parser.add_parser("import-history")
     import_history_command.add_argument("start_date", nargs="?", help="the start date at which to start importing (in format YYYY-MM-DD)")
     import_history_command.add_argument("--chats", nargs="*", help="only import the given chats (use list-chats to get IDs)")
+    import_history_command.add_argument("--parallel", type=int, default=1, help="number of chats to import at the same time (default: 1)")
+    import_history_command.add_argument("--full", action="store_true", help="import all messages instead of continuing after the last imported message of each chat")
+
+    import_export_command = sub_command_parser.add_parser("import-export")
+    import_export_command.add_argument("path", help="path to the result.json of a Telegram Desktop export (JSON format) or the directory containing it")
+    import_export_command.add_argument("--chats", nargs="*", help="only import the given chats (IDs as found in the export)")
+
+    replay_command = sub_command_parser.add_parser("replay")
+    replay_command.add_argument("paths", nargs="+", help="files written by the file output (rotated and compressed files included) or directories containing them")
+    replay_command.add_argument("--outputs", nargs="*", type=int, help="only write to the given outputs (index in the config, starting at 0)")
+    replay_command.add_argument("--resume", type=Replayer.parse_resume, metavar="PATH:OFFSET", help="skip the files before PATH and start at OFFSET of it (as logged by a previous replay)")
+    replay_command.add_argument("--batch-size", type=int, default=1000, help="number of lines parsed and written per batch (default: 1000)")
+    replay_command.add_argument("--parallel", type=int, default=4, help="number of lanes writing at the same time, messages of the same chat are written by the same lane in order (default: 4)")
+    replay_command.add_argument("--workers", type=int, help="number of processes parsing the lines (default: number of CPUs, 0 to parse in the main process)")
 
     list_chats_command = sub_command_parser.add_parser("list-chats")
     list_chats_command.add_argument("--types", nargs="*", choices=["contact", "user", "group", "channel"], help="list the given chat types instead of those from the config file")
@@ -632,22 +3307,69 @@ def main():
         logging.error("Unable to parse config file '{}'".format(arguments.config))
         exit(1)
 
-    output_handler = OutputHandler(media_config=config.get("media", {}), translate_to_lang=config.get("translate_to_lang"))
+    output_handler = OutputHandler(media_config=config.get("media", {}), translate_to_lang=config.get("translate_to_lang"), pipeline_config=config.get("pipeline"), translation_config=config.get("translation"), entity_cache_config=config.get("entity_cache"))
 
     for output in config.get("outputs", []):
         output_handler.add(output)
 
+    if arguments.command == "import-export":
+        # Reading an export does not require a connection to Telegram
+        async def import_export():
+            try:
+                await output_handler.start_import()
+                await ExportImporter(output_handler).import_export(arguments.path, arguments.chats)
+            finally:
+                await output_handler.close()
+
+        asyncio.run(import_export())
+        return
+
+    if arguments.command == "replay":
+        if arguments.outputs:
+            if any(index not in range(len(output_handler.outputs)) for index in arguments.outputs):
+                raise RuntimeError(f"Invalid output index (expected 0 to {len(output_handler.outputs) - 1})")
+
+            outputs = [output_handler.outputs[index] for index in arguments.outputs]
+        else:
+            outputs = output_handler.outputs
+
+        async def replay():
+            try:
+                await asyncio.gather(*[output.start_import() for output in outputs])
+                await Replayer(outputs, arguments.batch_size, arguments.parallel, arguments.workers).replay(arguments.paths, arguments.resume)
+            finally:
+                await output_handler.close()
+
+        asyncio.run(replay())
+        return
+
     telegram_reader = TelegramReader(config.get("telegram", {}), output_handler)
 
+    metrics_config = config.get("metrics")
+    metrics_server = MetricsServer(metrics_config) if metrics_config and arguments.command in ["import-history", "listen"] else None
+
     with telegram_reader.client:
         loop = telegram_reader.client.loop
 
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.start())
+
+        if arguments.command in ["import-history", "listen"]:
+            loop.call_soon(output_handler.start)
+
         if arguments.command == "import-history":
             start_date = arguments.start_date
             if start_date:
                 start_date = datetime.strptime(start_date, "%Y-%m-%d")
 
-            loop.run_until_complete(telegram_reader.import_history(start_date, arguments.chats))
+            try:
+                loop.run_until_complete(output_handler.start_import())
+                loop.run_until_complete(telegram_reader.import_history(start_date, arguments.chats, arguments.parallel, arguments.full))
+            finally:
+                loop.run_until_complete(output_handler.close())
+
+                if metrics_server is not None:
+                    loop.run_until_complete(metrics_server.close())
         elif arguments.command == "list-chats":
             loop.run_until_complete(telegram_reader.list_chats(arguments.types))
         elif arguments.command == "listen":
@@ -661,6 +3383,11 @@ def main():
                 loop.run_forever()
             except KeyboardInterrupt:
                 pass
+            finally:
+                loop.run_until_complete(output_handler.close())
+
+                if metrics_server is not None:
+                    loop.run_until_complete(metrics_server.close())
 
 
 if __name__ == "__main__":
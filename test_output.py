@@ -0,0 +1,603 @@
+import asyncio
+import gzip
+import json
+import lzma
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from telegram2elastic import MessageContext, RejectedMessageError
+
+
+def create_context(message_id: int, text: str = "hello", is_edit: bool = False):
+    message = SimpleNamespace(id=message_id, chat_id=1, date=datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc), edit_date=datetime(2026, 1, 2, 4, 0, tzinfo=timezone.utc) if is_edit else None, text=text)
+
+    context = MessageContext(message=message, chat=None, sender=MessageContext.get_sender_dict(None), translated_text=None, downloaded_media=None, is_edit=is_edit)
+    context.media_changed = False
+
+    return context
+
+
+class ElasticsearchStub(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.send_json({})
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, b""))
+
+        # Canned responses by path (e.g. index settings)
+        self.send_json(next((data for path, data in self.server.responses.items() if path in self.path), {}))
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.command, self.path, body))
+
+        if self.path.startswith("/_bulk"):
+            self.send_json(self.get_bulk_response(body))
+        else:
+            self.send_json({"result": "created"})
+
+    def get_bulk_response(self, body: bytes):
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+
+        for action in lines[0::2]:
+            operation, metadata = next(iter(action.items()))
+            doc_id = str(metadata.get("_id"))
+
+            if doc_id in self.server.reject_ids:
+                items.append({operation: {"_index": metadata.get("_index"), "_id": doc_id, "status": 400, "error": {"type": "mapper_parsing_exception"}}})
+            elif self.server.throttle_ids.get(doc_id, 0) > 0:
+                self.server.throttle_ids[doc_id] -= 1
+                items.append({operation: {"_index": metadata.get("_index"), "_id": doc_id, "status": 429, "error": {"type": "es_rejected_execution_exception"}}})
+            else:
+                items.append({operation: {"_index": metadata.get("_index"), "_id": doc_id, "status": 201, "result": "created"}})
+
+        return {"took": 1, "errors": any("error" in next(iter(item.values())) for item in items), "items": items}
+
+    def send_json(self, data: dict):
+        body = json.dumps(data).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def elasticsearch_stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ElasticsearchStub)
+    server.requests = []
+    server.reject_ids = set()
+    server.throttle_ids = {}
+    server.responses = {}
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def get_bulk_documents(server):
+    documents = []
+
+    for command, path, body in server.requests:
+        if path.startswith("/_bulk"):
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            documents.append([str(action["index"]["_id"]) for action in lines[0::2]])
+
+    return documents
+
+
+class TestElasticsearchBulk:
+    @pytest.mark.parametrize("version", [8, 9])
+    def test_flush_on_document_count(self, elasticsearch_stub, version):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "version": version, "output_map": {"message": "message.text"}, "bulk": {"max_documents": 2, "max_linger": 60}})
+
+        async def write():
+            for message_id in range(5):
+                await writer.write_message(create_context(message_id))
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        assert get_bulk_documents(elasticsearch_stub) == [["0", "1"], ["2", "3"], ["4"]]
+
+    def test_flush_on_linger_time(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "bulk": {"max_linger": 0.05}})
+
+        async def write():
+            await writer.write_message(create_context(1))
+            await asyncio.sleep(0.5)
+
+            assert get_bulk_documents(elasticsearch_stub) == [["1"]]
+
+        asyncio.run(write())
+
+    def test_retry_failed_items(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        elasticsearch_stub.reject_ids.add("2")
+        elasticsearch_stub.throttle_ids["3"] = 1
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "bulk": {"retry_delay": 0}})
+        writer.report_errors = True
+
+        async def write():
+            for message_id in range(1, 4):
+                await writer.write_message(create_context(message_id))
+
+            # Rejected messages are identified by chat and message ID
+            with pytest.raises(RejectedMessageError) as exception_info:
+                await writer.flush_pending()
+
+            assert exception_info.value.message_keys == [(1, 2)]
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        # The rejected document is not retried, the throttled one is sent again on its own
+        assert get_bulk_documents(elasticsearch_stub) == [["1", "2", "3"], ["3"]]
+
+
+    def test_cancelled_flush(self):
+        from output.elasticsearch import BulkIndexer
+
+        batches = []
+
+        async def send_bulk(operations):
+            await asyncio.sleep(0.1)
+            batches.append([operation["index"]["_id"] for operation in operations[0::2]])
+
+            return {"errors": False}
+
+        bulk_indexer = BulkIndexer(send_bulk, {"max_documents": 2, "max_linger": 60})
+
+        async def write():
+            await bulk_indexer.add("telegram", 1, {})
+
+            # The timeout of the delivery cancels the write while the batch is being sent
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(bulk_indexer.add("telegram", 2, {}), 0.01)
+
+            await bulk_indexer.flush()
+
+        asyncio.run(write())
+
+        assert batches == [[1, 2]]
+
+
+class TestElasticsearchAsync:
+    @pytest.mark.parametrize("version", [8, 9])
+    def test_index(self, elasticsearch_stub, version):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "version": version, "async": True, "max_in_flight": 2})
+
+        async def write():
+            for message_id in range(5):
+                await writer.write_message(create_context(message_id))
+
+                assert len(writer.pending_requests) <= 2
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        assert sorted(path for command, path, body in elasticsearch_stub.requests) == [f"/telegram-2026.01.02/_doc/{message_id}" for message_id in range(5)]
+
+    def test_bulk(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "async": True, "bulk": {"max_documents": 3}})
+
+        async def write():
+            for message_id in range(4):
+                await writer.write_message(create_context(message_id))
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        assert get_bulk_documents(elasticsearch_stub) == [["0", "1", "2"], ["3"]]
+
+
+class TestElasticsearchEdits:
+    def test_bulk_update(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "bulk": True})
+
+        async def write():
+            await writer.write_message(create_context(1))
+            await writer.write_message(create_context(1, "edited", is_edit=True))
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        _, _, body = elasticsearch_stub.requests[0]
+        lines = [json.loads(line) for line in body.splitlines()]
+
+        assert lines[2] == {"update": {"_index": "telegram-2026.01.02", "_id": 1}}
+        assert lines[3] == {"doc": {"message": "edited", "edit_date": "2026-01-02T04:00:00+00:00", "timestamp": "2026-01-02T03:04:05+00:00"}, "doc_as_upsert": True}
+
+    def test_update(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}"})
+
+        async def write():
+            await writer.write_message(create_context(1, "edited", is_edit=True))
+            await writer.close()
+
+        asyncio.run(write())
+
+        command, path, body = elasticsearch_stub.requests[0]
+
+        assert path == "/telegram-2026.01.02/_update/1"
+        assert json.loads(body)["doc"]["message"] == "edited"
+
+
+class TestElasticsearchImport:
+    def test_import_settings(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        config = {
+            "host": f"http://127.0.0.1:{elasticsearch_stub.server_port}",
+            "bulk": True,
+            "index_template": {"name": "telegram", "mappings": {"message": "text", "sender.id": "long"}, "settings": {"number_of_replicas": 1}},
+            "import": {"number_of_replicas": 0}
+        }
+
+        writer = Writer(config)
+
+        elasticsearch_stub.responses["/_settings"] = {"telegram-2026.01.01": {"settings": {"index.refresh_interval": "30s", "index.number_of_replicas": "2"}}}
+
+        async def run():
+            await writer.start_import()
+
+            await writer.write_message(create_context(1))
+
+            # The index of the written message got created while importing
+            elasticsearch_stub.responses["/_settings"] = {"telegram-2026.01.01": {}, "telegram-2026.01.02": {}}
+
+            await writer.close()
+
+        asyncio.run(run())
+
+        requests = [(command, path.split("?")[0], json.loads(body) if body and not path.startswith("/_bulk") else None) for command, path, body in elasticsearch_stub.requests]
+
+        import_settings = {"index.refresh_interval": "-1", "index.number_of_replicas": 0}
+        mappings = {"properties": {"timestamp": {"type": "date"}, "message": {"type": "text"}, "sender": {"properties": {"id": {"type": "long"}}}}}
+
+        assert requests == [
+            ("GET", "/telegram-*/_settings/index.refresh_interval,index.number_of_replicas", None),
+            ("PUT", "/_index_template/telegram", {"index_patterns": ["telegram-*"], "priority": 100, "template": {"settings": {"index.number_of_replicas": 1, **import_settings}, "mappings": mappings}}),
+            ("PUT", "/telegram-2026.01.01/_settings", import_settings),
+            ("PUT", "/_bulk", None),
+            ("PUT", "/_index_template/telegram", {"index_patterns": ["telegram-*"], "priority": 100, "template": {"settings": {"index.number_of_replicas": 1}, "mappings": mappings}}),
+            ("GET", "/telegram-*/_settings/index.refresh_interval,index.number_of_replicas", None),
+            ("PUT", "/telegram-2026.01.01/_settings", {"index.refresh_interval": "30s", "index.number_of_replicas": "2"}),
+            ("PUT", "/telegram-2026.01.02/_settings", {"index.refresh_interval": None, "index.number_of_replicas": 1})
+        ]
+
+    def test_data_stream(self, elasticsearch_stub):
+        from output.elasticsearch import Writer
+
+        writer = Writer({"host": f"http://127.0.0.1:{elasticsearch_stub.server_port}", "index_format": "telegram", "data_stream": True, "bulk": True})
+
+        async def write():
+            for message_id in range(2):
+                await writer.write_message(create_context(message_id))
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        command, path, body = elasticsearch_stub.requests[0]
+
+        assert path == "/_index_template/telegram2elastic"
+        assert json.loads(body)["data_stream"] == {}
+        assert json.loads(body)["index_patterns"] == ["telegram"]
+
+        _, _, body = elasticsearch_stub.requests[1]
+        lines = [json.loads(line) for line in body.splitlines()]
+
+        assert lines[0] == {"create": {"_index": "telegram", "_id": 0}}
+        assert lines[1]["@timestamp"] == "2026-01-02T03:04:05+00:00"
+        assert writer.index_cache == {(2026, 1, 2, timedelta(0)): "telegram"}
+
+
+class RedisStub:
+    # Minimal in-process server speaking the Redis protocol for the commands used by the Redis output
+    def __init__(self):
+        self.lists = {}
+        self.streams = {}
+        self.commands = []
+        self.server = None
+
+        # Number of commands which fail before commands are executed again
+        self.failures = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, "127.0.0.1", 0)
+
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def read_command(self, reader):
+        header = await reader.readline()
+        if not header:
+            return None
+
+        arguments = []
+
+        for _ in range(int(header[1:])):
+            length = int((await reader.readline())[1:])
+            arguments.append((await reader.readexactly(length + 2))[:-2])
+
+        return arguments
+
+    async def handle_client(self, reader, writer):
+        while (arguments := await self.read_command(reader)) is not None:
+            command = arguments[0].decode().upper()
+            key = arguments[1].decode() if len(arguments) > 1 else None
+
+            self.commands.append(command)
+
+            if self.failures:
+                self.failures -= 1
+                writer.write(b"-ERR unavailable\r\n")
+            elif command == "RPUSH":
+                self.lists.setdefault(key, []).extend(arguments[2:])
+                writer.write(f":{len(self.lists[key])}\r\n".encode())
+            elif command == "LTRIM":
+                start, end = int(arguments[2]), int(arguments[3])
+                self.lists[key] = self.lists[key][start:] if end == -1 else self.lists[key][start:end + 1]
+                writer.write(b"+OK\r\n")
+            elif command == "XADD":
+                entries = self.streams.setdefault(key, [])
+                fields = arguments[arguments.index(b"*") + 1:]
+                entries.append(dict(zip(fields[0::2], fields[1::2])))
+                entry_id = f"{len(entries)}-0"
+                writer.write(f"${len(entry_id)}\r\n{entry_id}\r\n".encode())
+            else:
+                writer.write(b"+OK\r\n")
+
+            await writer.drain()
+
+        writer.close()
+
+
+class TestRedis:
+    def run_writer(self, config: dict, message_count: int, before_close: callable = None):
+        from output.redis import Writer
+
+        stub = RedisStub()
+
+        async def write():
+            port = await stub.start()
+
+            writer = Writer({"host": "127.0.0.1", "port": port, "key": "telegram", "output_map": {"id": "message.id"}, **config})
+
+            for message_id in range(message_count):
+                await writer.write_message(create_context(message_id))
+
+            if before_close is not None:
+                await before_close(stub)
+
+            await writer.close()
+            await stub.stop()
+
+        asyncio.run(write())
+
+        return stub
+
+    def test_batched_rpush(self):
+        stub = self.run_writer({"batch": {"max_messages": 2, "max_linger": 60}, "max_length": 4}, 5)
+
+        assert stub.commands == ["RPUSH", "LTRIM", "RPUSH", "LTRIM", "RPUSH", "LTRIM"]
+        assert stub.lists["telegram"] == [b'{"id": 1}', b'{"id": 2}', b'{"id": 3}', b'{"id": 4}']
+
+    def test_flush_on_linger_time(self):
+        async def before_close(stub):
+            await asyncio.sleep(0.3)
+
+            assert len(stub.lists["telegram"]) == 3
+
+        self.run_writer({"batch": {"max_linger": 0.05}}, 3, before_close)
+
+    def test_retry_failed_batch(self):
+        async def before_close(stub):
+            stub.failures = 2
+
+        stub = self.run_writer({"batch": {"max_messages": 2, "max_linger": 60, "retry_delay": 0}}, 3, before_close)
+
+        # The first batch has been written before, the last one on close after two failed attempts
+        assert stub.commands == ["RPUSH", "RPUSH", "RPUSH", "RPUSH"]
+        assert stub.lists["telegram"] == [b'{"id": 0}', b'{"id": 1}', b'{"id": 2}']
+
+    def test_stream(self):
+        stub = self.run_writer({"stream": True}, 2)
+
+        assert stub.commands == ["XADD", "XADD"]
+        assert stub.streams["telegram"] == [{b"message": b'{"id": 0}'}, {b"message": b'{"id": 1}'}]
+
+
+class TestTcp:
+    class LineCollector:
+        def __init__(self):
+            self.lines = []
+            self.server = None
+
+        async def start(self, port: int = 0):
+            self.server = await asyncio.start_server(self.handle_client, "127.0.0.1", port)
+
+            return self.server.sockets[0].getsockname()[1]
+
+        async def stop(self):
+            self.server.close()
+            await self.server.wait_closed()
+
+        async def handle_client(self, reader, writer):
+            while line := await reader.readline():
+                self.lines.append(json.loads(line)["id"])
+
+    @staticmethod
+    def get_free_port():
+        import socket
+
+        with socket.socket() as free_socket:
+            free_socket.bind(("127.0.0.1", 0))
+            return free_socket.getsockname()[1]
+
+    def create_writer(self, port: int, **config):
+        from output.tcp import Writer
+
+        return Writer({"host": "127.0.0.1", "port": port, "output_map": {"id": "message.id"}, "reconnect_delay": 0.05, **config})
+
+    def test_reconnect(self):
+        collector = self.LineCollector()
+        port = self.get_free_port()
+
+        async def write():
+            writer = self.create_writer(port)
+
+            # Nothing is listening yet, writing must not block
+            for message_id in range(3):
+                await writer.write_message(create_context(message_id))
+
+            await collector.start(port)
+            await writer.close()
+            await asyncio.sleep(0.05)
+            await collector.stop()
+
+        asyncio.run(write())
+
+        assert collector.lines == [0, 1, 2]
+
+    def test_drop_oldest(self):
+        async def write():
+            writer = self.create_writer(self.get_free_port(), buffer_size=2, overflow="drop_oldest", close_timeout=0.1)
+
+            for message_id in range(5):
+                await writer.write_message(create_context(message_id))
+
+            buffered_ids = [json.loads(line)["id"] for line in writer.sending_lines + list(writer.buffer)]
+            await writer.close()
+
+            return buffered_ids
+
+        # One line has already been taken by the sender, only the newest lines are kept in the buffer
+        assert asyncio.run(write())[-2:] == [3, 4]
+
+    def test_spill(self, tmp_path):
+        spill_path = tmp_path / "spill.ndjson"
+        port = self.get_free_port()
+        collector = self.LineCollector()
+
+        async def write_offline():
+            writer = self.create_writer(port, buffer_size=2, overflow="spill", spill_path=str(spill_path), close_timeout=0.1)
+
+            for message_id in range(5):
+                await writer.write_message(create_context(message_id))
+
+            await writer.close()
+
+        async def write_online():
+            await collector.start(port)
+
+            # Spilled lines are sent once the writer is started, even without further messages
+            writer = self.create_writer(port, buffer_size=2, overflow="spill", spill_path=str(spill_path))
+            writer.start()
+            await asyncio.wait_for(writer.wait_drained(), 5)
+
+            await writer.write_message(create_context(5))
+            await writer.close()
+
+            await asyncio.sleep(0.05)
+            await collector.stop()
+
+        asyncio.run(write_offline())
+
+        assert [json.loads(line)["id"] for line in spill_path.read_bytes().splitlines()] == [0, 1, 2, 3, 4]
+
+        asyncio.run(write_online())
+
+        assert collector.lines == [0, 1, 2, 3, 4, 5]
+
+
+class TestFile:
+    def write_messages(self, config: dict, message_ids):
+        from output.file import Writer
+
+        writer = Writer({"output_map": {"id": "message.id"}, **config})
+
+        async def write():
+            for message_id in message_ids:
+                await writer.write_message(create_context(message_id))
+
+            await writer.close()
+
+        asyncio.run(write())
+
+    def test_buffered_write(self, tmp_path):
+        from output.file import Writer
+
+        path = tmp_path / "messages.log"
+        writer = Writer({"path": str(path), "output_map": {"id": "message.id"}, "flush_interval": 60})
+
+        async def write():
+            await writer.write_message(create_context(1))
+
+            # Still in the buffer
+            assert path.read_bytes() == b""
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        assert path.read_bytes() == b'{"id": 1}\n'
+
+    def test_size_rotation(self, tmp_path):
+        path = tmp_path / "messages.log"
+
+        self.write_messages({"path": str(path), "max_size": "20", "compress_rotated": "gzip"}, range(5))
+
+        rotated_files = sorted(tmp_path.glob("messages.log.*.gz"))
+        rotated_lines = [gzip.decompress(rotated_file.read_bytes()) for rotated_file in rotated_files]
+
+        assert rotated_lines == [b'{"id": 0}\n{"id": 1}\n', b'{"id": 2}\n{"id": 3}\n']
+        assert path.read_bytes() == b'{"id": 4}\n'
+
+    def test_time_pattern_and_compression(self, tmp_path):
+        self.write_messages({"path": str(tmp_path / "%Y" / "messages.log.xz"), "compression": "lzma"}, range(2))
+        self.write_messages({"path": str(tmp_path / "%Y" / "messages.log.xz"), "compression": "lzma"}, range(2, 3))
+
+        path = tmp_path / datetime.now().strftime("%Y") / "messages.log.xz"
+
+        assert lzma.decompress(path.read_bytes()) == b'{"id": 0}\n{"id": 1}\n{"id": 2}\n'
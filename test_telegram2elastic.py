@@ -1,6 +1,19 @@
+import asyncio
+import gzip
+import io
+import os
+import random
+import re
+import time
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
 import pytest
+from telethon.errors import FloodWaitError
+from telethon.tl.types import User, ChatForbidden, MessageMediaPhoto, MessageMediaDocument
 
-from telegram2elastic import FileSize, DottedPathDict, TimeInterval
+from telegram2elastic import FileSize, DottedPathDict, TimeInterval, OutputMap, MessageContext, Pipeline, TelegramReader, MediaDownloader, DownloadedMedia, Translator, EntityCache, MediaConfiguration, KeyedExecutor, Metrics, MetricsServer, METRICS, OutputWriter, OutputSpool, RejectedMessageError, OutputDelivery, OutputHandler, ApiRateLimiter, API_PRIORITY, JsonStreamReader, TelegramExport, ExportImporter, Replayer
 
 
 class TestFileSize:
@@ -51,3 +64,1177 @@ class TestTimeInterval:
         assert TimeInterval(60*60*24).format_human_readable() == "1 day"
         assert TimeInterval(60*60*24*2).format_human_readable() == "2 days"
         assert TimeInterval(60*60*24 + 60*60*12 + 60 + 35).format_human_readable() == "1 day, 12 hours, 1 minute, 35 seconds"
+
+
+class TestOutputMap:
+    def test_evaluate(self):
+        async def get_value():
+            return "async value"
+
+        output_map = OutputMap({
+            "id": "number * 2",
+            "nested.value": "await get_value()",
+            "nested.list": "[item for item in range(number)]"
+        })
+
+        result = asyncio.run(output_map.evaluate({"number": 3, "get_value": get_value}))
+
+        assert result == {"id": 6, "nested": {"value": "async value", "list": [0, 1, 2]}}
+
+    def test_only_awaiting_expressions_are_async(self):
+        output_map = OutputMap({"sync": "1 + 1", "async": "await asyncio.sleep(0)"})
+
+        assert [is_async for _, _, is_async in output_map.expressions] == [False, True]
+
+    def test_invalid_expression(self):
+        with pytest.raises(RuntimeError, match="Invalid output map expression for 'broken'"):
+            OutputMap({"broken": "message.text +"})
+
+
+class TestMediaConfiguration:
+    @staticmethod
+    def matches_rule(rule: dict, global_config: dict, media_type: str, mime_type: str, chat_type: str, chat_id: int, size: int):
+        # Straight-forward implementation of the rule semantics checking the raw config
+        for name, value in [("media_type", media_type), ("mime_type", mime_type), ("chat_type", chat_type)]:
+            if rule.get(name) is None and rule.get(f"{name}_re") is None:
+                continue
+
+            if rule.get(name) != value and not (rule.get(f"{name}_re") is not None and re.match(rule[f"{name}_re"], value)):
+                return False
+
+        if rule.get("chats") and chat_id not in rule["chats"]:
+            return False
+
+        max_size = rule.get("max_size", global_config.get("max_size"))
+        if max_size is not None and size > FileSize.human_readable_to_bytes(max_size):
+            return False
+
+        return True
+
+    def test_first_match(self):
+        randomizer = random.Random(42)
+        chat_ids = [-100123, -100456, 789, 1011]
+
+        rules = []
+        for _ in range(500):
+            rule = {}
+
+            match randomizer.randrange(3):
+                case 0:
+                    rule["media_type"] = randomizer.choice(["photo", "file"])
+                case 1:
+                    rule["media_type_re"] = "ph"
+
+            match randomizer.randrange(3):
+                case 0:
+                    rule["mime_type"] = randomizer.choice(["image/jpeg", "video/mp4"])
+                case 1:
+                    rule["mime_type_re"] = randomizer.choice(["image/", "video/", "application/(pdf|zip)"])
+
+            if randomizer.randrange(3) == 0:
+                rule["chat_type"] = randomizer.choice(["user", "group", "channel"])
+
+            if randomizer.randrange(2) == 0:
+                rule["chats"] = randomizer.sample(chat_ids, randomizer.randint(1, 2))
+
+            if randomizer.randrange(2) == 0:
+                rule["max_size"] = randomizer.choice(["100K", "1M", "10M"])
+
+            # Only a few rules accept everything
+            if randomizer.randrange(20) and not rule:
+                rule["chats"] = [randomizer.choice(chat_ids)]
+
+            rules.append(rule)
+
+        global_config = {"max_size": "5M"}
+        media_configuration = MediaConfiguration({**global_config, "rules": rules})
+
+        for _ in range(1000):
+            media_type = randomizer.choice(["photo", "file"])
+            mime_type = randomizer.choice(["image/jpeg", "image/png", "video/mp4", "application/pdf", "text/plain"])
+            chat_type = randomizer.choice(["user", "bot", "group", "channel"])
+            chat_id = randomizer.choice(chat_ids + [1213])
+            size = randomizer.choice([1000, 500000, 2000000, 8000000, 20000000])
+
+            media = MessageMediaPhoto() if media_type == "photo" else MessageMediaDocument()
+            message = SimpleNamespace(media=media, chat_id=chat_id, file=SimpleNamespace(mime_type=mime_type, size=size))
+
+            expected_index = next((index for index, rule in enumerate(rules) if self.matches_rule(rule, global_config, media_type, mime_type, chat_type, chat_id, size)), None)
+            rule = media_configuration.get_rule(message, chat_type)
+
+            assert (rule.index if rule else None) == expected_index
+
+
+class TestMetrics:
+    def test_format(self):
+        metrics = Metrics()
+
+        metrics.count("messages_total", (("chat_type", "group"),))
+        metrics.count("messages_total", (("chat_type", "group"),))
+        metrics.observe("eval_map_seconds", 0.003)
+        metrics.observe("eval_map_seconds", 100)
+        metrics.register("queue_depth", "gauge", lambda: {(("queue", "ingest"),): 5})
+
+        lines = metrics.format().splitlines()
+
+        assert 'telegram2elastic_messages_total{chat_type="group"} 2' in lines
+        assert "# TYPE telegram2elastic_eval_map_seconds histogram" in lines
+        assert 'telegram2elastic_eval_map_seconds_bucket{le="0.0025"} 0' in lines
+        assert 'telegram2elastic_eval_map_seconds_bucket{le="0.005"} 1' in lines
+        assert 'telegram2elastic_eval_map_seconds_bucket{le="60"} 1' in lines
+        assert 'telegram2elastic_eval_map_seconds_bucket{le="+Inf"} 2' in lines
+        assert "telegram2elastic_eval_map_seconds_count 2" in lines
+        assert 'telegram2elastic_queue_depth{queue="ingest"} 5' in lines
+
+    def test_server(self):
+        async def request(path: str):
+            metrics_server = MetricsServer({"port": 0})
+            await metrics_server.start()
+
+            port = metrics_server.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+
+            response = await reader.read()
+            writer.close()
+            await metrics_server.close()
+
+            return response
+
+        METRICS.count("messages_total", (("chat_type", "channel"),))
+
+        response = asyncio.run(request("/metrics"))
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        assert b'telegram2elastic_messages_total{chat_type="channel"}' in response
+
+        assert asyncio.run(request("/")).startswith(b"HTTP/1.1 404")
+
+
+class TestMessageContext:
+    class CountingMessage:
+        def __init__(self):
+            self.text_reads = 0
+
+        @property
+        def text(self):
+            self.text_reads += 1
+            return "hello"
+
+    def test_shared_evaluation(self):
+        message = self.CountingMessage()
+        context = MessageContext(message=message, chat=None, sender=MessageContext.get_sender_dict(None), translated_text=None, downloaded_media=None)
+        output_map = OutputMap({"message": "message.text", "sender": "sender['firstName']"})
+
+        async def evaluate():
+            return await asyncio.gather(context.get_message_dict(output_map), context.get_message_dict(output_map), context.get_message_json(output_map))
+
+        first_dict, second_dict, message_json = asyncio.run(evaluate())
+
+        assert first_dict is second_dict
+        assert message.text_reads == 1
+        assert message_json == b'{"message": "hello", "sender": "Deleted User"}'
+
+    def test_edit_record(self):
+        message = SimpleNamespace(id=7, chat_id=1, date=datetime(2026, 1, 1, tzinfo=timezone.utc), edit_date=datetime(2026, 1, 2, tzinfo=timezone.utc), text="edited")
+        output_map = OutputMap({**OutputWriter.default_output_map, "upper": "message.text.upper()", "translation": "translated_text"})
+
+        context = MessageContext(message=message, chat=None, sender={}, is_edit=True)
+        context.media_changed = False
+
+        # Only the fields depending on the text are evaluated again, sender, chat and media are kept as they are
+        assert asyncio.run(context.get_message_json(output_map)) == b'{"id": 7, "date": "2026-01-01T00:00:00+00:00", "message": "edited", "upper": "EDITED", "translation": null, "chat_id": 1, "edit_date": "2026-01-02T00:00:00+00:00", "edit": true}'
+
+        # Once a background download completed, only the media is updated so that the edited text is kept
+        context = context.with_media(DownloadedMedia(filepath=None, filename="new.jpg"))
+
+        assert asyncio.run(context.get_message_json(output_map)) == b'{"id": 7, "date": "2026-01-01T00:00:00+00:00", "media": "new.jpg", "chat_id": 1, "edit": true}'
+
+    def test_media_changes(self):
+        output_handler = OutputHandler({})
+
+        message = SimpleNamespace(id=1, chat_id=2, photo=SimpleNamespace(id=10), document=None)
+        assert output_handler.remember_media(message)
+        assert not output_handler.remember_media(message)
+
+        message.photo = SimpleNamespace(id=11)
+        assert output_handler.remember_media(message)
+
+
+class TestEntityCache:
+    class FakeMessage:
+        def __init__(self, chat, requests: list):
+            self.chat_id = chat.id
+            self.sender_id = chat.id
+            self.chat = chat
+            self.entity = chat
+            self.requests = requests
+
+        async def get_chat(self):
+            self.requests.append("chat")
+            return self.entity
+
+        async def get_sender(self):
+            self.requests.append("sender")
+            return self.entity
+
+    def test_cache(self, tmp_path):
+        cache_file = tmp_path / "entities.json"
+        requests = []
+        message = self.FakeMessage(User(id=123, first_name="Ann", last_name="B", username="ann"), requests)
+
+        async def lookup(entity_cache):
+            return await entity_cache.get_chat(message), await entity_cache.get_sender(message)
+
+        entity_cache = EntityCache({"file": str(cache_file)})
+        asyncio.run(lookup(entity_cache))
+        chat_info, sender_info = asyncio.run(lookup(entity_cache))
+        entity_cache.save()
+
+        # In private chats, the chat and the sender are the same entity
+        assert requests == ["chat"]
+        assert chat_info.display_name == "Ann B"
+        assert chat_info.chat_type.value == "user"
+        assert sender_info.sender == {"username": "ann", "firstName": "Ann", "lastName": "B"}
+
+        # Loaded from the file without further requests
+        chat_info, _ = asyncio.run(lookup(EntityCache({"file": str(cache_file)})))
+
+        assert requests == ["chat"]
+        assert chat_info.display_name == "Ann B"
+
+        # Expired entities are requested again
+        entity_cache.entities[123].fetched_at -= 2 * 86400
+        asyncio.run(lookup(entity_cache))
+
+        assert requests == ["chat", "chat"]
+
+    def test_chat_entity_and_size(self):
+        requests = []
+        entity_cache = EntityCache({"size": 2})
+
+        messages = [self.FakeMessage(User(id=chat_id, first_name=f"User {chat_id}"), requests) for chat_id in (1, 2, 3)]
+
+        # Entities unknown to Telethon
+        for message in messages:
+            message.chat = None
+
+        async def lookup():
+            return [(await entity_cache.get_chat_entity(message)).id for message in messages + [messages[2]]]
+
+        assert asyncio.run(lookup()) == [1, 2, 3, 3]
+        assert requests == ["chat", "chat", "chat"]
+
+        # Only the most recently used entities are kept
+        assert list(entity_cache.entities) == [2, 3]
+        assert list(entity_cache.chat_entities) == [2, 3]
+
+        # The chat entity is only requested if an output map uses it
+        assert "chat" in OutputMap({"chat": "get_display_name(chat)"}).variables
+        assert "chat" not in OutputMap(OutputWriter.default_output_map).variables
+
+
+class TestPipeline:
+    def create_pipeline(self, outputs: list, config: dict):
+        async def create_context(message, is_chat_enabled, is_edit=False):
+            if not is_chat_enabled(message):
+                return None
+
+            # The date is used for the lag metric once written
+            message.date = datetime.now(timezone.utc)
+
+            context = MessageContext(message=message, chat=None, sender={})
+            context.id = message.id
+
+            return context
+
+        async def enrich_context(context):
+            context.enriched = API_PRIORITY.get()
+
+        async def submit_media_download(context):
+            pass
+
+        output_handler = SimpleNamespace(outputs=outputs, create_context=create_context, enrich_context=enrich_context, submit_media_download=submit_media_download, media_downloader=MediaDownloader({}))
+
+        return Pipeline(output_handler, config)
+
+    def test_stages(self):
+        written = []
+
+        async def write_message(context):
+            assert context.enriched
+            written.append(context.id)
+
+        pipeline = self.create_pipeline([SimpleNamespace(write_message=write_message)], {})
+
+        async def run():
+            for message_id in range(10):
+                await pipeline.submit(SimpleNamespace(id=message_id), lambda message: message.id != 5)
+
+            await pipeline.close()
+
+        asyncio.run(run())
+
+        assert written == [0, 1, 2, 3, 4, 6, 7, 8, 9]
+        assert pipeline.get_stats()["output[#0]"]["processed"] == 9
+
+    def test_backpressure(self):
+        release = asyncio.Event()
+
+        async def write_message(context):
+            await release.wait()
+
+        pipeline = self.create_pipeline([SimpleNamespace(write_message=write_message)], {"ingest": {"queue_size": 1}, "enrich": {"queue_size": 1}, "output": {"queue_size": 1}})
+
+        async def run():
+            submit_task = asyncio.ensure_future(asyncio.gather(*[pipeline.submit(SimpleNamespace(id=message_id), lambda message: True) for message_id in range(10)]))
+            await asyncio.sleep(0.05)
+
+            # The slow output blocks its queue and all queues in front of it
+            stats = pipeline.get_stats()
+            assert not submit_task.done()
+            assert stats["output[#0]"]["queue_depth"] == 1
+            assert stats["output[#0]"]["busy_workers"] == 1
+
+            release.set()
+            await submit_task
+            await pipeline.close()
+
+        asyncio.run(run())
+
+    def test_chat_order(self):
+        written = []
+        randomizer = random.Random(1)
+
+        async def write_message(context):
+            await asyncio.sleep(randomizer.random() / 1000)
+            written.append((context.message.chat_id, context.id))
+
+        pipeline = self.create_pipeline([SimpleNamespace(write_message=write_message)], {"ingest": {"workers": 4}, "enrich": {"workers": 4}, "output": {"workers": 4}})
+
+        async def run():
+            for message_id in range(200):
+                await pipeline.submit(SimpleNamespace(id=message_id, chat_id=randomizer.randint(1, 10)), lambda message: True)
+
+            await pipeline.close()
+
+        asyncio.run(run())
+
+        assert len(written) == 200
+
+        # Messages of different chats are written concurrently, messages of the same chat in the order they were submitted
+        for chat_id in range(1, 11):
+            message_ids = [message_id for written_chat_id, message_id in written if written_chat_id == chat_id]
+            assert message_ids == sorted(message_ids)
+
+        assert written != sorted(written, key=lambda item: item[1])
+
+    def test_written(self):
+        async def write_message(context):
+            if context.id == 2:
+                raise ConnectionError("unavailable")
+
+        output = SimpleNamespace(write_message=write_message)
+        output.delivery = OutputDelivery(output, "output[#0]", {"max_retries": 0})
+
+        pipeline = self.create_pipeline([output], {})
+
+        async def run():
+            written = [await pipeline.submit(SimpleNamespace(id=message_id), lambda message: message.id != 3) for message_id in range(1, 4)]
+            results = await asyncio.gather(*written)
+
+            await pipeline.close()
+
+            return results
+
+        # Messages of disabled chats count as written
+        assert asyncio.run(run()) == [True, False, True]
+
+    def test_priority(self):
+        written = []
+
+        async def write_message(context):
+            written.append((context.id, context.priority, context.enriched))
+
+        pipeline = self.create_pipeline([SimpleNamespace(write_message=write_message)], {})
+
+        async def run():
+            await pipeline.submit(SimpleNamespace(id=1), lambda message: True)
+
+            # The pipeline tasks were started by the first message but use the priority of the caller of each message
+            with ApiRateLimiter.priority("backfill"):
+                await pipeline.submit(SimpleNamespace(id=2), lambda message: True)
+
+            await pipeline.close()
+
+        asyncio.run(run())
+
+        assert written == [(1, "live", "live"), (2, "backfill", "backfill")]
+
+    def test_fair_lanes(self):
+        processed = []
+
+        async def process(item):
+            await asyncio.sleep(0)
+            processed.append(item)
+
+        executor = KeyedExecutor(process, 1, 100, lambda item: item[0])
+
+        async def run():
+            task = asyncio.ensure_future(executor.run_lane(executor.lanes[0]))
+
+            for index in range(20):
+                await executor.put(("hot", index))
+
+            await executor.put(("cold", 0))
+            await executor.join()
+
+            task.cancel()
+
+        asyncio.run(run())
+
+        # Chats sharing a lane take turns, a chat with many pending messages does not delay the others
+        assert processed[:3] == [("hot", 0), ("cold", 0), ("hot", 1)]
+        assert [index for key, index in processed if key == "hot"] == list(range(20))
+
+
+class TestOutputSpool:
+    class FakeOutput(OutputWriter):
+        def __init__(self):
+            super().__init__({"name": "output[#0]", "output_map": {"id": "message.id", "text": "message.text"}})
+
+            self.written = []
+            self.failures = 0
+            self.rejected_ids = set()
+
+            # Rejected when flushing, like buffered messages of the bulk indexer
+            self.rejected_keys_on_flush = set()
+            self.pending_rejected_keys = []
+
+        async def write_message(self, context):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("unavailable")
+
+            message_key = (context.message.chat_id, context.message.id)
+
+            if context.message.id in self.rejected_ids:
+                raise RejectedMessageError("invalid document", [message_key])
+
+            if message_key in self.rejected_keys_on_flush:
+                self.pending_rejected_keys.append(message_key)
+                return
+
+            self.written.append(json.loads(await self.get_message_json(context)))
+
+        async def flush_pending(self):
+            rejected_keys, self.pending_rejected_keys = self.pending_rejected_keys, []
+
+            if rejected_keys:
+                raise RejectedMessageError("invalid documents", rejected_keys)
+
+    @staticmethod
+    def create_context(message_id: int, chat_id: int = 1):
+        message = SimpleNamespace(id=message_id, chat_id=chat_id, date=datetime(2026, 1, 1, tzinfo=timezone.utc), text=f"text {message_id}")
+
+        return MessageContext(message=message, chat=None, sender={})
+
+    def run_spool(self, output, config: dict, message_ids, wait: bool = True, chat_ids=(1,)):
+        spool = OutputSpool(output, {"retry_delay": 0.01, "close_timeout": 0.5 if wait else 0.05, **config})
+
+        async def run():
+            spool.start()
+
+            for message_id in message_ids:
+                for chat_id in chat_ids:
+                    await spool.append(self.create_context(message_id, chat_id))
+
+            await spool.close()
+
+        asyncio.run(run())
+
+        return spool
+
+    def test_retry(self, tmp_path):
+        output = self.FakeOutput()
+        output.failures = 3
+
+        spool = self.run_spool(output, {"path": str(tmp_path), "segment_size": "100"}, range(1, 11))
+
+        assert [message["id"] for message in output.written] == list(range(1, 11))
+        assert output.written[0] == {"id": 1, "text": "text 1"}
+        assert spool.size == 0
+
+        # Acknowledged segments are removed
+        assert len(list(tmp_path.glob("*.spool"))) <= 1
+
+    def test_replay(self, tmp_path):
+        output = self.FakeOutput()
+        output.failures = 1000
+
+        self.run_spool(output, {"path": str(tmp_path)}, range(1, 6), wait=False)
+
+        assert output.written == []
+
+        # Unacknowledged messages are written on the next start before new ones
+        output = self.FakeOutput()
+        self.run_spool(output, {"path": str(tmp_path)}, range(6, 8))
+
+        assert [message["id"] for message in output.written] == list(range(1, 8))
+
+    def test_dead_letter_and_limit(self, tmp_path):
+        output = self.FakeOutput()
+        output.rejected_ids = {2}
+
+        spool = self.run_spool(output, {"path": str(tmp_path)}, range(1, 4))
+
+        assert [message["id"] for message in output.written] == [1, 3]
+
+        dead_letters = [json.loads(line) for line in tmp_path.joinpath("dead-letter.jsonl").read_text().splitlines()]
+        assert [dead_letter["record"]["id"] for dead_letter in dead_letters] == [2]
+        assert spool.size == 0
+
+        output = self.FakeOutput()
+        output.failures = 1000
+
+        spool = self.run_spool(output, {"path": str(tmp_path / "limited"), "max_size": "200"}, range(1, 11), wait=False)
+
+        assert 0 < spool.size <= 200
+        assert spool.dropped_records > 0
+
+    def test_dead_letter_by_chat(self, tmp_path):
+        output = self.FakeOutput()
+        output.rejected_keys_on_flush = {(2, 2)}
+
+        self.run_spool(output, {"path": str(tmp_path)}, range(1, 4), chat_ids=(1, 2))
+
+        # Only the rejected message is written to the dead letter file, not the message of the other chat using the same ID
+        dead_letters = [json.loads(line) for line in tmp_path.joinpath("dead-letter.jsonl").read_text().splitlines()]
+        assert [(dead_letter["record"]["chat_id"], dead_letter["record"]["id"]) for dead_letter in dead_letters] == [(2, 2)]
+        assert len(output.written) == 5
+
+
+class TestOutputDelivery:
+    class FlakyOutput:
+        def __init__(self, failures: int = 0, delay: float = 0):
+            self.failures = failures
+            self.delay = delay
+            self.attempts = 0
+            self.written = []
+
+        async def write_message(self, context):
+            self.attempts += 1
+            await asyncio.sleep(self.delay)
+
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("unavailable")
+
+            self.written.append(context.message.id)
+
+    @staticmethod
+    def create_context(message_id: int):
+        return SimpleNamespace(message=SimpleNamespace(id=message_id, chat_id=1))
+
+    def test_retry_and_timeout(self):
+        output = self.FlakyOutput(failures=2)
+        delivery = OutputDelivery(output, "output[#0]", {"retry_delay": 0.01})
+
+        asyncio.run(delivery.write(self.create_context(1)))
+
+        assert output.written == [1]
+        assert output.attempts == 3
+
+        slow_output = self.FlakyOutput(delay=1)
+        delivery = OutputDelivery(slow_output, "output[#1]", {"timeout": 0.05, "max_retries": 1, "retry_delay": 0.01})
+
+        start_time = time.monotonic()
+        asyncio.run(delivery.write(self.create_context(1)))
+
+        assert slow_output.written == []
+        assert slow_output.attempts == 2
+        assert time.monotonic() - start_time < 0.5
+
+    def test_circuit_breaker(self):
+        output = self.FlakyOutput(failures=3)
+        delivery = OutputDelivery(output, "output[#0]", {"max_retries": 0, "failure_threshold": 3, "reset_timeout": 0.1})
+
+        async def write(message_ids):
+            for message_id in message_ids:
+                await delivery.write(self.create_context(message_id))
+
+        asyncio.run(write(range(1, 6)))
+
+        # The circuit opened after the third failure, further messages are skipped without trying
+        assert output.attempts == 3
+        assert delivery.skipped_messages == 2
+
+        time.sleep(0.1)
+        asyncio.run(write([6, 7]))
+
+        assert output.written == [6, 7]
+        assert not delivery.circuit_breaker.is_open()
+
+    def test_concurrent_fan_out(self):
+        output_handler = OutputHandler({})
+
+        healthy_output = self.FlakyOutput(delay=0.05)
+        slow_output = self.FlakyOutput(delay=0.05, failures=1000)
+
+        for index, output in enumerate([slow_output, healthy_output]):
+            output.delivery = OutputDelivery(output, f"output[#{index}]", {"max_retries": 0})
+            output_handler.outputs.append(output)
+
+        start_time = time.monotonic()
+        asyncio.run(output_handler.write_context(self.create_context(1)))
+
+        # Both outputs have been written at the same time and the failing one did not prevent writing the healthy one
+        assert healthy_output.written == [1]
+        assert time.monotonic() - start_time < 0.09
+
+
+class TestMediaDownloader:
+    class FakeMessage:
+        def __init__(self, message_id: int, size: int):
+            self.id = message_id
+            self.file = SimpleNamespace(size=size)
+
+        async def download_media(self, file, progress_callback):
+            for position in range(0, self.file.size, 1024):
+                await progress_callback(min(position + 1024, self.file.size), self.file.size)
+
+            file.write_bytes(b"x" * self.file.size)
+
+    def test_background_download(self, tmp_path):
+        downloader = MediaDownloader({"workers": 2})
+        written = []
+
+        async def write_context(context):
+            assert context.is_edit and context.media_only
+            written.append((context.message.id, context.downloaded_media.status))
+
+        async def run():
+            for message_id in range(1, 4):
+                media = DownloadedMedia(filepath=tmp_path / f"{message_id}.bin", filename=f"{message_id}.bin", status="pending")
+                context = MessageContext(message=self.FakeMessage(message_id, 20 * 1024), chat=None, sender={}, downloaded_media=media)
+
+                await downloader.submit(context, write_context)
+
+            await downloader.close()
+
+        asyncio.run(run())
+
+        assert sorted(written) == [(1, "downloaded"), (2, "downloaded"), (3, "downloaded")]
+        assert downloader.downloaded_bytes == 3 * 20 * 1024
+        assert (tmp_path / "3.bin").stat().st_size == 20 * 1024
+
+    def test_close_timeout(self, tmp_path):
+        downloader = MediaDownloader({"workers": 1, "max_bandwidth": "1K", "close_timeout": 0.1})
+        written = []
+
+        async def write_context(context):
+            written.append(context.message.id)
+
+        async def run():
+            for message_id in range(1, 3):
+                media = DownloadedMedia(filepath=tmp_path / f"{message_id}.bin", filename=f"{message_id}.bin", status="pending")
+                await downloader.submit(MessageContext(message=self.FakeMessage(message_id, 20 * 1024), chat=None, sender={}, downloaded_media=media), write_context)
+
+            # Downloads still pending after the timeout are cancelled
+            await downloader.close()
+
+        asyncio.run(run())
+
+        assert written == []
+
+    def test_dedup(self, tmp_path):
+        downloader = MediaDownloader({"dedup": {"index_file": str(tmp_path / "index.jsonl"), "link": "hardlink", "hash": True}})
+        downloads = []
+
+        class FakeDocumentMessage(self.FakeMessage):
+            def __init__(self, message_id: int, document_id: int, content: bytes):
+                super().__init__(message_id, len(content))
+                self.photo = None
+                self.document = SimpleNamespace(id=document_id)
+                self.content = content
+
+            async def download_media(self, file, progress_callback):
+                downloads.append(self.id)
+                await asyncio.sleep(0.01)
+                file.write_bytes(self.content)
+
+        async def download(message):
+            return await downloader.download(message, DownloadedMedia(filepath=tmp_path / f"{message.id}.bin", filename=f"{message.id}.bin"))
+
+        async def run():
+            # Message 2 is a forward of message 1 (same document) downloaded at the same time, message 3 contains the same bytes using another document
+            return await asyncio.gather(download(FakeDocumentMessage(1, 100, b"content")), download(FakeDocumentMessage(2, 100, b"content")), download(FakeDocumentMessage(3, 200, b"content")))
+
+        results = asyncio.run(run())
+
+        assert downloads == [1, 3]
+        assert [result.status for result in results] == ["downloaded"] * 3
+        assert (tmp_path / "1.bin").stat().st_ino == (tmp_path / "2.bin").stat().st_ino == (tmp_path / "3.bin").stat().st_ino
+
+        # The index is kept on disk, a re-import does not download anything
+        downloader = MediaDownloader({"dedup": {"index_file": str(tmp_path / "index.jsonl"), "link": "reference"}})
+        result = asyncio.run(download(FakeDocumentMessage(4, 100, b"content")))
+
+        assert downloads == [1, 3]
+        assert result.filepath == tmp_path / "1.bin"
+
+    def test_bandwidth_limit(self):
+        downloader = MediaDownloader({"max_bandwidth": "100K"})
+
+        async def run():
+            start_time = time.monotonic()
+
+            # The first 100K are covered by the bucket capacity, the remaining 50K take half a second
+            await downloader.create_progress_callback()(150 * 1024, 150 * 1024)
+
+            return time.monotonic() - start_time
+
+        assert 0.4 < asyncio.run(run()) < 1
+
+
+class TestTranslator:
+    class FakeClient:
+        def __init__(self):
+            self.requests = []
+
+        async def __call__(self, request):
+            self.requests.append((request.peer, request.id))
+
+            return SimpleNamespace(result=[SimpleNamespace(text=f"translated {message_id}") for message_id in request.id])
+
+    def create_message(self, client, chat_id: int, message_id: int, text: str = "text"):
+        return SimpleNamespace(client=client, chat_id=chat_id, id=message_id, text=text, input_chat=f"peer {chat_id}")
+
+    def test_batches_and_cache(self, tmp_path):
+        client = self.FakeClient()
+        config = {"batch_size": 3, "max_wait": 0.01, "cache_file": str(tmp_path / "translations.json")}
+
+        async def translate(translator, messages):
+            results = await asyncio.gather(*[translator.translate(message) for message in messages])
+            await translator.close()
+
+            return results
+
+        messages = [self.create_message(client, 1, 1), self.create_message(client, 2, 1), self.create_message(client, 1, 2), self.create_message(client, 1, 3), self.create_message(client, 1, 4)]
+        results = asyncio.run(translate(Translator("en", config), messages))
+
+        assert results == ["translated 1", "translated 1", "translated 2", "translated 3", "translated 4"]
+        assert client.requests == [("peer 1", [1, 2, 3]), ("peer 2", [1]), ("peer 1", [4])]
+
+        # Unchanged texts are taken from the persisted cache, edited texts are translated again
+        client.requests.clear()
+        results = asyncio.run(translate(Translator("en", config), [self.create_message(client, 1, 1), self.create_message(client, 1, 2, "edited")]))
+
+        assert results == ["translated 1", "translated 2"]
+        assert client.requests == [("peer 1", [2])]
+
+
+class FakeTelegramClient:
+    def __init__(self, chats: dict):
+        # Maps chat ID to the list of message IDs in that chat
+        self.chats = chats
+        self.active_imports = 0
+        self.max_active_imports = 0
+
+    async def get_entity(self, chat_ids):
+        return [ChatForbidden(id=int(chat_id), title=f"Chat {chat_id}") for chat_id in chat_ids]
+
+    async def iter_messages(self, chat, offset_date=None, min_id=0, reverse=False):
+        self.active_imports += 1
+        self.max_active_imports = max(self.max_active_imports, self.active_imports)
+
+        try:
+            for message_id in self.chats[chat.id]:
+                if message_id <= min_id:
+                    continue
+
+                await asyncio.sleep(0)
+                yield SimpleNamespace(id=message_id, chat_id=chat.id, date=datetime(2026, 1, 1))
+        finally:
+            self.active_imports -= 1
+
+
+class FloodWaitClient:
+    # Sends requests by recording them, the first requests fail with FloodWait errors
+    flood_sleep_threshold = 60
+
+    def __init__(self, flood_waits: list = None):
+        self.flood_waits = list(flood_waits or [])
+        self.requests = []
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        if self.flood_waits:
+            raise FloodWaitError(request=request, capture=self.flood_waits.pop(0))
+
+        self.requests.append(request)
+
+        return request
+
+
+class FakeOutputHandler:
+    def __init__(self, failing_ids: set = None):
+        self.messages = []
+        self.failing_ids = failing_ids or set()
+        self.failed_flushes = 0
+        self.report_errors = False
+
+    async def submit(self, message, is_chat_enabled):
+        assert self.report_errors
+        self.messages.append((message.chat_id, message.id))
+
+        written = asyncio.get_running_loop().create_future()
+        written.set_result(message.id not in self.failing_ids)
+
+        return written
+
+    async def flush_pending(self):
+        return True
+
+    def set_report_errors(self, enabled: bool):
+        self.report_errors = enabled
+
+    async def join(self):
+        pass
+
+
+@pytest.fixture
+def telegram_export(tmp_path):
+    export = {
+        "about": "Here is the data you requested.",
+        "personal_information": {"user_id": 42, "first_name": "Me"},
+        "contacts": {"about": "", "list": [{"first_name": "Ann", "phone_number": "+1"}]},
+        "chats": {
+            "about": "",
+            "list": [
+                {
+                    "name": "Ann",
+                    "type": "personal_chat",
+                    "id": 123,
+                    "messages": [
+                        {"id": 1, "type": "service", "date": "2020-01-01T10:00:00", "date_unixtime": "1577872800", "actor": "Ann", "action": "phone_call"},
+                        {"id": 2, "type": "message", "date": "2020-01-01T10:01:00", "date_unixtime": "1577872860", "from": "Ann", "from_id": "user123", "text": "Hello"},
+                        {"id": 3, "type": "message", "date": "2020-01-01T10:02:00", "date_unixtime": "1577872920", "edited": "2020-01-01T10:03:00", "edited_unixtime": "1577872980", "from": "Me", "from_id": "user42", "text": ["Look at ", {"type": "bold", "text": "this"}], "file": "files/doc.pdf", "mime_type": "application/pdf"}
+                    ]
+                },
+                {
+                    "name": "News",
+                    "type": "public_channel",
+                    "id": 1234567,
+                    "messages": [
+                        {"id": 10, "type": "message", "date": "2020-01-02T00:00:00", "date_unixtime": "1577923200", "from": "News", "from_id": "channel1234567", "text": "Breaking", "photo": "(File not included. Change data exporting settings to download.)"}
+                    ]
+                }
+            ]
+        },
+        "left_chats": {"about": "", "list": []}
+    }
+
+    tmp_path.joinpath("files").mkdir()
+    tmp_path.joinpath("files", "doc.pdf").write_bytes(b"%PDF")
+    tmp_path.joinpath("result.json").write_text(json.dumps(export, indent=1))
+
+    return tmp_path
+
+
+class TestTelegramExport:
+    def test_stream_reader(self, telegram_export):
+        export_text = telegram_export.joinpath("result.json").read_text()
+
+        # Tiny chunks to split values (e.g. numbers) between chunks
+        reader = JsonStreamReader(io.StringIO(export_text), chunk_size=7)
+        document = {}
+
+        for key in reader.iter_object():
+            document[key] = reader.read_value()
+
+        assert document == json.loads(export_text)
+
+    def test_messages(self, telegram_export):
+        export = TelegramExport(str(telegram_export))
+        messages = [(chat["name"], message["id"]) for chat, message in export.iter_messages()]
+
+        assert messages == [("Ann", 1), ("Ann", 2), ("Ann", 3), ("News", 10)]
+
+        chat, data = list(export.iter_messages())[2]
+        context = export.create_context(chat, data)
+
+        assert context.message.text == "Look at this"
+        assert context.message.chat_id == 123
+        assert context.message.sender_id == 42
+        assert context.message.date == datetime(2020, 1, 1, 10, 2, tzinfo=timezone.utc)
+        assert context.message.edit_date == datetime(2020, 1, 1, 10, 3, tzinfo=timezone.utc)
+        assert context.chat_type == "user"
+        assert context.downloaded_media.filename == "doc.pdf"
+
+    def test_import(self, telegram_export, tmp_path):
+        output_handler = OutputHandler({})
+        output_handler.add({"type": "file", "path": str(tmp_path / "messages.json"), "output_map": {"id": "message.id", "chat": "chat_name", "chat_id": "message.chat_id", "sender": "sender['firstName']", "message": "message.text", "media": "media.filename if media else None"}})
+
+        async def run(chats):
+            await ExportImporter(output_handler).import_export(str(telegram_export), chats)
+            await output_handler.close()
+
+        asyncio.run(run(["1234567"]))
+
+        lines = [json.loads(line) for line in tmp_path.joinpath("messages.json").read_text().splitlines()]
+
+        assert lines == [{"id": 10, "chat": "News", "chat_id": -1000001234567, "sender": "News", "message": "Breaking", "media": None}]
+
+
+class TestReplayer:
+    @staticmethod
+    def write_lines(path, message_ids: list, opener=open):
+        with opener(path, "wt") as file:
+            for message_id in message_ids:
+                file.write(json.dumps({"id": message_id, "chat_id": message_id % 3, "date": f"2020-01-01T10:00:{message_id:02}+00:00", "message": f"Message {message_id}"}) + "\n")
+
+    def replay(self, tmp_path, paths: list, resume: tuple = None, workers: int = 0):
+        output_handler = OutputHandler({})
+        output_handler.add({"type": "file", "path": str(tmp_path / "replayed.json"), "flush_interval": 0})
+
+        replayer = Replayer(output_handler.outputs, batch_size=3, parallel=2, workers=workers)
+
+        async def run():
+            await replayer.replay(paths, resume)
+            await output_handler.close()
+
+        asyncio.run(run())
+
+        records = [json.loads(line) for line in tmp_path.joinpath("replayed.json").read_text().splitlines()]
+
+        # Batches are written in parallel, only the order of messages of the same chat is kept
+        for chat_id in {record["chat_id"] for record in records}:
+            message_ids = [record["id"] for record in records if record["chat_id"] == chat_id]
+            assert message_ids == sorted(message_ids)
+
+        return replayer, sorted(record["id"] for record in records)
+
+    def test_replay(self, tmp_path):
+        source_dir = tmp_path / "source"
+        source_dir.mkdir()
+
+        # Rotated and compressed file (without extension, like written by the file output) followed by the current file with an incomplete last line and an invalid line
+        self.write_lines(source_dir / "messages.json.20200101-100000-000000", range(1, 8), gzip.open)
+        os.utime(source_dir / "messages.json.20200101-100000-000000", (0, 0))
+
+        self.write_lines(source_dir / "messages.json", range(8, 12))
+
+        with open(source_dir / "messages.json", "a") as file:
+            file.write("not json\n{\"id\": 12")
+
+        replayer, message_ids = self.replay(tmp_path, [str(source_dir)], workers=2)
+
+        assert message_ids == list(range(1, 12))
+        assert replayer.invalid_lines == 1
+        assert replayer.position == (str(source_dir / "messages.json"), os.path.getsize(source_dir / "messages.json") - len('{"id": 12'))
+
+    def test_resume(self, tmp_path):
+        source_dir = tmp_path / "source"
+        source_dir.mkdir()
+
+        self.write_lines(source_dir / "messages.json.20200101-100000-000000", range(1, 5))
+        self.write_lines(source_dir / "messages.json", range(5, 11))
+
+        with open(source_dir / "messages.json", "rb") as file:
+            offset = sum(len(file.readline()) for _ in range(2))
+
+        # Files before the logged file are skipped, the offset only applies to the logged file
+        _, message_ids = self.replay(tmp_path, [str(source_dir)], Replayer.parse_resume(f"{source_dir / 'messages.json'}:{offset}"))
+
+        assert message_ids == list(range(7, 11))
+
+    def test_rotated_order(self, tmp_path):
+        from output.file import Writer
+
+        source_dir = tmp_path / "source"
+        writer = Writer({"path": str(source_dir / "messages.json"), "max_size": 150, "compress_rotated": "gzip", "flush_interval": 0, "output_map": {"id": "message.id", "chat_id": "message.chat_id", "date": "message.date"}})
+
+        async def write():
+            for message_id in range(1, 8):
+                await writer.write_message(MessageContext(message=SimpleNamespace(id=message_id, chat_id=1, date=datetime(2020, 1, 1, tzinfo=timezone.utc)), chat=None, sender={}))
+
+            await writer.close()
+
+        asyncio.run(write())
+
+        assert len(list(source_dir.glob("*.gz"))) > 1
+
+        # The file currently written to comes last even if it has been modified before the last segment has been compressed
+        os.utime(source_dir / "messages.json", (0, 0))
+
+        output_handler = OutputHandler({})
+        output_handler.add({"type": "file", "path": str(tmp_path / "replayed.json"), "flush_interval": 0})
+
+        async def replay():
+            await Replayer(output_handler.outputs, batch_size=2, parallel=2, workers=0).replay([str(source_dir)])
+            await output_handler.close()
+
+        asyncio.run(replay())
+
+        assert [json.loads(line)["id"] for line in tmp_path.joinpath("replayed.json").read_text().splitlines()] == list(range(1, 8))
+
+    def test_failed_output(self, tmp_path):
+        class FailingWriter(OutputWriter):
+            async def write_message(self, context):
+                if context.message.id == 5:
+                    raise ConnectionError("unavailable")
+
+        writer = FailingWriter({})
+        writer.delivery = OutputDelivery(writer, "output[#0]", {"max_retries": 0, "failure_threshold": 0})
+
+        self.write_lines(tmp_path / "messages.json", range(1, 11))
+
+        with open(tmp_path / "messages.json", "rb") as file:
+            offset = sum(len(file.readline()) for _ in range(3))
+
+        replayer = Replayer([writer], batch_size=3, parallel=2, workers=0)
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(replayer.replay([str(tmp_path / "messages.json")]))
+
+        # The position stays before the batch containing the message which could not be written
+        assert replayer.position == (str(tmp_path / "messages.json"), offset)
+
+
+class TestApiRateLimiter:
+    def test_flood_wait(self):
+        client = FloodWaitClient([1, 0])
+        rate_limiter = ApiRateLimiter({"rate": 100, "min_rate": 10, "recovery": 0.5})
+        rate_limiter.install(client)
+
+        async def run():
+            start_time = time.monotonic()
+
+            assert await client._call(None, "request") == "request"
+
+            # Waited for the FloodWait error and halved the rate twice, the successful request raised it again
+            assert time.monotonic() - start_time >= 1
+            assert rate_limiter.bucket.rate == 75
+            assert client.flood_sleep_threshold == 0
+
+        asyncio.run(run())
+
+        assert client.requests == ["request"]
+
+    def test_priorities(self):
+        client = FloodWaitClient()
+        rate_limiter = ApiRateLimiter({"rate": 50, "burst": 1})
+        rate_limiter.install(client)
+
+        async def send(request: str, priority: str):
+            with ApiRateLimiter.priority(priority):
+                await client._call(None, request)
+
+        async def run():
+            # Uses the only token, the other requests wait for the next ones
+            await send("first", "backfill")
+
+            await asyncio.gather(send("media", "media"), send("backfill", "backfill"), send("live", "live"), send("live2", "live"))
+
+        asyncio.run(run())
+
+        assert client.requests == ["first", "live", "live2", "backfill", "media"]
+        assert rate_limiter.wait_stats["live"][0] == 2
+        assert rate_limiter.wait_stats["media"][1] > rate_limiter.wait_stats["live"][1]
+
+    def test_flood_wait_priority(self):
+        client = FloodWaitClient([30])
+        rate_limiter = ApiRateLimiter({"rate": 100})
+        rate_limiter.install(client)
+
+        async def send(request: str, priority: str):
+            with ApiRateLimiter.priority(priority):
+                await client._call(None, request)
+
+        async def run():
+            media_request = asyncio.ensure_future(send("media", "media"))
+            await asyncio.sleep(0.1)
+
+            # Only media requests wait for the FloodWait error received by the media request
+            await asyncio.wait_for(send("live", "live"), 1)
+            assert not media_request.done()
+
+            media_request.cancel()
+
+        asyncio.run(run())
+
+        assert client.requests == ["live"]
+
+
+class TestTelegramReader:
+    def create_reader(self, client, config: dict = None, output_handler: FakeOutputHandler = None):
+        reader = TelegramReader(config or {}, output_handler or FakeOutputHandler(), client)
+        reader.page_size = 3
+
+        return reader
+
+    def test_parallel_import(self):
+        client = FakeTelegramClient({1: list(range(1, 11)), 2: list(range(1, 21)), 3: list(range(1, 6))})
+        reader = self.create_reader(client)
+
+        asyncio.run(reader.import_history(chats=["1", "2", "3"], parallel=2))
+
+        assert client.max_active_imports == 2
+
+        for chat_id, message_ids in client.chats.items():
+            assert [message_id for message_chat_id, message_id in reader.output_handler.messages if message_chat_id == chat_id] == message_ids
+
+    def test_report_errors(self):
+        from output.tcp import Writer
+
+        output_handler = OutputHandler({})
+        output_handler.outputs.append(Writer({"host": "127.0.0.1", "port": 1}))
+
+        # Lines dropped while listening are neither tracked nor reported by the next import
+        assert not output_handler.outputs[0].report_errors
+        output_handler.outputs[0].unreported_dropped_lines = 3
+
+        output_handler.set_report_errors(True)
+
+        assert output_handler.outputs[0].report_errors
+        assert asyncio.run(output_handler.flush_pending())
+
+    def test_fetch_error(self):
+        class FailingClient(FakeTelegramClient):
+            async def iter_messages(self, chat, offset_date=None, min_id=0, reverse=False):
+                yield SimpleNamespace(id=1, chat_id=chat.id, date=datetime(2026, 1, 1))
+                raise ConnectionError("connection lost")
+
+        with pytest.raises(ConnectionError):
+            asyncio.run(self.create_reader(FailingClient({1: []})).import_history(chats=["1"]))
+
+    def test_checkpoints(self, tmp_path):
+        config = {"checkpoint_file": str(tmp_path / "checkpoints.json")}
+        client = FakeTelegramClient({1: [1, 2, 3]})
+
+        asyncio.run(self.create_reader(client, config).import_history(chats=["1"]))
+
+        # Only messages after the last imported message are fetched again
+        client.chats[1].extend([4, 5])
+        reader = self.create_reader(client, config)
+        asyncio.run(reader.import_history(chats=["1"]))
+
+        assert reader.output_handler.messages == [(1, 4), (1, 5)]
+
+        reader = self.create_reader(client, config)
+        asyncio.run(reader.import_history(chats=["1"], full=True))
+
+        assert len(reader.output_handler.messages) == 5
+
+        # Checkpoints are stored by the peer ID of the chat
+        assert json.loads((tmp_path / "checkpoints.json").read_text()) == {"-1": 5}
+
+    def test_checkpoint_after_failed_message(self, tmp_path):
+        config = {"checkpoint_file": str(tmp_path / "checkpoints.json")}
+        client = FakeTelegramClient({1: list(range(1, 11))})
+
+        reader = self.create_reader(client, config, FakeOutputHandler({5}))
+        reader.progress_interval = 3
+        asyncio.run(reader.import_history(chats=["1"]))
+
+        # The checkpoint stays before the page containing the message which could not be written
+        assert json.loads((tmp_path / "checkpoints.json").read_text()) == {"-1": 3}